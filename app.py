@@ -1,44 +1,50 @@
 import streamlit as st
 import os
 import time
-import pandas as pd
-import random
 import json
 from datetime import datetime
-from src.data_processor import WorkflowModifier
+from src.data_processor import load_template
+from src import workflow_builder
+from src.workflow_builder import WORKFLOW_BINDINGS
 from src.comfy_client import ComfyAgent
 from src.file_manager import AssetManager
-from PIL import Image, ImageFile
-ImageFile.LOAD_TRUNCATED_IMAGES = True  # 允许加载截断的图片文件
+from src.run_ledger import RunLedger
+from src.thumbnails import ThumbnailCache
+from src.model_catalog import ModelCatalog
+from src.reference_images import ReferenceImages
+from src.job_ledger import JobSource
+from src.job_queue import JobQueue
+from src.asset_index import AssetIndex, DUPLICATE_DISTANCE
+from src import draft_scoring, telemetry
 
 # === ⚙️ 配置区 ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_PATH = os.path.join(BASE_DIR, "config", "workflow_api.json")
 PROJECT_OUTPUT_DIR = os.path.join(BASE_DIR, "output")
-HISTORY_FILE = os.path.join(BASE_DIR, "history.csv")
+LEDGER_FILE = os.path.join(BASE_DIR, "runs.sqlite") # 运行台账 (替代 history.csv)，分析页的数据来源
 JOBS_FILE = os.path.join(BASE_DIR, "jobs.csv") # 👈 任务清单文件
+JOURNAL_FILE = os.path.join(BASE_DIR, "jobs.progress.jsonl") # 进度日志 (与 main.py 共用)，删除即可从头重跑
+DRAFT_JOURNAL_FILE = os.path.join(BASE_DIR, "jobs.drafts.jsonl") # 草图模式的进度日志 (精修完成的行才记入正式进度日志)
+DRAFT_PICK_LIMIT = 48 # 挑选草图时最多展示的张数 (按评分排序)
+JOB_PREVIEW_ROWS = 200
+QUEUE_FILE = os.path.join(BASE_DIR, "queue.sqlite") # 批量任务队列，由后台 worker (worker.py) 执行
+QUEUE_STATUS_BATCHES = 10 # 批量页展示最近的批次数
+WORKER_STALE_SECONDS = 30 # 超过该时间没有心跳的 worker 视为离线
+THUMB_CACHE_DIR = os.path.join(BASE_DIR, "cache", "thumbs")
+REF_CACHE_DIR = os.path.join(BASE_DIR, "cache", "refs") # ControlNet 参考图预处理缓存 (按内容哈希 + 尺寸命名)
+ASSET_INDEX_FILE = os.path.join(BASE_DIR, "cache", "assets.sqlite") # 输出图片的感知哈希 (与 worker.py 共用)，画廊合并相似图片时使用
+TELEMETRY_DIR = os.path.join(BASE_DIR, "telemetry") # worker --telemetry 导出的耗时指标 (.prom) 与批次追踪 (.json)
 
 # ⚠️ 路径配置
 COMFY_MODELS_DIR = r"M:\models\checkpoints"
 COMFY_LORAS_DIR = r"M:\models\loras"
 COMFY_CN_DIR = r"M:\models\controlnet"
 COMFY_UPSCALE_DIR = r"M:\models\upscale_models"
-COMFY_INPUT_DIR = r"D:\ComfyUI_Main\ComfyUI-aki-v3\ComfyUI-aki-v3\ComfyUI\input"
 COMFY_OUTPUT_DIR = r"D:\ComfyUI_Main\ComfyUI-aki-v3\ComfyUI-aki-v3\ComfyUI\output"
-
-# 🔗 节点 ID
-NODE_ID_PROMPT = "6"
-NODE_ID_NEGATIVE = "7"
-NODE_ID_KSAMPLER = "3"
-NODE_ID_KSAMPLER_2 = "18" # 第二遍采样的采样器
-NODE_ID_CHECKPOINT = "4"
-NODE_ID_EMPTY_LATENT = "5"
-NODE_ID_LORA = "10"
-NODE_ID_CN_LOADER = "11"
-NODE_ID_CN_IMAGE = "13"
-NODE_ID_UPSCALE_LOADER = "15"
-NODE_ID_UPSCALE_IMAGE = "16"
-NODE_ID_SAVE_IMAGE = "9"
+COMFY_LOCAL_BACKENDS = ["http://127.0.0.1:8188"] # 与上面输出目录同机的实例：输出直接从磁盘搬运 (同盘时只是重命名)，不经 HTTP 下载
+# 批量模式可同时驱动多台 ComfyUI (每行一个地址)，任务自动发往最空闲的实例
+COMFY_BACKENDS = ["http://127.0.0.1:8188"]
+MODEL_CATALOG_TTL = 60 # 模型清单缓存时长 (秒)，侧边栏可手动刷新
 
 RATIO_PRESETS = {"1:1 方形头像": (512, 512), "3:4 小红书": (512, 680), "16:9 壁纸": (912, 512)}
 STYLE_PRESETS = {
@@ -47,79 +53,86 @@ STYLE_PRESETS = {
     "🦁 霸气线稿风": "intricate details, majestic, ink sketch style, 8k",
     "📸 真实摄影": "photorealistic, raw photo, dslr, soft lighting"
 }
+BATCH_MODE_LABELS = {"draft": "🧪 草图", "refine": "✨ 精修"}
+BATCH_STATUS_LABELS = {"queued": "⏳ 排队中", "running": "🏃 执行中", "done": "✅ 已完成", "cancelled": "⏹️ 已取消", "failed": "❌ 失败"}
 DEFAULT_NEGATIVE = "embedding:EasyNegative, nsfw, lowres, bad anatomy, bad hands, text, error, blurry"
 
 st.set_page_config(page_title="Siyua AIGC Factory v2.3", layout="wide", page_icon="🏭")
 
-def get_files(directory, extensions):
-    if not os.path.exists(directory): return []
-    return [f for f in os.listdir(directory) if f.endswith(extensions)]
+@st.cache_data
+def count_jobs(jobs_file, fingerprint):
+    # 按文件指纹缓存行数，jobs.csv 不变时 rerun 不再全量扫描
+    return JobSource(jobs_file).count()
+
+@st.cache_resource
+def get_thumbnail_cache():
+    # 进程级单例：缩略图索引、后台线程池和目录列表缓存跨 rerun 复用
+    return ThumbnailCache(THUMB_CACHE_DIR)
+
+@st.cache_resource
+def get_model_catalog():
+    # 进程级单例：模型清单优先取自 ComfyUI /object_info，否则扫描本地目录；按 TTL + 目录 mtime 刷新
+    return ModelCatalog(COMFY_BACKENDS[0], {
+        "checkpoints": COMFY_MODELS_DIR, "loras": COMFY_LORAS_DIR,
+        "controlnet": COMFY_CN_DIR, "upscale_models": COMFY_UPSCALE_DIR,
+    }, ttl=MODEL_CATALOG_TTL)
+
+@st.cache_resource
+def get_job_queue():
+    # 进程级单例：批量任务队列 (与 worker.py 共用)
+    return JobQueue(QUEUE_FILE)
+
+@st.cache_resource
+def get_reference_images(backends):
+    # 进程级单例 (按实例列表)：参考图按内容哈希上传，同一张图只传一次，rerun 不再重复写入
+    return ReferenceImages([ComfyAgent(url) for url in backends], REF_CACHE_DIR)
+
+@st.cache_resource
+def get_asset_index():
+    # 进程级单例：哈希数组常驻内存，worker 写入新图片后按数据库版本自动重新载入
+    return AssetIndex(ASSET_INDEX_FILE, PROJECT_OUTPUT_DIR)
+
+@st.cache_data
+def duplicate_clusters(version, max_distance, _names):
+    # 以索引版本为缓存键 (画廊列表变化时 sync 会更新索引)，不对十万级的文件名列表做哈希
+    return get_asset_index().clusters(_names, max_distance)
+
+@st.cache_resource
+def get_run_ledger():
+    # 进程级单例：写入缓冲区跨 rerun 保留
+    return RunLedger(LEDGER_FILE)
 
-def log_job(prompt, style, seed, status, cost_time, filename="N/A"):
-    new_data = {"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "prompt": prompt, "style": style, "seed": seed, "status": status, "cost_time_sec": round(cost_time, 2), "filename": filename}
-    if not os.path.exists(HISTORY_FILE): pd.DataFrame([new_data]).to_csv(HISTORY_FILE, index=False, encoding='utf-8-sig')
-    else: pd.DataFrame([new_data]).to_csv(HISTORY_FILE, mode='a', header=False, index=False, encoding='utf-8-sig')
+@st.cache_data
+def ledger_summary(version, since, gpu_hour_cost):
+    # 以台账最大行号为缓存键：没有新记录时 rerun 不会重新统计
+    ledger = get_run_ledger()
+    return ledger.summary(since=since, gpu_hour_cost=gpu_hour_cost), ledger.batches(), ledger.recent()
+
+@st.cache_data
+def span_breakdown(path, mtime):
+    # 以文件修改时间为缓存键：worker 每次心跳重写一次
+    with open(path, "r", encoding="utf-8") as f:
+        return telemetry.parse_prometheus(f.read())
 
 # === 核心逻辑函数：生成单张图 ===
-def generate_image(prompt, neg_prompt, width, height, ckpt, lora, lora_str, cn, cn_img, upscale, upscale_model, seed, filename_prefix):
-    agent = ComfyAgent()
-    if not agent.is_server_ready(): return False, "ComfyUI 未启动"
+def build_workflow(prompt, neg_prompt, width, height, ckpt, lora, lora_str, cn, cn_img, upscale, upscale_model, seed, filename_prefix):
+    """组装一个任务的工作流，返回 (workflow, 实际使用的种子)"""
+    # 模板只解析一次，每个任务只复制被修改的节点
+    template = load_template(TEMPLATE_PATH, WORKFLOW_BINDINGS)
+    valid_loras = get_model_catalog().list("loras")
+    return workflow_builder.build_workflow(template, prompt, neg_prompt, width, height, ckpt, lora, lora_str, cn, cn_img,
+                                           upscale, upscale_model, seed, filename_prefix,
+                                           dummy_lora=valid_loras[0] if valid_loras else None)
+
+def generate_image(prompt, neg_prompt, width, height, ckpt, lora, lora_str, cn, cn_img, upscale, upscale_model, seed, filename_prefix, agent=None):
+    # 复用调用方的 agent，保证任务事件推送到同一个 clientId 的事件流
+    agent = agent or ComfyAgent()
+    if not agent.is_server_ready(): return False, "ComfyUI 未启动", 0
     
     try:
-        mod = WorkflowModifier(TEMPLATE_PATH)
-        # 1. 基础设置
-        mod.update_prompt(NODE_ID_PROMPT, prompt)
-        if NODE_ID_NEGATIVE: mod.update_prompt(NODE_ID_NEGATIVE, neg_prompt)
-        if NODE_ID_CHECKPOINT: mod.workflow_data[NODE_ID_CHECKPOINT]["inputs"]["ckpt_name"] = ckpt
-        if NODE_ID_EMPTY_LATENT: 
-            mod.workflow_data[NODE_ID_EMPTY_LATENT]["inputs"]["width"] = width
-            mod.workflow_data[NODE_ID_EMPTY_LATENT]["inputs"]["height"] = height
-        
-        # 2. 文件名前缀 (Tier 7 核心)
-        if NODE_ID_SAVE_IMAGE:
-            mod.workflow_data[NODE_ID_SAVE_IMAGE]["inputs"]["filename_prefix"] = filename_prefix
-
-        # 3. LoRA
-        if NODE_ID_LORA:
-            valid_loras = [f for f in get_files(COMFY_LORAS_DIR, (".safetensors", ".ckpt"))]
-            dummy = valid_loras[0] if valid_loras else "blindbox_v1_mix.safetensors"
-            mod.workflow_data[NODE_ID_LORA]["inputs"]["lora_name"] = lora if lora != "None" else dummy
-            strength = lora_str if lora != "None" else 0
-            mod.workflow_data[NODE_ID_LORA]["inputs"]["strength_model"] = strength
-            mod.workflow_data[NODE_ID_LORA]["inputs"]["strength_clip"] = strength
-
-        # 4. ControlNet
-        if NODE_ID_CN_LOADER and cn != "None":
-            mod.workflow_data[NODE_ID_CN_LOADER]["inputs"]["control_net_name"] = cn
-            if NODE_ID_CN_IMAGE and cn_img:
-                mod.workflow_data[NODE_ID_CN_IMAGE]["inputs"]["image"] = cn_img
-        elif NODE_ID_CN_LOADER:
-             if "inputs" in mod.workflow_data.get("12", {}): mod.workflow_data["12"]["inputs"]["strength"] = 0
-
-        # 5. Upscale
-        # 5. Upscale 动态路由 (核心修复)
-        # 如果启用放大：SaveImage -> Node 19 (高清解码)
-        # 如果关闭放大：SaveImage -> Node 8 (基础解码)
-        if upscale and upscale_model:
-            mod.workflow_data[NODE_ID_UPSCALE_LOADER]["inputs"]["model_name"] = upscale_model
-            mod.workflow_data[NODE_ID_SAVE_IMAGE]["inputs"]["images"] = ["19", 0]
-            # 确保第二遍采样器的降噪不为0
-            if NODE_ID_KSAMPLER_2 in mod.workflow_data:
-                mod.workflow_data[NODE_ID_KSAMPLER_2]["inputs"]["denoise"] = 0.5
-        else:
-            # 关键：当不放大时，必须跳过高清流程，直接连到基础解码
-            mod.workflow_data[NODE_ID_SAVE_IMAGE]["inputs"]["images"] = ["8", 0]
-            # 可选优化：关闭放大时，让第二遍采样器跑 0 步以节省资源（或直接不管它，因为输出已重定向）
-            if NODE_ID_KSAMPLER_2 in mod.workflow_data:
-                mod.workflow_data[NODE_ID_KSAMPLER_2]["inputs"]["steps"] = 0
-        
-        # 6. 种子 (处理所有采样器)
-        final_seed = seed if seed != -1 else random.randint(1, 10**14)
-        if NODE_ID_KSAMPLER: mod.workflow_data[NODE_ID_KSAMPLER]["inputs"]["seed"] = final_seed
-        if NODE_ID_KSAMPLER_2: mod.workflow_data[NODE_ID_KSAMPLER_2]["inputs"]["seed"] = final_seed
-
+        workflow, final_seed = build_workflow(prompt, neg_prompt, width, height, ckpt, lora, lora_str, cn, cn_img, upscale, upscale_model, seed, filename_prefix)
         # 发送任务
-        succ, msg = agent.send_job(mod.get_workflow())
+        succ, msg = agent.send_job(workflow)
         return succ, msg, final_seed
 
     except Exception as e: return False, str(e), 0
@@ -129,21 +142,23 @@ st.title("🏭 Siyua AIGC 智能数据工厂 (v2.3 批量完全体)")
 
 with st.sidebar:
     st.header("⚙️ 引擎室")
-    ckpt_list = get_files(COMFY_MODELS_DIR, (".safetensors", ".ckpt"))
+    catalog = get_model_catalog()
+    if st.button("🔄 刷新模型列表"): catalog.refresh()
+    ckpt_list = catalog.list("checkpoints")
     selected_ckpt = st.selectbox("🧠 核心模型", ckpt_list if ckpt_list else ["无模型"])
     
     st.markdown("---")
     enable_upscale = st.checkbox("启用 2x 放大 (Tier 6)", value=True)
-    upscale_list = get_files(COMFY_UPSCALE_DIR, (".pth", ".pt"))
+    upscale_list = catalog.list("upscale_models")
     selected_upscaler = st.selectbox("放大模型", upscale_list if upscale_list else ["无模型"]) if enable_upscale else None
 
     st.markdown("---")
-    lora_list = ["None"] + get_files(COMFY_LORAS_DIR, (".safetensors", ".ckpt"))
+    lora_list = ["None"] + catalog.list("loras")
     selected_lora = st.selectbox("选择 LoRA", lora_list)
     lora_strength = st.slider("LoRA 权重", 0.0, 2.0, 1.0, 0.1) if selected_lora != "None" else 0
     
     st.markdown("---")
-    cn_list = ["None"] + get_files(COMFY_CN_DIR, (".safetensors", ".ckpt"))
+    cn_list = ["None"] + catalog.list("controlnet")
     def format_cn_name(filename):
         if filename == "None": return "🚫 关闭 (None)"
         
@@ -171,7 +186,7 @@ with st.sidebar:
     ratio_name = st.selectbox("比例", list(RATIO_PRESETS.keys()))
     width, height = RATIO_PRESETS[ratio_name]
 
-tab1, tab2, tab3 = st.tabs(["🎮 单人控制台", "🚀 批量流水线", "📊 画廊"])
+tab1, tab2, tab3, tab4 = st.tabs(["🎮 单人控制台", "🚀 批量流水线", "📊 画廊", "📈 分析"])
 
 # === Tab 1: 单人控制台 (逻辑不变，调用封装函数) ===
 with tab1:
@@ -182,31 +197,69 @@ with tab1:
         neg_prompt = st.text_area("负向 Prompt", DEFAULT_NEGATIVE, height=80)
         style = st.selectbox("风格", list(STYLE_PRESETS.keys()))
         
-        cn_image_name = None
+        uploaded_cn_img = None
         if selected_cn != "None":
             uploaded_cn_img = st.file_uploader("📤 上传参考图", type=["png", "jpg"], key="tab1_upload")
             if uploaded_cn_img:
                 st.image(uploaded_cn_img, width=200)
-                cn_image_name = f"CN_{int(time.time())}_{uploaded_cn_img.name}"
-                with open(os.path.join(COMFY_INPUT_DIR, cn_image_name), "wb") as f: f.write(uploaded_cn_img.getbuffer())
 
         if st.button("✨ 启动单人任务", type="primary"):
             full_prompt = f"{prompt}, {STYLE_PRESETS[style]}"
-            succ, msg, seed = generate_image(full_prompt, neg_prompt, width, height, selected_ckpt, selected_lora, lora_strength, selected_cn, cn_image_name, enable_upscale, selected_upscaler, -1, "Single_Task")
+            agent = ComfyAgent()
+            cn_image_name = None
+            if uploaded_cn_img:
+                # 按内容哈希命名并通过 /upload/image 上传，同一张图重复提交不会再次上传
+                try:
+                    cn_image_name = get_reference_images((agent.base_url,)).add(uploaded_cn_img.getvalue(), (width, height))
+                except Exception as e:
+                    st.error(str(e)); st.stop()
+            events = agent.open_event_stream()
+            submitted_at = time.time()
+            succ, msg, seed = generate_image(full_prompt, neg_prompt, width, height, selected_ckpt, selected_lora, lora_strength, selected_cn, cn_image_name, enable_upscale, selected_upscaler, -1, "Single_Task", agent=agent)
             
             if succ:
                 progress_text = st.empty()
                 bar = st.progress(0)
-                manager = AssetManager(COMFY_OUTPUT_DIR, PROJECT_OUTPUT_DIR)
+                manager = AssetManager(COMFY_OUTPUT_DIR, PROJECT_OUTPUT_DIR, local_backends=COMFY_LOCAL_BACKENDS)
                 max_wait = 300 
-                for i in range(max_wait):
-                    progress_text.text(f"AI 绘图中... {i}s")
-                    moved = manager.sync_latest_images()
-                    if moved > 0: bar.progress(100); break
-                    time.sleep(1)
-                    bar.progress(min(int((i/max_wait)*90), 90))
+                moved = 0
+                if events:
+                    # 事件驱动：任务结束立即返回，每秒只刷新一次进度条
+                    status = None
+                    for i in range(max_wait):
+                        status = events.wait(msg, timeout=1)
+                        if status is not None or not events.connected: break
+                        value, total = events.get_progress(msg)
+                        progress_text.text(f"AI 绘图中... {i}s (采样 {value}/{total})")
+                        bar.progress(min(int((i/max_wait)*90), 90))
+                    events.close()
+                    started_at, executed_at = events.get_timing(msg)
+                    archived = []
+                    transfer_start = time.time()
+                    if status == "success": archived = manager.archive_job(agent, msg, "Single_Task"); moved = len(archived)
+                    elif status == "failed": st.error(events.get_error(msg))
+                    get_run_ledger().record(
+                        style=style, job="Single_Task", prompt=full_prompt, seed=seed, status=status or "timeout",
+                        backend=agent.base_url, prompt_id=msg,
+                        queue_wait=started_at - submitted_at if started_at else None,
+                        gpu_time=executed_at - started_at if started_at and executed_at else None,
+                        transfer_time=time.time() - transfer_start if archived else None,
+                        total_time=(executed_at or time.time()) - submitted_at, images=len(archived),
+                        filename=os.path.basename(archived[0]) if archived else None)
+                    get_run_ledger().flush()
+                else:
+                    for i in range(max_wait):
+                        progress_text.text(f"AI 绘图中... {i}s")
+                        moved = manager.sync_latest_images()
+                        if moved > 0: break
+                        time.sleep(1)
+                        bar.progress(min(int((i/max_wait)*90), 90))
+                    get_run_ledger().record(style=style, job="Single_Task", prompt=full_prompt, seed=seed, status="success" if moved else "timeout",
+                                            backend=agent.base_url, prompt_id=msg, total_time=time.time() - submitted_at, images=moved)
+                    get_run_ledger().flush()
                 
                 if moved: 
+                    bar.progress(100)
                     st.balloons(); st.rerun()
                 else: st.warning("等待超时")
             else: st.error(msg)
@@ -215,113 +268,236 @@ with tab1:
 with tab2:
     st.subheader("🏭 批量生产车间")
     
-    # 1. 任务预览
+    # 1. 任务预览 (流式读取，只展示前 200 行)
     if os.path.exists(JOBS_FILE):
-        
-        df_jobs = pd.read_csv(JOBS_FILE, quotechar='"', skipinitialspace=True)
-        # 强制 seed 列为整数，NaN 转为 -1
-        df_jobs['seed'] = pd.to_numeric(df_jobs['seed'], errors='coerce').fillna(-1).astype(int)
-        st.dataframe(df_jobs, use_container_width=True)
-        st.info(f"📋 检测到 {len(df_jobs)} 个待办任务")
+        job_source = JobSource(JOBS_FILE)
+        total_rows = count_jobs(JOBS_FILE, tuple(job_source.fingerprint()))
+        # st.dataframe 会导入 pandas (约 0.5s)，预览按需展开，冷启动与普通 rerun 不再付出这笔开销
+        if st.toggle("📋 预览任务表", value=False):
+            st.dataframe([dict(job) for job in job_source.preview(JOB_PREVIEW_ROWS)], use_container_width=True)
+        st.info(f"📋 检测到 {total_rows} 个任务" + (f" (预览前 {JOB_PREVIEW_ROWS} 行)" if total_rows > JOB_PREVIEW_ROWS else ""))
     else:
         st.error("❌ 未找到 jobs.csv，请在项目根目录创建")
         st.stop()
 
     # 2. ControlNet 统一设置 (批量模式下通常用同一张骨架图，或者不开启)
+    #    jobs.csv 中的 cn_image 列可为每行指定参考图 (相对 jobs.csv 所在目录或绝对路径)，留空的行使用这里上传的图
     cn_batch_img = None
     if selected_cn != "None":
-        st.warning(f"⚠️ 批量模式已启用 ControlNet: {format_cn_name(selected_cn)}。所有任务将使用同一张参考图。")
+        st.warning(f"⚠️ 批量模式已启用 ControlNet: {format_cn_name(selected_cn)}。未填写 cn_image 列的任务将使用同一张参考图。")
         uploaded_cn_img_batch = st.file_uploader("📤 上传批量参考图", type=["png", "jpg"], key="tab2_upload")
         if uploaded_cn_img_batch:
             st.image(uploaded_cn_img_batch, width=150)
-            cn_batch_img = f"CN_Batch_{int(time.time())}_{uploaded_cn_img_batch.name}"
-            with open(os.path.join(COMFY_INPUT_DIR, cn_batch_img), "wb") as f: f.write(uploaded_cn_img_batch.getbuffer())
+            cn_batch_img = uploaded_cn_img_batch.getvalue()
     
-    # 3. 启动按钮
+    # 3. 登记到持久化队列，由后台 worker (python worker.py) 执行：关闭页面或 rerun 不会中断批次
+    #    实例地址与队列深度在 worker.py 中配置；多个批次 / 多个用户共用同一个 worker，批次之间轮流执行
+    job_queue = get_job_queue()
+    owner = st.text_input("👤 提交人 (可选)", value="")
+    resume_run = st.checkbox("♻️ 断点续跑 (跳过进度日志中已完成的行)", value=True)
+    draft_mode = st.checkbox("🧪 草图模式 (先只跑第一遍出草图，挑选后再精修放大)", value=False, disabled=not enable_upscale,
+                             help="草图 SaveImage 接第一遍解码 (节点 8)，不跑放大与第二遍采样；选中的草图以相同种子只跑精修，构图不变。")
+    auto_refine = {}
+    if draft_mode:
+        d1, d2 = st.columns([1, 1])
+        with d1: refine_scorer = st.selectbox("评分钩子", list(draft_scoring.SCORERS))
+        with d2: refine_top = st.number_input("自动精修得分最高的前 N 张 (0 = 手动挑选)", min_value=0, value=0, step=1)
+        auto_refine = {"scorer": refine_scorer, "top": int(refine_top)}
+    latent_batch = st.checkbox("🎲 合并种子批次 (latent batch)", value=False,
+                               help="提示词与参数相同、种子为随机 (-1 或留空) 的相邻行合并为一次提交 (batch_size > 1)，出图更快。"
+                                    "每张图由 基础种子 + 批内序号 确定；填写了种子的行仍单独提交，按自己的种子出图。")
+    reject_duplicates = st.checkbox("🧬 拒收近重复图片", value=False,
+                                    help="输出与素材库中已有图片 (感知哈希距离 ≤ %d) 近重复时直接删除，该行记为重复、不再重跑。" % DUPLICATE_DISTANCE)
+
     if st.button("🚀 启动批量流水线", type="primary"):
-        batch_bar = st.progress(0)
-        status_text = st.empty()
-        manager = AssetManager(COMFY_OUTPUT_DIR, PROJECT_OUTPUT_DIR)
-        
-        total_jobs = len(df_jobs)
-        success_count = 0
-        
-        # 🛡️ 安全升级：使用 enumerate 生成独立的序号 i，无视 DataFrame 索引格式
-        for i, (index, row) in enumerate(df_jobs.iterrows()):
-            job_prompt = str(row['prompt'])
-            job_filename = str(row['filename'])
-            # 安全获取 seed，防止空值报错
-            try:
-                job_seed = int(row['seed'])
-            except:
-                job_seed = -1
-            
-            # 这里改成 i+1，绝对是整数，绝不会报错
-            status_text.text(f"正在处理: {job_filename} ({i+1}/{total_jobs})...")
-            
-            # 调用生成函数
-            succ, msg, used_seed = generate_image(
-                prompt=job_prompt,
-                neg_prompt=DEFAULT_NEGATIVE, 
-                width=width, height=height,
-                ckpt=selected_ckpt,
-                lora=selected_lora, lora_str=lora_strength,
-                cn=selected_cn, cn_img=cn_batch_img,
-                upscale=enable_upscale, upscale_model=selected_upscaler,
-                seed=job_seed,
-                filename_prefix=job_filename
-            )
-            
-            # 更新进度条
-            batch_bar.progress(int((i + 1) / total_jobs * 100))
-            
-            
-            
-            if succ:
-                # 等待单张图完成
-                wait_success = False
-                for i in range(300): # 每张图最多等 300秒
-                    moved = manager.sync_latest_images()
-                    if moved > 0: wait_success = True; break
-                    time.sleep(1)
-                
-                if wait_success:
-                    success_count += 1
-                    log_job(job_prompt, "Batch", used_seed, "Success", 0, job_filename)
-                else:
-                    st.error(f"任务 {job_filename} 超时")
-            else:
-                st.error(f"任务 {job_filename} 失败: {msg}")
-            
-            # 更新总进度条
-            batch_bar.progress(int((index + 1) / total_jobs * 100))
-        
-        st.success(f"🎉 批量任务结束！成功: {success_count}/{total_jobs}")
-        st.balloons()
-        time.sleep(2)
-        st.rerun()
+        valid_loras = catalog.list("loras")
+        batch_id = job_queue.enqueue({
+            "jobs_file": JOBS_FILE, "journal": DRAFT_JOURNAL_FILE if draft_mode else JOURNAL_FILE, "refine_journal": JOURNAL_FILE,
+            "resume": resume_run, "style": "Draft" if draft_mode else "Batch", "latent_batch": latent_batch,
+            "reject_duplicates": reject_duplicates,
+            "mode": "draft" if draft_mode else "full", "auto_refine": auto_refine,
+            "negative": DEFAULT_NEGATIVE, "cn": selected_cn, "dummy_lora": valid_loras[0] if valid_loras else None,
+            # 每行可用 ckpt / lora / lora_strength / width / height / upscale / upscale_model 列覆盖这些默认值
+            "defaults": {"ckpt": selected_ckpt, "lora": selected_lora, "lora_strength": lora_strength,
+                         "width": width, "height": height, "upscale": enable_upscale, "upscale_model": selected_upscaler},
+        }, source=JOBS_FILE, reference=cn_batch_img, owner=owner.strip() or None)
+        st.success(f"📥 批次 {batch_id} 已加入队列")
+
+    # 4. 队列状态 (每 2 秒局部刷新，不重跑整个页面)
+    @st.fragment(run_every=2)
+    def queue_status():
+        workers = job_queue.workers(max_age=WORKER_STALE_SECONDS)
+        if workers:
+            for w in workers:
+                info = w["info"]
+                st.caption(f"🛠️ worker {w['id']} 在线 · 实例 {info.get('backends', '?')} · 队列深度 {info.get('max_in_flight', '?')} · "
+                           f"成功 {info.get('success', 0)} / 失败 {info.get('failed', 0)} / 缓存 {info.get('cached', 0)}")
+        else:
+            st.warning("⚠️ 后台 worker 未运行：请在项目根目录执行 python worker.py，已登记的批次会在 worker 启动后执行")
+
+        for batch in job_queue.batches(limit=QUEUE_STATUS_BATCHES):
+            counts = batch["counts"]
+            total = batch["total"]
+            done = sum(n for state, n in counts.items() if state not in ("pending", "running"))
+            label = f"**{batch['id']}**" + (f" · {batch['owner']}" if batch["owner"] else "") + f" · {BATCH_STATUS_LABELS.get(batch['status'], batch['status'])}"
+            if batch["mode"] in BATCH_MODE_LABELS: label += f" · {BATCH_MODE_LABELS[batch['mode']]}"
+            with st.container(border=True):
+                c1, c2 = st.columns([5, 1])
+                c1.markdown(label)
+                if batch["status"] in ("queued", "running") and c2.button("⏹️ 取消", key=f"cancel_{batch['id']}"):
+                    job_queue.cancel(batch["id"])
+                    st.rerun(scope="fragment")
+                if total:
+                    st.progress(min(done / total, 1.0), text=f"{done}/{total} · 成功 {counts.get('success', 0)} · "
+                                f"缓存 {counts.get('cached', 0)} · 失败 {counts.get('failed', 0) + counts.get('timeout', 0)} · "
+                                + (f"重复 {counts['duplicate']} · " if counts.get('duplicate') else "") + f"执行中 {counts.get('running', 0)}")
+                if batch["message"]: st.caption(batch["message"])
+                if batch["mode"] == "draft" and batch["status"] == "done":
+                    with st.expander("🎯 挑选要精修的草图"):
+                        pick_drafts(batch["id"])
 
-# === Tab 3 修复版 ===
+    def pick_drafts(batch_id):
+        drafts = job_queue.drafts(batch_id)
+        if st.button("📊 按清晰度评分", key=f"score_{batch_id}"):
+            draft_scoring.score_drafts(job_queue, batch_id, PROJECT_OUTPUT_DIR)
+            drafts = job_queue.drafts(batch_id)
+        # 已评分时高分在前；只展示前 DRAFT_PICK_LIMIT 张
+        drafts = [d for d in sorted(drafts, key=lambda d: -(d["score"] or 0)) if d["outputs"]][:DRAFT_PICK_LIMIT]
+        paths = [os.path.join(PROJECT_OUTPUT_DIR, d["outputs"][0]) for d in drafts]
+        previews = get_thumbnail_cache().ensure(paths, timeout=5)
+        cols = st.columns(4)
+        selected = []
+        for i, (d, path) in enumerate(zip(drafts, paths)):
+            with cols[i % 4]:
+                if previews.get(path): st.image(previews[path], use_container_width=True)
+                caption = d["outputs"][0] + (f" · {d['score']:.0f}" if d["score"] is not None else "")
+                if st.checkbox(caption, key=f"pick_{d['id']}"): selected.append(d["id"])
+        if st.button(f"✨ 精修选中的 {len(selected)} 张", key=f"refine_{batch_id}", disabled=not selected):
+            refine_id = job_queue.enqueue_refine(batch_id, selected, owner=owner.strip() or None)
+            st.success(f"📥 精修批次 {refine_id} 已加入队列")
+
+    queue_status()
+
+# === Tab 3: 画廊 (缩略图缓存 + 分页懒加载) ===
 with tab3:
     st.subheader("🖼️ 资产监控")
-    limit_num = st.number_input("数量", 8, step=4)
-    if st.button("🔄 刷新"): st.rerun()
+    thumbs = get_thumbnail_cache()
+    g1, g2 = st.columns([1, 1])
+    with g1: page_size = st.number_input("每页数量", 4, 64, 8, step=4)
+    if st.button("🔄 刷新"):
+        thumbs.invalidate(PROJECT_OUTPUT_DIR)
+        st.rerun()
     
-    if os.path.exists(PROJECT_OUTPUT_DIR):
-        imgs = sorted(
-            [f for f in os.listdir(PROJECT_OUTPUT_DIR) if f.endswith('.png')], 
-            key=lambda x: os.path.getmtime(os.path.join(PROJECT_OUTPUT_DIR, x)), 
-            reverse=True
-        )
-        
+    imgs = thumbs.list_images(PROJECT_OUTPUT_DIR)
+    collapse = st.toggle("🧬 合并相似图片", value=False, help="感知哈希近重复的图片只显示最新的一张，其余计入 “+N 张相似”")
+    similar = {}
+    if imgs and collapse:
+        asset_index = get_asset_index()
+        max_distance = st.slider("相似阈值 (哈希距离)", 0, 12, DUPLICATE_DISTANCE, help="越小越严格；0 只合并几乎完全相同的图")
+        with st.spinner("🧬 计算新图片的感知哈希..."):
+            asset_index.sync(imgs)
+        imgs, similar = duplicate_clusters(asset_index.version(), max_distance, imgs)
+        st.caption(f"{len(imgs)} 组 · {sum(len(v) for v in similar.values())} 张相似图片已合并")
+    if imgs:
+        total_pages = max(1, (len(imgs) + page_size - 1) // page_size)
+        with g2: page = st.number_input(f"页码 (共 {total_pages} 页 / {len(imgs)} 张)", 1, total_pages, 1)
+        page_imgs = imgs[(page - 1) * page_size: page * page_size]
+        page_paths = [os.path.join(PROJECT_OUTPUT_DIR, img) for img in page_imgs]
+
+        # 当前页缩略图最多等待 10 秒；下一页在后台预生成
+        previews = thumbs.ensure(page_paths, timeout=10)
+        thumbs.prefetch(os.path.join(PROJECT_OUTPUT_DIR, img) for img in imgs[page * page_size: (page + 1) * page_size])
+
         cols = st.columns(4)
-        for i, img in enumerate(imgs[:limit_num]):
+        for i, (img, img_path) in enumerate(zip(page_imgs, page_paths)):
             with cols[i % 4]:
-                img_path = os.path.join(PROJECT_OUTPUT_DIR, img)
-                try:
-                    # 增加防御：尝试打开图片，如果失败则跳过
-                    with Image.open(img_path) as verified_img:
-                        st.image(verified_img, caption=img, use_container_width=True)
-                except Exception:
-                    # 如果文件正在被占用或损坏，显示占位符或直接跳过
-                    st.warning(f"⏳ 加载中: {img[:10]}...")
\ No newline at end of file
+                caption = img + (f" (+{len(similar[img])} 张相似)" if img in similar else "")
+                if previews.get(img_path):
+                    st.image(previews[img_path], caption=caption, use_container_width=True)
+                else:
+                    # 如果文件正在被占用或损坏，显示占位符
+                    st.warning(f"⏳ 加载中: {img[:10]}...")
+
+        # 原图只在选中时加载
+        full_img = st.selectbox("🔍 查看原图", ["—"] + page_imgs)
+        if full_img != "—":
+            st.image(os.path.join(PROJECT_OUTPUT_DIR, full_img), caption=full_img, use_container_width=True)
+            if similar.get(full_img):
+                with st.expander(f"🧬 同组的 {len(similar[full_img])} 张相似图片"):
+                    st.write(similar[full_img])
+
+    # 以图查重：上传一张图，在素材库中查找近重复
+    probe = st.file_uploader("🔎 以图查重", type=["png", "jpg", "jpeg", "webp"], key="dedup_probe")
+    if probe:
+        asset_index = get_asset_index()
+        with st.spinner("🧬 计算新图片的感知哈希..."):
+            asset_index.sync(thumbs.list_images(PROJECT_OUTPUT_DIR))
+        matches = asset_index.search(probe, DUPLICATE_DISTANCE)
+        if matches:
+            match_paths = [os.path.join(PROJECT_OUTPUT_DIR, name) for name, _ in matches]
+            match_previews = thumbs.ensure(match_paths, timeout=10)
+            cols = st.columns(4)
+            for i, ((name, distance), path) in enumerate(zip(matches, match_paths)):
+                with cols[i % 4]:
+                    if match_previews.get(path):
+                        st.image(match_previews[path], caption=f"{name} · 距离 {distance}", use_container_width=True)
+        else:
+            st.info("素材库中没有近重复的图片")
+
+# === Tab 4: 分析 (运行台账 -> 吞吐 / 延迟分位 / 成本) ===
+with tab4:
+    st.subheader("📈 产能与成本")
+    ledger = get_run_ledger()
+    a1, a2 = st.columns([1, 1])
+    with a1: window = st.selectbox("统计范围", ["全部", "最近 24 小时", "最近 7 天"])
+    with a2: gpu_hour_cost = st.number_input("GPU 每小时成本 (元)", min_value=0.0, value=2.0, step=0.5)
+    since = {"全部": None, "最近 24 小时": 86400, "最近 7 天": 7 * 86400}[window]
+    # 按小时取整，让缓存键在一小时内保持不变
+    since = int(time.time() // 3600 * 3600 - since) if since else None
+    summary, batches, recent = ledger_summary(ledger.version(), since, gpu_hour_cost)
+
+    def fmt_sec(value): return f"{value:.2f}s" if value is not None else "—"
+
+    if summary["total"]:
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("任务数", summary["total"], f"失败 {summary['failed']} / 缓存 {summary['cached']}", delta_color="off")
+        m2.metric("吞吐 (张/小时)", f"{summary['images_per_hour']:.0f}" if summary["images_per_hour"] else "—")
+        m3.metric("端到端 p50 / p95", f"{fmt_sec(summary['p50_total'])} / {fmt_sec(summary['p95_total'])}")
+        m4.metric("单张成本", f"¥{summary['cost_per_image']:.4f}" if summary["cost_per_image"] is not None else "—")
+        m5, m6, m7, m8 = st.columns(4)
+        m5.metric("GPU p50 / p95", f"{fmt_sec(summary['p50_gpu'])} / {fmt_sec(summary['p95_gpu'])}")
+        m6.metric("排队等待 p50", fmt_sec(summary["p50_queue"]))
+        m7.metric("平均传输", fmt_sec(summary["avg_transfer"]))
+        m8.metric("平均归档", fmt_sec(summary["avg_archive"]))
+
+        show_details = st.toggle("显示批次与明细表", value=False)
+        if batches and show_details:
+            st.markdown("**最近批次**")
+            st.dataframe([{"批次": b, "开始时间": datetime.fromtimestamp(ts), "任务数": n, "成功": ok, "耗时(s)": round(span, 1),
+                           "张/小时": round(rate) if rate else None} for b, ts, n, ok, span, rate in batches], use_container_width=True)
+        if show_details:
+            st.markdown("**最近记录**")
+            st.dataframe([dict(row, ts=datetime.fromtimestamp(row["ts"])) for row in recent], use_container_width=True)
+    else:
+        st.info("暂无运行记录，完成一次生成后这里会显示统计")
+
+    st.subheader("🔬 流水线耗时分解")
+    prom_files = sorted((f for f in os.listdir(TELEMETRY_DIR) if f.endswith(".prom")),
+                        key=lambda f: os.path.getmtime(os.path.join(TELEMETRY_DIR, f)), reverse=True) if os.path.isdir(TELEMETRY_DIR) else []
+    if prom_files:
+        prom_file = st.selectbox("worker", prom_files, format_func=lambda f: f[len("metrics-"):-len(".prom")])
+        prom_path = os.path.join(TELEMETRY_DIR, prom_file)
+        spans = span_breakdown(prom_path, os.path.getmtime(prom_path))
+        # span 可以嵌套 (worker.prepare 包含 workflow.render / compile)，comfy.* 为 ComfyUI 侧时段，各行耗时不能相加
+        st.dataframe([{"阶段": name, "次数": s["count"], "总耗时(s)": round(s["sum"], 2),
+                       "平均(ms)": round(s["sum"] / s["count"] * 1000, 2) if s["count"] else None, "出错": s["errors"]}
+                      for name, s in sorted(spans.items(), key=lambda item: -item[1]["sum"])], use_container_width=True)
+        traces = sorted((f for f in os.listdir(TELEMETRY_DIR) if f.startswith("trace-") and f.endswith(".json")),
+                        key=lambda f: os.path.getmtime(os.path.join(TELEMETRY_DIR, f)), reverse=True)
+        if traces:
+            trace_file = st.selectbox("批次追踪 (在 chrome://tracing 或 ui.perfetto.dev 中打开)", traces)
+            with open(os.path.join(TELEMETRY_DIR, trace_file), "rb") as f:
+                st.download_button("⬇️ 下载 Chrome trace", f.read(), file_name=trace_file, mime="application/json")
+    else:
+        st.info("暂无遥测数据：以 python worker.py --telemetry 启动 worker 后，这里会显示各阶段耗时")
+
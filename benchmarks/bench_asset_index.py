@@ -0,0 +1,90 @@
+"""
+AssetIndex 近重复检索基准测试：查询 / 聚类耗时 vs 素材库规模。
+
+素材库为随机 64 位哈希，其中 DUP_RATIO 的图片是另一张图翻转 1~3 位得到的近重复：
+    - loop   : 逐个 Python 整数比较汉明距离 (不建数组的朴素实现)，一次查询
+    - find   : AssetIndex.find，uint64 数组异或 + popcount 向量化，一次查询
+    - cluster: AssetIndex.clusters，整库聚类 (画廊 “合并相似图片”)
+    - found  : 聚类找到的近重复张数 / 植入的张数
+
+运行: python -m benchmarks.bench_asset_index [--sizes 10000 100000 300000]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.asset_index import AssetIndex, DUPLICATE_DISTANCE
+
+DUP_RATIO = 0.1
+
+
+def timed(func, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def library(size, rng):
+    """随机哈希 + 植入的近重复：返回 ([(文件名, 哈希)], 植入的近重复张数)"""
+    hashes = rng.integers(0, 1 << 63, size, dtype=np.int64).view(np.uint64) << np.uint64(1)
+    dups = int(size * DUP_RATIO)
+    sources = rng.integers(0, size - dups, dups)
+    for i, source in enumerate(sources):
+        value = hashes[source]
+        for bit in rng.choice(64, rng.integers(1, 4), replace=False):
+            value ^= np.uint64(1) << np.uint64(bit)
+        hashes[size - dups + i] = value
+    return [(f"asset_{i:07d}.png", int(value)) for i, value in enumerate(hashes)], dups
+
+
+def run(size, rng):
+    root = tempfile.mkdtemp(prefix="bench_index_")
+    try:
+        items, dups = library(size, rng)
+        index = AssetIndex(os.path.join(root, "assets.sqlite"), root)
+        index.add(items)
+        names = [name for name, _ in items]
+        probe = items[-1][1]
+
+        def loop():
+            return [name for name, value in items if bin(value ^ probe).count("1") <= DUPLICATE_DISTANCE]
+
+        loop_ms = timed(loop, repeat=1)
+        find_ms = timed(lambda: index.find(probe))
+        start = time.perf_counter()
+        _, members = index.clusters(names)
+        cluster_ms = (time.perf_counter() - start) * 1000
+        index.close()
+        return {"assets": size, "loop_ms": loop_ms, "find_ms": find_ms, "cluster_ms": cluster_ms,
+                "found": sum(len(m) for m in members.values()), "planted": dups}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 300000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    rows = [run(size, rng) for size in args.sizes]
+
+    print(f"{'assets':>8} {'loop(ms)':>9} {'find(ms)':>9} {'cluster(ms)':>12} {'found/planted':>14}")
+    for row in rows:
+        print(f"{row['assets']:>8} {row['loop_ms']:>9.2f} {row['find_ms']:>9.3f} {row['cluster_ms']:>12.1f} "
+              f"{row['found']:>7}/{row['planted']}")
+
+
+if __name__ == "__main__":
+    main()
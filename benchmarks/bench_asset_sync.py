@@ -0,0 +1,96 @@
+"""
+AssetManager.sync_latest_images 基准测试：同步耗时 vs 输出目录规模。
+
+对比旧实现 (os.listdir + 每个文件一次 getmtime) 与增量扫描索引：
+    - legacy : 旧实现，每次同步都 stat 全部文件
+    - cold   : 索引首次扫描 (每个文件 stat 一次)
+    - idle   : 索引建立后，没有新文件时的一次同步
+    - new    : 索引建立后，新增 NEW_FILES 张图片时的一次同步
+
+运行: python -m benchmarks.bench_asset_sync [--sizes 1000 10000 50000]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import file_manager
+from src.file_manager import AssetManager
+
+NEW_FILES = 10
+
+
+def legacy_scan(source_dir):
+    """旧版 sync_latest_images 的扫描部分 (不含搬运)"""
+    image_files = [f for f in os.listdir(source_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
+    return [f for f in image_files if time.time() - os.path.getmtime(os.path.join(source_dir, f)) < 60]
+
+
+def populate(source_dir, count):
+    old = time.time() - 3600
+    for i in range(count):
+        path = os.path.join(source_dir, f"ComfyUI_{i:06d}_.png")
+        with open(path, "wb"):
+            pass
+        os.utime(path, (old, old))
+    # 让目录 mtime 早于时间戳精度窗口，模拟长期堆积的目录
+    os.utime(source_dir, (old, old))
+
+
+def timed(func, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run(size):
+    root = tempfile.mkdtemp(prefix="bench_sync_")
+    source_dir = os.path.join(root, "comfy_output")
+    target_dir = os.path.join(root, "project_output")
+    os.makedirs(source_dir)
+    try:
+        populate(source_dir, size)
+        file_manager._scan_indexes.clear()
+        manager = AssetManager(source_dir, target_dir)
+
+        legacy_ms = timed(lambda: legacy_scan(source_dir))
+        cold_ms = timed(manager.sync_latest_images, repeat=1)
+        idle_ms = timed(manager.sync_latest_images)
+
+        def add_and_sync():
+            for i in range(NEW_FILES):
+                with open(os.path.join(source_dir, f"New_{time.time_ns()}_{i}.png"), "wb"):
+                    pass
+            manager.sync_latest_images()
+
+        new_ms = timed(add_and_sync)
+        return {"files": size, "legacy_ms": legacy_ms, "cold_ms": cold_ms, "idle_ms": idle_ms, "new_ms": new_ms}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000, 50000])
+    args = parser.parse_args()
+
+    # 搬运时的日志会淹没结果表
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = [run(size) for size in args.sizes]
+
+    print(f"{'files':>8} {'legacy(ms)':>11} {'cold(ms)':>9} {'idle(ms)':>9} {'+' + str(NEW_FILES) + ' new(ms)':>12}")
+    for row in rows:
+        print(f"{row['files']:>8} {row['legacy_ms']:>11.2f} {row['cold_ms']:>9.2f} {row['idle_ms']:>9.2f} {row['new_ms']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+批量流水线端到端基准测试 (离线，基于 src.fake_comfy 模拟服务)。
+
+按 jobs.csv 的格式生成 N 行任务，走与 main.py 相同的路径：
+JobSource -> JobJournal -> BatchPlanner -> WorkflowTemplate.render -> MultiBackendDispatcher
+-> BatchRunner (事件驱动) -> AssetManager.archive_job，测量流水线自身的开销：
+    - submit_per_s : 提交吞吐 (send_job 次数 / 提交耗时之和)
+    - jobs_per_s   : 完成吞吐 (结束的任务数 / 总耗时)
+    - e2e_ms       : 单任务端到端延迟 (提交 -> 得知完成) 的 p50 / p95 / p99
+    - archive_ms   : 归档 (/history + /view 下载 + 写盘) 耗时，按归档时项目目录中的文件数分段
+                     (--local-archive 时本机实例的输出直接从磁盘搬运；--async-archive 时归档在后台线程中进行，
+                      与 worker.py 相同，这里统计的是主循环被阻塞的时间)
+    - images_per_min: 出图吞吐 (--seed-sweep K 让每个提示词连续出现 K 行、种子随机，
+                     --latent-batch N 把这样的相邻行合并为一次 batch_size <= N 的提交)
+    - rss_peak_mb  : 进程峰值常驻内存 (模拟服务运行在独立进程中，不计入)
+
+结果以 JSON 输出，便于在不同提交之间对比:
+    python -m benchmarks.bench_pipeline --rows 10 1000 10000 --json before.json
+    python -m benchmarks.bench_pipeline --rows 10 1000 10000 --json after.json
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.batch_planner import BatchPlanner, LatentBatcher
+from src.batch_runner import BatchRunner
+from src.data_processor import load_template
+from src.fake_comfy import FakeComfyServer
+from src.file_manager import AssetManager
+from src.job_ledger import JobSource, JobJournal
+from src.result_cache import workflow_key
+from src.workflow_builder import WORKFLOW_BINDINGS, build_workflow, with_batch_size
+from src.scheduler import MultiBackendDispatcher
+
+try:
+    import resource  # 仅 Unix
+except ImportError:
+    resource = None
+
+TEMPLATE_PATH = os.path.join(ROOT, "config", "workflow_api.json")
+MODEL_PARAMS = ("ckpt", "lora", "lora_strength", "width", "height", "upscale_model")
+CKPTS = [name for name in FakeComfyServer.DEFAULT_MODELS["CheckpointLoaderSimple"][1]]
+# 归档耗时按项目目录中已有文件数分段统计
+DIR_BUCKETS = (0, 100, 1000, 10000, 100000)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+
+def rss_peak_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_jobs(path, rows, sweep=1):
+    """
+    生成 jobs.csv 格式的任务表，checkpoint 交替出现以覆盖模型亲和排序；
+    sweep > 1 时每个提示词连续 sweep 行、种子为 -1 (随机)，与 worker 一样只有这样的行才能合并为潜空间批次
+    """
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["prompt", "filename", "seed", "ckpt"])
+        for i in range(rows):
+            group = i // sweep
+            writer.writerow([f"1girl, benchmark job {group}, masterpiece", f"Bench_{i:06d}", -1 if sweep > 1 else 1000 + i,
+                             CKPTS[group % len(CKPTS)]])
+
+
+@contextlib.contextmanager
+def fake_servers(count, args, work_dir):
+    """在独立进程中启动模拟服务，避免其开销与内存计入被测进程"""
+    procs, urls = [], []
+    try:
+        for i in range(count):
+            port = free_port()
+            cmd = [sys.executable, "-m", "src.fake_comfy", "--port", str(port),
+                   "--exec-time", str(args.exec_time), "--fail-rate", str(args.fail_rate),
+                   "--http-latency", str(args.http_latency), "--seed", str(i), "--batch-cost", str(args.batch_cost),
+                   "--output-dir", os.path.join(work_dir, f"comfy_output_{i}")]
+            proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            proc.stdout.readline()  # 等待启动完成
+            procs.append(proc)
+            urls.append(f"http://127.0.0.1:{port}")
+        yield urls
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+
+def run(rows, args):
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    try:
+        csv_path = os.path.join(work_dir, "jobs.csv")
+        target_dir = os.path.join(work_dir, "output")
+        write_jobs(csv_path, rows, args.seed_sweep)
+        os.makedirs(target_dir)
+        for i in range(args.prefill):
+            open(os.path.join(target_dir, f"Prefill_{i:06d}.png"), "wb").close()
+
+        with fake_servers(args.backends, args, work_dir) as urls:
+            dispatcher = MultiBackendDispatcher(urls)
+            template = load_template(TEMPLATE_PATH, WORKFLOW_BINDINGS)
+            planner = BatchPlanner(dict({name: template.default(name) for name in MODEL_PARAMS}, upscale=True))
+            runner = BatchRunner(dispatcher, max_in_flight=args.max_in_flight * len(urls), events=dispatcher, job_timeout=60)
+            if args.local_archive:
+                archiver = AssetManager(os.path.join(work_dir, "comfy_output_0"), target_dir, local_backends=urls[:1])
+            else:
+                archiver = AssetManager(os.path.join(work_dir, "unused"), target_dir)
+            batcher = LatentBatcher(args.latent_batch, max_pixels=args.latent_batch * 512 * 512)
+            source = JobSource(csv_path)
+            journal = JobJournal(os.path.join(work_dir, "jobs.progress.jsonl"))
+
+            submit_times, e2e, archive_by_bucket = [], [], {}
+            archiving = []  # --async-archive: (任务, Future)
+            dir_files = args.prefill
+            completed = failed = images = 0
+
+            def rendered(jobs):
+                for job in jobs:
+                    config = planner.resolve(job)
+                    workflow, _ = build_workflow(template, job["prompt"], template.default("negative"), config["width"], config["height"],
+                                                 config["ckpt"], config["lora"], config["lora_strength"], "None", None,
+                                                 config["upscale"], config["upscale_model"], int(job["seed"]), job["filename"])
+                    yield job, workflow
+
+            def submit(group):
+                # 整批使用第一行的工作流 (种子)，与 worker.py 相同
+                (job, workflow), size = group[0], len(group)
+                if size > 1:
+                    workflow = with_batch_size(workflow, size)
+                start = time.perf_counter()
+                succ, msg = dispatcher.send_job(workflow)
+                submit_times.append(time.perf_counter() - start)
+                if succ:
+                    for job, _ in group:
+                        journal.record_submitted(job, msg)
+                return succ, msg
+
+            def groups(jobs):
+                pairs = rendered(jobs)
+                if args.latent_batch <= 1:
+                    return ([pair] for pair in pairs)
+                # 填写了种子的行单独提交 (与 worker.py 相同)
+                return batcher.group(pairs, lambda pair: workflow_key(pair[1], ignore=("seed",)) if int(pair[0]["seed"]) == -1 else None,
+                                     lambda pair: batcher.capacity(512, 512))
+
+            start = time.perf_counter()
+            # 归档时的日志会淹没结果
+            with contextlib.redirect_stdout(io.StringIO()):
+                for result in runner.run(groups(planner.plan(source.iter_pending(journal))), submit):
+                    jobs = [job for job, _ in result.job]
+                    if result.succeeded:
+                        e2e.append(result.elapsed)
+                        archive_start = time.perf_counter()
+                        bucket = max(b for b in DIR_BUCKETS if b <= dir_files)
+                        names = [job["filename"] for job in jobs]
+                        if args.async_archive:
+                            archiving.append((result, archiver.archive_batch_async(dispatcher, result.prompt_id, names)))
+                            archive_by_bucket.setdefault(bucket, []).append(time.perf_counter() - archive_start)
+                            dir_files += len(jobs)
+                        else:
+                            archived_rows = archiver.archive_batch(dispatcher, result.prompt_id, names)
+                            archive_by_bucket.setdefault(bucket, []).append(time.perf_counter() - archive_start)
+                            for job, archived in zip(jobs, archived_rows):
+                                dir_files += len(archived)
+                                images += len(archived)
+                                journal.record_completed(job, result.prompt_id, [os.path.basename(p) for p in archived])
+                        completed += len(jobs)
+                    else:
+                        for job in jobs:
+                            journal.record_failed(job, result.message)
+                        failed += len(jobs)
+                for result, future in archiving:
+                    archived_rows, _ = future.result()
+                    for (job, _), archived in zip(result.job, archived_rows):
+                        images += len(archived)
+                        journal.record_completed(job, result.prompt_id, [os.path.basename(p) for p in archived])
+            wall = time.perf_counter() - start
+            journal.close()
+            dispatcher.close()
+
+        def ms(values, q):
+            value = percentile(values, q)
+            return round(value * 1000, 2) if value is not None else None
+
+        return {
+            "rows": rows,
+            "completed": completed,
+            "failed": failed,
+            "wall_s": round(wall, 3),
+            "submit_per_s": round(len(submit_times) / sum(submit_times), 1) if submit_times else None,
+            "jobs_per_s": round((completed + failed) / wall, 1) if wall else None,
+            "images_per_min": round(images / wall * 60, 1) if wall else None,
+            "submissions": len(submit_times),
+            "submit_ms": {"p50": ms(submit_times, 0.5), "p95": ms(submit_times, 0.95)},
+            "e2e_ms": {"p50": ms(e2e, 0.5), "p95": ms(e2e, 0.95), "p99": ms(e2e, 0.99)},
+            "archive_ms": {f">={bucket}": {"n": len(values), "p50": ms(values, 0.5), "p95": ms(values, 0.95)}
+                           for bucket, values in sorted(archive_by_bucket.items())},
+            "planner": dict(planner.stats),
+            "rss_peak_mb": rss_peak_mb(),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--backends", type=int, default=1, help="模拟 ComfyUI 实例数")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="每个实例的队列深度")
+    parser.add_argument("--exec-time", type=float, default=0.005, help="模拟每个任务的 GPU 耗时 (秒)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="任务失败概率")
+    parser.add_argument("--http-latency", type=float, default=0.0, help="每个 HTTP 请求的额外延迟 (秒)")
+    parser.add_argument("--local-archive", action="store_true", help="第一个实例的输出直接从磁盘搬运 (不经 /view 下载)")
+    parser.add_argument("--async-archive", action="store_true", help="归档在后台线程中进行 (worker.py 的方式)")
+    parser.add_argument("--seed-sweep", type=int, default=1, help="每个提示词连续出现的行数 (种子随机)")
+    parser.add_argument("--latent-batch", type=int, default=1, help="合并只差种子的相邻行，每次提交最多的张数 (1 表示不合并)")
+    parser.add_argument("--batch-cost", type=float, default=0.35, help="模拟服务中每多一张图增加的采样耗时比例")
+    parser.add_argument("--prefill", type=int, default=0, help="预先放入项目输出目录的文件数")
+    parser.add_argument("--json", help="结果写入该文件 (默认输出到标准输出)")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("rows", "json")},
+        "results": [run(rows, args) for rows in args.rows],
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        for r in report["results"]:
+            print(f"rows={r['rows']:>7}  {r['jobs_per_s']:>7} jobs/s  {r['images_per_min']} img/min  submit {r['submit_per_s']} /s  "
+                  f"e2e p50={r['e2e_ms']['p50']}ms p95={r['e2e_ms']['p95']}ms  rss={r['rss_peak_mb']}MB")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
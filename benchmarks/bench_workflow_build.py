@@ -0,0 +1,88 @@
+"""
+单个任务构建工作流的开销：WorkflowModifier (每个任务重新读取、解析模板) vs WorkflowTemplate.render，
+以及 worker / 命令行实际使用的 workflow_builder.build_workflow (渲染 + 编译)。
+
+运行: python -m benchmarks.bench_workflow_build [--jobs 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.data_processor import WorkflowModifier, WorkflowTemplate
+from src.workflow_builder import WORKFLOW_BINDINGS, build_workflow
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "workflow_api.json")
+
+
+def build_legacy(i):
+    """旧版 generate_image 中的工作流构建步骤"""
+    mod = WorkflowModifier(TEMPLATE_PATH)
+    mod.update_prompt("6", f"1girl, job {i}")
+    mod.update_prompt("7", "lowres, bad anatomy")
+    mod.workflow_data["4"]["inputs"]["ckpt_name"] = "anything-v5-PrtRE.safetensors"
+    mod.workflow_data["5"]["inputs"]["width"] = 512
+    mod.workflow_data["5"]["inputs"]["height"] = 680
+    mod.workflow_data["9"]["inputs"]["filename_prefix"] = f"Job_{i:05d}"
+    mod.workflow_data["10"]["inputs"]["lora_name"] = "blindbox_v1_mix.safetensors"
+    mod.workflow_data["10"]["inputs"]["strength_model"] = 0.8
+    mod.workflow_data["10"]["inputs"]["strength_clip"] = 0.8
+    mod.workflow_data["12"]["inputs"]["strength"] = 0
+    mod.workflow_data["15"]["inputs"]["model_name"] = "4x-UltraSharp.pth"
+    mod.workflow_data["9"]["inputs"]["images"] = ["19", 0]
+    mod.workflow_data["18"]["inputs"]["denoise"] = 0.5
+    mod.workflow_data["3"]["inputs"]["seed"] = 1000 + i
+    mod.workflow_data["18"]["inputs"]["seed"] = 1000 + i
+    return mod.get_workflow()
+
+
+def build_template(template, i):
+    return template.render(
+        prompt=f"1girl, job {i}", negative="lowres, bad anatomy",
+        ckpt="anything-v5-PrtRE.safetensors", width=512, height=680,
+        filename_prefix=f"Job_{i:05d}", lora="blindbox_v1_mix.safetensors", lora_strength=0.8,
+        cn_strength=0, upscale_model="4x-UltraSharp.pth", save_images=["19", 0], hires_denoise=0.5,
+        seed=1000 + i,
+    )
+
+
+def build_shared(template, i):
+    workflow, _ = build_workflow(template, f"1girl, job {i}", "lowres, bad anatomy", 512, 680, "anything-v5-PrtRE.safetensors",
+                                 "blindbox_v1_mix.safetensors", 0.8, "None", None, True, "4x-UltraSharp.pth", 1000 + i, f"Job_{i:05d}")
+    return workflow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=2000)
+    args = parser.parse_args()
+
+    template = WorkflowTemplate.from_file(TEMPLATE_PATH, WORKFLOW_BINDINGS)
+    assert build_legacy(7) == build_template(template, 7), "两种构建方式的结果不一致"
+
+    start = time.perf_counter()
+    for i in range(args.jobs):
+        build_legacy(i)
+    legacy_us = (time.perf_counter() - start) / args.jobs * 1e6
+
+    start = time.perf_counter()
+    for i in range(args.jobs):
+        build_template(template, i)
+    template_us = (time.perf_counter() - start) / args.jobs * 1e6
+
+    start = time.perf_counter()
+    for i in range(args.jobs):
+        build_shared(template, i)
+    shared_us = (time.perf_counter() - start) / args.jobs * 1e6
+
+    print(f"jobs: {args.jobs}")
+    print(f"WorkflowModifier (读取 + 解析 + 修改): {legacy_us:8.1f} µs/job")
+    print(f"WorkflowTemplate.render (增量拷贝):   {template_us:8.1f} µs/job")
+    print(f"build_workflow (渲染 + 编译):        {shared_us:8.1f} µs/job")
+    print(f"加速比: {legacy_us / template_us:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
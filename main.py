@@ -1,9 +1,14 @@
 import os
 import time
-import pandas as pd
-from src.data_processor import WorkflowModifier
-from src.comfy_client import ComfyAgent
+from src.data_processor import load_template
 from src.file_manager import AssetManager  # 引入新写的搬运工
+from src.batch_runner import BatchRunner
+from src.scheduler import MultiBackendDispatcher
+from src.batch_planner import BatchPlanner, parse_seed
+from src.result_cache import ResultCache, workflow_key
+from src.run_ledger import RunLedger
+from src.job_ledger import JobSource, JobJournal
+from src.workflow_builder import WORKFLOW_BINDINGS, build_workflow
 
 # ==========================================
 # 🔧 工程配置区 (Configuration)
@@ -13,6 +18,9 @@ from src.file_manager import AssetManager  # 引入新写的搬运工
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_PATH = os.path.join(BASE_DIR, "config", "workflow_api.json")
 DATA_PATH = os.path.join(BASE_DIR, "jobs.csv")
+JOURNAL_PATH = os.path.join(BASE_DIR, "jobs.progress.jsonl")  # 进度日志，删除即可从头重跑
+RESULT_CACHE_PATH = os.path.join(BASE_DIR, "cache", "results.sqlite")  # 结果缓存索引 (与 app.py 共用)
+LEDGER_PATH = os.path.join(BASE_DIR, "runs.sqlite")  # 运行台账 (与 app.py 的分析页共用)
 PROJECT_OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 
 # 2. ComfyUI 的输出路径 (⚠️⚠️⚠️ 这里一定要改对 ⚠️⚠️⚠️)
@@ -20,16 +28,28 @@ PROJECT_OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 # 如果你是便携版，通常在 ComfyUI/output
 COMFY_OUTPUT_DIR = r"D:\ComfyUI_Main\ComfyUI-aki-v3\ComfyUI-aki-v3\ComfyUI\output" 
 # ↑↑↑ 如果你的盘符是 M盘或 E盘，请手动修改上面的路径 ↑↑↑
+# 与 COMFY_OUTPUT_DIR 同机的 ComfyUI 实例：输出直接从磁盘搬运 (同一盘符时只是重命名)，不经 HTTP 下载
+COMFY_LOCAL_BACKENDS = ["http://127.0.0.1:8188"]
 
-# 3. JSON 节点 ID (根据你的 workflow_api.json)
-NODE_ID_PROMPT = "6"
-NODE_ID_SEED = "3"
+# 3. 节点绑定与 worker / 界面共用 src/workflow_builder.WORKFLOW_BINDINGS (根据你的 workflow_api.json)
+# 以下参数可在 jobs.csv 中按行覆盖 (ckpt / lora / lora_strength / width / height / upscale_model 列)，留空的列沿用模板中的取值
+MODEL_PARAMS = ("ckpt", "lora", "lora_strength", "width", "height", "upscale_model")
+
+# 4. 队列深度：每个 ComfyUI 实例上同时排队的任务数，完成一个补一个
+MAX_IN_FLIGHT = 4
+
+# 5. ComfyUI 实例列表：填多个地址即可多机/多卡并行，任务自动发往最空闲的实例，宕机实例上的任务会迁移
+COMFY_BACKENDS = ["http://127.0.0.1:8188"]
+
+def job_label(job):
+    """任务的显示名：优先用 filename / id 列，没有则用行号"""
+    return job.get('filename') or job.get('id') or f"row_{job.row + 1}"
 
 def main():
     print("🤖 AIGC Pipeline v1.2 (Full Cycle) 初始化中...")
 
     # === 第一步：基础设施自检 ===
-    agent = ComfyAgent()
+    agent = MultiBackendDispatcher(COMFY_BACKENDS)
     if not agent.is_server_ready():
         print("❌ 错误：无法连接到 ComfyUI。请先启动 ComfyUI 控制台！")
         return
@@ -38,74 +58,125 @@ def main():
         print(f"❌ 错误：找不到工单文件 {DATA_PATH}")
         return
 
-    # === 第二步：读取工单 ===
+    # === 第二步：读取工单 (流式读取 + 断点续跑) ===
     print(f"📂 正在读取工单: {DATA_PATH}")
     try:
-        df = pd.read_csv(DATA_PATH)
-        # 过滤掉 NaN 的行 (防呆设计)
-        df = df.dropna(subset=['prompt'])
+        source = JobSource(DATA_PATH)
     except Exception as e:
         print(f"❌读取 CSV 失败: {e}")
         return
-
-    # 筛选待处理任务
-    pending_jobs = df[df['status'] == 'pending']
-    print(f"📋 待处理任务数：{len(pending_jobs)}")
-
-    if len(pending_jobs) == 0:
-        print("✅ 所有任务已完成，无需运行。")
-        return
+    journal = JobJournal(JOURNAL_PATH)
+    if journal.completed_count:
+        print(f"♻️ 断点续跑：进度日志中已有 {journal.completed_count} 行完成，将跳过")
 
     # === 第三步：加载模具 ===
     try:
-        modifier = WorkflowModifier(TEMPLATE_PATH)
+        template = load_template(TEMPLATE_PATH, WORKFLOW_BINDINGS)
     except Exception as e:
         print(f"❌ {e}")
         return
 
-    # === 第四步：循环生产 (Production Loop) ===
-    for index, row in pending_jobs.iterrows():
-        prompt_text = row['prompt']
-        seed_val = int(row['seed'])
-        job_id_csv = row['id']
-        
-        print(f"\n--- 正在处理任务 ID: {job_id_csv} ---")
-        
-        # 1. 修改参数
-        modifier.update_prompt(NODE_ID_PROMPT, prompt_text)
-        # 强制修改 Seed
-        modifier.workflow_data[NODE_ID_SEED]["inputs"]["seed"] = seed_val
-        
-        print(f"Ref: 提示词='{prompt_text[:20]}...', 种子={seed_val}")
-
+    # === 第四步：流水线生产 (Production Loop) ===
+    # 始终保持 MAX_IN_FLIGHT 个任务在 GPU 队列中，每完成一个立即归档并补位
+    archiver = AssetManager(COMFY_OUTPUT_DIR, PROJECT_OUTPUT_DIR, local_backends=COMFY_LOCAL_BACKENDS)
+    # 调度器订阅每个实例的事件流：任务完成即刻得知，全部断开时退回 /history 轮询
+    print(f"🖥️ 在线实例: {len(agent.healthy_backends)}/{len(COMFY_BACKENDS)}")
+    runner = BatchRunner(agent, max_in_flight=MAX_IN_FLIGHT * len(COMFY_BACKENDS), events=agent)
+    # 模型亲和排序：模型配置相同的行连续执行，减少换模型的等待
+    # 模板默认走放大分支 (SaveImage <- 节点 19)，放大模型也计入模型配置
+    planner = BatchPlanner(dict({name: template.default(name) for name in MODEL_PARAMS}, upscale=True))
+
+    def pending_jobs():
+        # 过滤掉 prompt 为空的行 (防呆设计)，并计为完成，避免下次重复检查
+        for job in source.iter_pending(journal):
+            if job.get('prompt', '').strip():
+                yield job
+            else:
+                journal.record_skipped(job, "prompt 为空")
+
+    # 结果缓存：与之前某次成功生成的工作流完全相同 (忽略文件名前缀) 的行直接复用已归档的图片
+    result_cache = ResultCache(RESULT_CACHE_PATH, max_age_days=30)
+    prepared = {}  # 行号 -> 待提交的工作流
+    cache_hits = 0
+    # 运行台账：记录每个任务的排队、GPU、传输、归档耗时
+    ledger = RunLedger(LEDGER_PATH)
+    batch_id = "cli-" + time.strftime("%Y%m%d-%H%M%S")
+
+    def uncached_jobs(jobs):
+        nonlocal cache_hits
+        for job in jobs:
+            prompt_text = job['prompt']
+            seed_val = parse_seed(job)
+
+            # 1. 修改参数 (每个任务一份独立的工作流，流水线提交时互不干扰)
+            # 与 worker 使用同一套组装逻辑：同一行在两边得到相同的工作流与结果缓存键
+            config = planner.resolve(job)
+            workflow, seed_val = build_workflow(template, prompt_text, template.default("negative"), config['width'], config['height'],
+                                                config['ckpt'], config['lora'], config['lora_strength'], "None", None,
+                                                config['upscale'], config['upscale_model'], seed_val, job_label(job))
+            key = workflow_key(workflow)
+            job['cache_key'] = key
+
+            cached = result_cache.lookup(key)
+            if cached:
+                linked = archiver.link_cached(cached, job_label(job), key[:8])
+                if linked:
+                    print(f"♻️ 任务 {job_label(job)} 命中结果缓存，跳过生成")
+                    journal.record_completed(job, None, [os.path.basename(p) for p in linked])
+                    ledger.record(batch=batch_id, style="CLI", job=job_label(job), prompt=prompt_text, seed=seed_val,
+                                  status="cached", total_time=0, images=len(linked), filename=os.path.basename(linked[0]))
+                    cache_hits += 1
+                    continue
+
+            print(f"\n--- 正在提交任务: {job_label(job)} ---")
+            print(f"Ref: 提示词='{prompt_text[:20]}...', 种子={seed_val}")
+            job['used_seed'] = seed_val
+            prepared[job.row] = workflow
+            yield job
+
+    def submit(job):
         # 2. 发送指令
-        workflow = modifier.get_workflow()
-        success, msg = agent.send_job(workflow)
-
-        if success:
-            print(f"✅ 指令下发成功! Job ID: {msg}")
-            # 更新内存状态
-            df.at[index, 'status'] = 'done'
-        else:
-            print(f"❌ 下发失败: {msg}")
-
-    # === 第五步：等待生成 (Wait) ===
-    # 这一步是为了给 ComfyUI 留出渲染时间
-    # 假设每张图 3 秒，3张图就是 9 秒，我们给 12 秒缓冲
-    wait_time = len(pending_jobs) * 4 
-    print(f"\n⏳ 所有指令已发送，等待 GPU 渲染中... ({wait_time}秒)")
-    time.sleep(wait_time)
-
-    # === 第六步：资产归档 (Archiving) ===
-    # 实例化搬运工
-    archiver = AssetManager(COMFY_OUTPUT_DIR, PROJECT_OUTPUT_DIR)
-    
-    # 获取今天日期
-    today_str = time.strftime("%Y%m%d")
-    
-    # 执行搬运
-    archiver.sync_latest_images(today_str)
-    
+        succ, msg = agent.send_job(prepared.pop(job.row))
+        if succ:
+            journal.record_submitted(job, msg)
+        return succ, msg
+
+    done_count = 0
+    try:
+        for result in runner.run(uncached_jobs(planner.plan(pending_jobs())), submit):
+            job = result.job
+            timings = {}
+            if result.succeeded:
+                print(f"✅ 任务 {job_label(job)} 渲染完成 ({result.elapsed:.1f}s), Job ID: {result.prompt_id}")
+                # === 第五步：资产归档 (Archiving) ===
+                transfer_start = time.time()
+                archived = archiver.archive_job(agent, result.prompt_id, job_label(job))
+                archive_start = time.time()
+                # 写入进度日志，重启后自动跳过
+                journal.record_completed(job, result.prompt_id, [os.path.basename(p) for p in archived])
+                result_cache.store(job['cache_key'], archived)
+                done_count += 1
+                timings = {"transfer_time": archive_start - transfer_start, "archive_time": time.time() - archive_start,
+                           "images": len(archived), "filename": os.path.basename(archived[0]) if archived else None}
+            else:
+                print(f"❌ 任务 {job_label(job)} 失败 ({result.status}): {result.message}")
+                journal.record_failed(job, result.message)
+            ledger.record(batch=batch_id, style="CLI", job=job_label(job), prompt=job['prompt'], seed=job.get('used_seed'),
+                          status=result.status, prompt_id=result.prompt_id,
+                          backend=agent.backend_of(result.prompt_id) if result.prompt_id else None,
+                          queue_wait=result.queue_wait, gpu_time=result.run_time, total_time=result.elapsed, **timings)
+    finally:
+        journal.close()
+        agent.close()
+        result_cache.evict()
+        cache_summary = result_cache.summary()
+        result_cache.close()
+        ledger.close()
+
+    print(f"\n📋 本次完成 {done_count} 个任务" + (f"，{cache_hits} 个命中结果缓存" if cache_hits else ""))
+    if planner.stats["rows"]:
+        print(f"🧩 模型亲和排序: {planner.summary()}")
+    print(f"🗃️ 结果缓存: {cache_summary}")
     print("\n🎉 全流程结束！请检查 output 文件夹。")
 
 if __name__ == "__main__":
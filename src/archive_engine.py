@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from src import telemetry
+
+CHUNK_SIZE = 4 * 1024 * 1024
+# 交付副本格式：webp 为无损 WebP，png 为优化压缩的 PNG (同样无损)
+DELIVERY_FORMATS = ("webp", "png")
+# EXIF ImageDescription，WebP 交付副本的任务元数据写在这里
+EXIF_IMAGE_DESCRIPTION = 0x010E
+
+
+def same_device(src_path, dst_dir):
+    """源文件与目标目录是否在同一卷上 (可以直接重命名，无需复制)"""
+    try:
+        return os.stat(src_path).st_dev == os.stat(dst_dir).st_dev
+    except OSError:
+        return False
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_verified(src_path, dst_path):
+    """
+    跨卷搬运：边复制边计算 sha256，写完后重新读取目标文件校验，
+    一致才原子替换为正式文件名并删除源文件；校验失败时源文件保持不动。
+    :return: 复制的字节数
+    """
+    tmp_path = dst_path + ".part"
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(src_path, "rb") as fin, open(tmp_path, "wb") as fout:
+            for chunk in iter(lambda: fin.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+                fout.write(chunk)
+                size += len(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+        if _file_sha256(tmp_path) != h.hexdigest():
+            raise IOError(f"❌ 校验失败: {os.path.basename(src_path)} 复制后内容不一致")
+        shutil.copystat(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.remove(src_path)
+    return size
+
+
+def encode_delivery(src_path, dst_dir, fmt, metadata):
+    """
+    生成交付副本 (在子进程中运行)：无损 WebP 或优化 PNG，并写入任务元数据。
+    PNG 保留 ComfyUI 原有的文本块 (prompt / workflow)，另加 aigc_job；WebP 写入 EXIF ImageDescription。
+    :return: 交付副本路径
+    """
+    from PIL import Image, PngImagePlugin
+
+    text = json.dumps(metadata, ensure_ascii=False, sort_keys=True)
+    dst_path = os.path.join(dst_dir, os.path.splitext(os.path.basename(src_path))[0] + "." + fmt)
+    tmp_path = dst_path + ".part"
+    with Image.open(src_path) as img:
+        if fmt == "webp":
+            exif = Image.Exif()
+            exif[EXIF_IMAGE_DESCRIPTION] = json.dumps(metadata, ensure_ascii=True, sort_keys=True)
+            img.save(tmp_path, "WEBP", lossless=True, quality=100, exif=exif.tobytes())
+        else:
+            info = PngImagePlugin.PngInfo()
+            for key, value in getattr(img, "text", {}).items():
+                info.add_text(key, value)
+            info.add_itxt("aigc_job", text)
+            img.save(tmp_path, "PNG", optimize=True, pnginfo=info)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+class ArchiveEngine:
+    """
+    归档引擎：把文件从 ComfyUI 输出目录搬到项目目录，并可选地生成交付副本。
+    - 同一卷上直接重命名 (原子操作，与文件大小无关)；
+    - 跨卷时在线程池中复制，写完校验 sha256 后才删除源文件；
+    - 交付副本 (无损 WebP / 优化 PNG + 任务元数据) 在进程池中编码，不占用提交任务的主循环。
+    """
+    def __init__(self, workers=4, delivery_dir=None, delivery_format=None, encode_workers=2):
+        """
+        :param workers: 复制 / 下载线程数
+        :param delivery_dir: 交付副本目录，None 表示不生成
+        :param delivery_format: "webp" 或 "png"
+        :param encode_workers: 编码进程数
+        """
+        if delivery_format is not None and delivery_format not in DELIVERY_FORMATS:
+            raise ValueError(f"❌ 不支持的交付格式 {delivery_format!r}，可选 {', '.join(DELIVERY_FORMATS)}")
+        self.delivery_dir = delivery_dir if delivery_format else None
+        self.delivery_format = delivery_format
+        self.encode_workers = encode_workers
+        self.stats = {"renamed": 0, "copied": 0, "bytes_copied": 0, "encoded": 0}
+        self._stats_lock = threading.Lock()
+        # 文件级与任务级分开两个池：任务级工作会等待文件级结果，共用一个池可能互相等死
+        self._files = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="archive-file")
+        self._jobs = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="archive-job")
+        self._encoder = None
+        if self.delivery_dir:
+            os.makedirs(self.delivery_dir, exist_ok=True)
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def move(self, src_path, dst_path):
+        """
+        搬运一个文件 (调用方保证 dst_path 不与已有文件冲突)
+        :return: Future，结果为 dst_path
+        """
+        if same_device(src_path, os.path.dirname(os.path.abspath(dst_path))):
+            future = Future()
+            try:
+                with telemetry.span("archive.rename"):
+                    os.replace(src_path, dst_path)
+                self._count("renamed")
+                future.set_result(dst_path)
+            except OSError as e:
+                future.set_exception(e)
+            return future
+        return self._files.submit(self._copy, src_path, dst_path)
+
+    @telemetry.traced("archive.copy")
+    def _copy(self, src_path, dst_path):
+        size = copy_verified(src_path, dst_path)
+        self._count("copied")
+        self._count("bytes_copied", size)
+        return dst_path
+
+    def submit_file(self, fn, *args):
+        """在文件级线程池中执行 (例如分块下载一个输出文件)"""
+        return self._files.submit(fn, *args)
+
+    def submit_job(self, fn, *args):
+        """在任务级线程池中执行整个任务的归档，内部可以再使用 move() / submit_file()"""
+        return self._jobs.submit(fn, *args)
+
+    def deliver(self, path, metadata):
+        """
+        在进程池中生成交付副本
+        :return: Future (结果为交付副本路径)；未启用交付副本时返回 None
+        """
+        if not self.delivery_dir:
+            return None
+        if self._encoder is None:
+            self._encoder = ProcessPoolExecutor(max_workers=self.encode_workers)
+        future = self._encoder.submit(encode_delivery, path, self.delivery_dir, self.delivery_format, metadata)
+        future.add_done_callback(self._on_encoded)
+        return future
+
+    def _on_encoded(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            print(f"⚠️ 交付副本生成失败: {error}")
+        else:
+            self._count("encoded")
+
+    def close(self, wait=True):
+        self._jobs.shutdown(wait=wait)
+        self._files.shutdown(wait=wait)
+        if self._encoder is not None:
+            self._encoder.shutdown(wait=wait)
@@ -0,0 +1,346 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# dHash 距离 (64 位中不同的位数) 不超过该值视为近重复：同种子 / 相近提示词的图通常在 0~5 之间
+DUPLICATE_DISTANCE = 5
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+# 旧版 numpy 没有 bitwise_count 时按字节查表 (首次使用时生成)
+_POPCOUNT8 = None
+
+
+def _popcount(values):
+    """uint64 数组每个元素中 1 的位数"""
+    # 延迟导入：界面冷启动不加载 numpy，打开画廊的相似图功能时才需要
+    import numpy as np
+
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(values)
+    global _POPCOUNT8
+    if _POPCOUNT8 is None:
+        _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return _POPCOUNT8[np.ascontiguousarray(values).view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def dhash(image):
+    """
+    64 位差值哈希 (dHash)：缩成 9x8 灰度图，逐行比较相邻像素的明暗。
+    对缩放、重新编码、轻微调色不敏感，构图 / 主体一变就会相差很多位。
+    :param image: 图片路径或已打开的文件对象
+    :return: int (0 ~ 2^64-1)
+    """
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(image) as img:
+        img.draft("L", (64, 64))  # JPEG 源图在解码阶段直接降采样
+        gray = img.convert("L").resize((9, 8), Image.Resampling.BOX)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int(bits.view(">u8")[0])
+
+
+def _signed(value):
+    """SQLite INTEGER 是有符号 64 位：高位为 1 的哈希按补码存储"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+# 多段索引每段的最大位数：按段取值分桶的计数表大小为 2^位数
+MAX_BAND_BITS = 22
+# 展开候选对时每块最多的对数，限制内存
+PAIR_CHUNK = 1 << 22
+
+
+def _near_pairs(hashes, max_distance):
+    """
+    距离不超过 max_distance 的全部图片对 (下标 a < b，可能重复出现)：多段索引 (multi-index hashing)。
+    把 64 位分成 m 段 (m > max_distance / 2)，按鸽巢原理这样的两张图至少有一段相差不超过 1 位；
+    每段按取值分桶，只比较同桶以及相差一位的桶中的候选，不必两两比较全部图片。
+    """
+    import numpy as np
+
+    count = len(hashes)
+    bands = max(max_distance // 2 + 1, -(-64 // MAX_BAND_BITS))
+    width = 64 // bands
+    radius = max_distance // bands  # 0 或 1
+    index = np.arange(count)
+    pairs_a, pairs_b = [], []
+    for band in range(bands):
+        bits = width if band < bands - 1 else 64 - width * (bands - 1)
+        keys = ((hashes >> np.uint64(band * width)) & np.uint64((1 << bits) - 1)).astype(np.int64)
+        sizes = np.bincount(keys, minlength=1 << bits)
+        starts = np.cumsum(sizes) - sizes
+        order = np.argsort(keys, kind="stable")
+        for flip in [0] + ([1 << bit for bit in range(bits)] if radius else []):
+            probe = keys ^ flip
+            n, lo = sizes[probe], starts[probe]
+            # 按累计候选数分块展开 (src, 桶内第 k 个)
+            ends = np.cumsum(n)
+            first = 0
+            while first < count:
+                last = int(np.searchsorted(ends, (ends[first - 1] if first else 0) + PAIR_CHUNK, "right"))
+                last = min(count, max(last, first + 1))
+                chunk_n = n[first:last]
+                total = int(chunk_n.sum())
+                if total:
+                    src = np.repeat(index[first:last], chunk_n)
+                    offset = np.arange(total) - np.repeat(np.cumsum(chunk_n) - chunk_n, chunk_n)
+                    dst = order[np.repeat(lo[first:last], chunk_n) + offset]
+                    keep = src < dst
+                    src, dst = src[keep], dst[keep]
+                    close = _popcount(hashes[src] ^ hashes[dst]) <= max_distance
+                    pairs_a.append(src[close])
+                    pairs_b.append(dst[close])
+                first = last
+    if not pairs_a:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+class AssetIndex:
+    """
+    素材库的感知哈希索引，用于查找近重复图片。
+    哈希持久化在 SQLite (WAL) 中，worker 与界面进程共用；查询时全部哈希以紧凑的 uint64 数组驻留内存
+    (10 万张约 800KB)，一次异或 + popcount 向量化算出与所有图片的汉明距离。
+    哈希在线程池中计算 (解码图片时 PIL 会释放 GIL)，归档完成即可入库，不阻塞提交循环。
+    """
+    def __init__(self, db_path, asset_dir, workers=4):
+        """
+        :param db_path: SQLite 数据库路径
+        :param asset_dir: 素材目录 (项目输出目录)，索引中的名称为该目录下的文件名
+        :param workers: 计算哈希的线程数
+        """
+        import numpy as np
+
+        self.asset_dir = asset_dir
+        self._lock = threading.Lock()
+        self._names = []
+        self._slots = {}  # 文件名 -> 数组下标
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._version = 0
+        self._data_version = None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="phash")
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS assets (name TEXT PRIMARY KEY, hash INTEGER NOT NULL, ts REAL NOT NULL)")
+        self._db.commit()
+        self._refresh()
+
+    # === 内存数组 ===
+    def _refresh(self):
+        """
+        其他进程 (worker / 界面) 写入过数据库时重新载入 (调用方不持有 self._lock)
+        PRAGMA data_version 只在其他连接提交后变化，本连接自己的写入已同步更新内存数组
+        """
+        import numpy as np
+
+        with self._lock:
+            data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            rows = self._db.execute("SELECT name, hash FROM assets ORDER BY rowid").fetchall()
+            self._names = [name for name, _ in rows]
+            self._slots = {name: i for i, name in enumerate(self._names)}
+            self._hashes = np.zeros(max(1024, len(rows) * 2), dtype=np.uint64)
+            if rows:
+                self._hashes[:len(rows)] = np.fromiter((h for _, h in rows), dtype=np.int64, count=len(rows)).view(np.uint64)
+            self._data_version = data_version
+            self._version += 1
+
+    def _put(self, name, value):
+        slot = self._slots.get(name)
+        if slot is None:
+            slot = len(self._names)
+            if slot == len(self._hashes):
+                import numpy as np
+
+                self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+            self._names.append(name)
+            self._slots[name] = slot
+        self._hashes[slot] = value
+
+    def _drop(self, name):
+        """与最后一个元素交换后删除，数组保持连续"""
+        slot = self._slots.pop(name)
+        last = len(self._names) - 1
+        if slot != last:
+            moved = self._names[last]
+            self._names[slot] = moved
+            self._hashes[slot] = self._hashes[last]
+            self._slots[moved] = slot
+        self._names.pop()
+
+    def __len__(self):
+        return len(self._names)
+
+    def version(self):
+        """索引内容的版本号，用作界面查询结果缓存的键"""
+        self._refresh()
+        return self._version
+
+    # === 写入 ===
+    def hash_file(self, path):
+        """计算一张图的哈希，读取失败时返回 None"""
+        try:
+            return dhash(path)
+        except Exception as e:
+            print(f"⚠️ 感知哈希计算失败 {os.path.basename(path)}: {e}")
+            return None
+
+    def hash_async(self, paths):
+        """
+        在线程池中并行计算多张图的哈希
+        :return: Future，结果为与 paths 对应的哈希列表 (失败的为 None)
+        """
+        combined = Future()
+        futures = [self._pool.submit(self.hash_file, path) for path in paths]
+        if not futures:
+            combined.set_result([])
+            return combined
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            combined.set_result([future.result() for future in futures])
+        for future in futures:
+            future.add_done_callback(done)
+        return combined
+
+    def add(self, items):
+        """
+        登记已算好哈希的素材
+        :param items: [(路径或文件名, 哈希), ...]，哈希为 None 的跳过
+        """
+        rows = [(os.path.basename(path), value) for path, value in items if value is not None]
+        if not rows:
+            return
+        now = time.time()
+        self._refresh()
+        with self._lock:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO assets (name, hash, ts) VALUES (?, ?, ?)",
+                                     [(name, _signed(value), now) for name, value in rows])
+            for name, value in rows:
+                self._put(name, value)
+            self._version += 1
+
+    def remove(self, names):
+        names = [os.path.basename(name) for name in names]
+        self._refresh()
+        with self._lock:
+            names = [name for name in names if name in self._slots]
+            if not names:
+                return
+            with self._db:
+                self._db.executemany("DELETE FROM assets WHERE name = ?", [(name,) for name in names])
+            for name in names:
+                self._drop(name)
+            self._version += 1
+
+    def sync(self, names=None):
+        """
+        让索引与素材目录一致：补算新文件的哈希 (线程池)，删除文件已不存在的记录
+        :param names: 目录中的全部文件名 (例如画廊的列表)，None 时扫描目录
+        :return: 新登记的张数
+        """
+        if names is None:
+            names = [entry.name for entry in os.scandir(self.asset_dir)
+                     if entry.name.lower().endswith(IMAGE_EXTS) and entry.is_file()] if os.path.isdir(self.asset_dir) else []
+        self._refresh()
+        with self._lock:
+            missing = [name for name in names if name not in self._slots]
+            present = set(names)
+            gone = [name for name in self._names if name not in present]
+        # 列表可能早于 worker 刚归档的图片，只删除文件确实已不存在的记录
+        gone = [name for name in gone if not os.path.exists(os.path.join(self.asset_dir, name))]
+        if gone:
+            self.remove(gone)
+        if missing:
+            hashes = self.hash_async([os.path.join(self.asset_dir, name) for name in missing]).result()
+            self.add(zip(missing, hashes))
+        return len(missing)
+
+    # === 查询 ===
+    def find(self, value, max_distance=DUPLICATE_DISTANCE, limit=20, exclude=()):
+        """
+        查找与哈希 value 的汉明距离不超过 max_distance 的素材 (向量化全量比较)
+        :param exclude: 不参与比较的文件名
+        :return: [(文件名, 距离), ...]，按距离从近到远
+        """
+        import numpy as np
+
+        self._refresh()
+        with self._lock:
+            count = len(self._names)
+            if not count:
+                return []
+            distances = _popcount(self._hashes[:count] ^ np.uint64(value))
+            hits = np.flatnonzero(distances <= max_distance)
+            hits = hits[np.argsort(distances[hits], kind="stable")]
+            result = [(self._names[i], int(distances[i])) for i in hits]
+        if exclude:
+            result = [(name, d) for name, d in result if name not in exclude]
+        return result[:limit]
+
+    def search(self, image, max_distance=DUPLICATE_DISTANCE, limit=20):
+        """给定一张图 (路径或文件对象)，返回素材库中的近重复图片 [(文件名, 距离), ...]"""
+        return self.find(dhash(image), max_distance, limit, exclude=(os.path.basename(image),) if isinstance(image, str) else ())
+
+    def clusters(self, names, max_distance=DUPLICATE_DISTANCE):
+        """
+        把 names (按展示顺序，例如画廊的新在前) 中的近重复图片聚成簇：
+        按顺序取尚未归簇的图片作为代表，与它距离不超过 max_distance 的其余未归簇图片并入该簇。
+        :return: (代表文件名列表 (保持原顺序，未入库的文件各自成簇), {代表: [同簇其余文件名]})
+        """
+        import numpy as np
+
+        self._refresh()
+        with self._lock:
+            slots = [self._slots.get(name) for name in names]
+            positions = [i for i, slot in enumerate(slots) if slot is not None]
+            hashes = self._hashes[[slots[i] for i in positions]] if positions else np.zeros(0, dtype=np.uint64)
+        a, b = _near_pairs(hashes, max_distance)
+        # 邻接表 (CSR)：每张图的近重复邻居
+        src, dst = np.concatenate([a, b]), np.concatenate([b, a])
+        order = np.argsort(src, kind="stable")
+        src, dst = src[order], dst[order]
+        nodes, starts = np.unique(src, return_index=True)
+        ends = np.append(starts[1:], len(src))
+
+        leader = np.full(len(positions), -1, dtype=np.int64)
+        for i, lo, hi in zip(nodes.tolist(), starts.tolist(), ends.tolist()):
+            if leader[i] >= 0:
+                continue
+            leader[i] = i
+            neighbours = dst[lo:hi]
+            leader[neighbours[leader[neighbours] < 0]] = i
+
+        members = {}
+        followers = set()
+        for i, j in enumerate(leader.tolist()):
+            if j >= 0 and i != j:
+                members.setdefault(names[positions[j]], []).append(names[positions[i]])
+                followers.add(positions[i])
+        leaders = [name for i, name in enumerate(names) if i not in followers]
+        return leaders, members
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,214 @@
+from collections import OrderedDict
+
+# jobs.csv 中可选的逐行模型配置列 -> 生成参数名；留空的单元格使用界面 (侧边栏) 的默认值
+MODEL_COLUMNS = {
+    "ckpt": "ckpt",
+    "lora": "lora",
+    "lora_strength": "lora_strength",
+    "width": "width",
+    "height": "height",
+    "upscale": "upscale",
+    "upscale_model": "upscale_model",
+}
+# 切换这些参数会让 ComfyUI 重新加载模型 (磁盘 I/O + 显存换入换出)；尺寸不影响模型缓存
+AFFINITY_PARAMS = ("ckpt", "lora", "lora_strength", "upscale", "upscale_model")
+
+# 放大分支 (ImageUpscaleWithModel upscale_by=2) 的第二遍采样在 4 倍像素上进行，显存按 4 倍估算
+HIRES_PIXEL_FACTOR = 4
+
+TRUE_VALUES = ("1", "true", "yes", "y", "on", "是")
+FALSE_VALUES = ("0", "false", "no", "n", "off", "否")
+
+
+def _parse_value(name, text):
+    """把 CSV 单元格转换为参数值，无法识别时抛出 ValueError"""
+    if name in ("width", "height"):
+        return int(float(text))
+    if name == "lora_strength":
+        return float(text)
+    if name == "upscale":
+        lowered = text.lower()
+        if lowered in TRUE_VALUES:
+            return True
+        if lowered in FALSE_VALUES:
+            return False
+        raise ValueError(f"无法识别的开关值 {text!r}")
+    return text
+
+
+def row_upscale(job, default):
+    """行内 upscale 列覆盖后的放大开关，与 BatchPlanner.resolve 一致 (无法识别的取值沿用默认值，不重复提示)"""
+    text = (job.get("upscale") or "").strip()
+    try:
+        return _parse_value("upscale", text) if text else default
+    except ValueError:
+        return default
+
+
+def parse_seed(job):
+    """
+    读取行内的 seed 列：空值返回 -1 (随机种子)；NaN、inf 等无法转为整数的取值同样按随机处理并给出提示
+    """
+    value = job.get("seed")
+    text = "" if value is None else str(value).strip()
+    if not text:
+        return -1
+    try:
+        return int(float(text))
+    except (ValueError, OverflowError):
+        print(f"⚠️ 列 seed 的取值无效，使用随机种子: {text!r}")
+        return -1
+
+
+class BatchPlanner:
+    """
+    批量任务的模型亲和性排序。
+    每一行可以通过 ckpt / lora / lora_strength / width / height / upscale / upscale_model 列
+    (或 size 列，如 512x680) 覆盖界面默认值；规划时把模型配置相同的行排在一起连续执行，
+    减少 ComfyUI 切换 checkpoint / LoRA / 放大模型的次数。
+
+    为了支持流式读取的大任务表，只在 window 行的窗口内重排：窗口内按模型配置分组，
+    并优先接上一个窗口最后使用的配置。行对象本身不变，结果仍按行内的 filename 归档。
+    """
+    def __init__(self, defaults, window=500):
+        """
+        :param defaults: 界面默认值，例如 {"ckpt": ..., "lora": ..., "lora_strength": 1.0, "width": 512, ...}
+        :param window: 重排窗口大小 (行)；越大分组越彻底，但首个任务开始前需要先读入这么多行
+        """
+        self.defaults = dict(defaults)
+        self.window = max(1, window)
+        self.stats = {"rows": 0, "switches_in_csv_order": 0, "switches_planned": 0}
+        self._last_csv_key = None
+        self._last_planned_key = None
+
+    def resolve(self, job):
+        """
+        合并行内配置与默认值
+        :return: dict 参数名 -> 取值
+        """
+        config = dict(self.defaults)
+        size = (job.get("size") or "").strip().lower().replace("×", "x")
+        if size:
+            try:
+                w, h = size.split("x")
+                config["width"], config["height"] = int(w), int(h)
+            except ValueError:
+                print(f"⚠️ 无法识别的尺寸 {size!r}，使用默认值")
+        for column, name in MODEL_COLUMNS.items():
+            text = (job.get(column) or "").strip()
+            if not text:
+                continue
+            try:
+                config[name] = _parse_value(name, text)
+            except (ValueError, OverflowError) as e:
+                print(f"⚠️ 列 {column} 的取值无效，使用默认值: {e}")
+        return config
+
+    def affinity_key(self, config):
+        """模型配置键：键相同的任务之间无需切换模型"""
+        key = []
+        for name in AFFINITY_PARAMS:
+            value = config.get(name)
+            if name == "upscale_model" and not config.get("upscale"):
+                value = None  # 不放大时放大模型不会被加载
+            if name == "lora_strength" and config.get("lora") in (None, "None"):
+                value = None
+            key.append(value)
+        return tuple(key)
+
+    def _count(self, counter, key, last):
+        if last is not None and key != last:
+            self.stats[counter] += 1
+        return key
+
+    def _flush(self, buffer):
+        groups = OrderedDict()
+        for job, key in buffer:
+            groups.setdefault(key, []).append(job)
+        # 先接着跑上一个窗口最后的配置，省掉窗口边界处的一次切换
+        if self._last_planned_key in groups:
+            groups.move_to_end(self._last_planned_key, last=False)
+        for key, jobs in groups.items():
+            self._last_planned_key = self._count("switches_planned", key, self._last_planned_key)
+            yield from jobs
+
+    def plan(self, jobs):
+        """
+        按模型亲和性重排任务 (生成器)
+        :param jobs: 可迭代的任务行 (dict / JobRow)
+        """
+        buffer = []
+        for job in jobs:
+            key = self.affinity_key(self.resolve(job))
+            self.stats["rows"] += 1
+            self._last_csv_key = self._count("switches_in_csv_order", key, self._last_csv_key)
+            buffer.append((job, key))
+            if len(buffer) >= self.window:
+                yield from self._flush(buffer)
+                buffer = []
+        if buffer:
+            yield from self._flush(buffer)
+
+    @property
+    def switches_avoided(self):
+        return self.stats["switches_in_csv_order"] - self.stats["switches_planned"]
+
+    def summary(self):
+        return (f"共 {self.stats['rows']} 行，模型切换 {self.stats['switches_in_csv_order']} 次 -> "
+                f"{self.stats['switches_planned']} 次 (减少 {self.switches_avoided} 次)")
+
+
+class LatentBatcher:
+    """
+    潜空间批处理：把生成参数只差种子 / 文件名的相邻任务合并为一次提交 (EmptyLatentImage batch_size > 1)，
+    GPU 一次采样多张，省掉每个任务的调度、模型前处理与 VAE 往返，提示词相同的种子扫描批次提速明显。
+
+    ComfyUI 对整批只用一个种子生成噪声：批内第 i 张图由 (基础种子, 批内序号 i) 唯一确定，
+    只有第 0 张与单独以基础种子提交的结果相同。因此只有随机种子的行适合合并，
+    填写了种子的行由调用方 (key_of 返回 None) 单独提交，保证每张图都能按所在行的种子重现。
+
+    每批张数受 max_batch 与 max_pixels 双重限制：大尺寸 / 开启放大的任务自动减小批量，避免显存溢出。
+    """
+    def __init__(self, max_batch=4, max_pixels=4 * 512 * 512):
+        """
+        :param max_batch: 每次提交最多合并的任务数
+        :param max_pixels: 一批的潜空间总像素上限 (宽 x 高 x 张数，开启放大时按 4 倍计)，按显存大小调整
+        """
+        self.max_batch = max(1, max_batch)
+        self.max_pixels = max_pixels
+        self.stats = {"rows": 0, "submissions": 0}
+
+    def capacity(self, width, height, upscale=False):
+        """该尺寸下一批最多合并的任务数 (至少 1)"""
+        pixels = int(width) * int(height) * (HIRES_PIXEL_FACTOR if upscale else 1)
+        return max(1, min(self.max_batch, self.max_pixels // max(1, pixels)))
+
+    def group(self, items, key_of, capacity_of):
+        """
+        把相邻的可合并任务分组 (生成器)，每组为一个 list，组内顺序即批内序号
+        :param key_of: key_of(item) -> 合并键，键相同的相邻任务可以合并；None 表示不参与合并
+        :param capacity_of: capacity_of(item) -> 该任务所在批次的张数上限
+        """
+        batch, batch_key, batch_cap = [], None, 1
+        for item in items:
+            key = key_of(item)
+            if batch and (key is None or key != batch_key):
+                yield self._emit(batch)
+                batch = []
+            if not batch:
+                batch_key, batch_cap = key, capacity_of(item) if key is not None else 1
+            batch.append(item)
+            if len(batch) >= batch_cap:
+                yield self._emit(batch)
+                batch = []
+        if batch:
+            yield self._emit(batch)
+
+    def _emit(self, batch):
+        self.stats["rows"] += len(batch)
+        self.stats["submissions"] += 1
+        return batch
+
+    def summary(self):
+        return (f"{self.stats['rows']} 行合并为 {self.stats['submissions']} 次提交 "
+                f"(平均每批 {self.stats['rows'] / max(1, self.stats['submissions']):.1f} 张)")
@@ -0,0 +1,191 @@
+import time
+
+from src import telemetry
+
+
+class JobResult:
+    """
+    单个批量任务的执行结果。
+    """
+    def __init__(self, job):
+        self.job = job
+        self.prompt_id = None
+        self.status = "pending"  # pending / running / success / failed / timeout
+        self.message = ""
+        self.submitted_at = None
+        self.started_at = None    # ComfyUI 开始执行的时间 (取不到时为 None)
+        self.executed_at = None   # ComfyUI 执行结束的时间
+        self.server_clock = False  # 上面两项取自 ComfyUI 服务器时钟 (/history)，不能与本机时间相减
+        self.finished_at = None
+
+    @property
+    def succeeded(self):
+        return self.status == "success"
+
+    @property
+    def elapsed(self):
+        """从提交到结束的耗时 (秒)"""
+        if self.submitted_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.submitted_at
+
+    @property
+    def queue_wait(self):
+        """提交后在 ComfyUI 队列中等待的时间 (秒)，未知时为 None"""
+        if self.submitted_at is None or self.started_at is None or self.server_clock:
+            return None  # 远程后端的时钟与本机不同步，跨机器相减的差值没有意义
+        return max(0.0, self.started_at - self.submitted_at)
+
+    @property
+    def run_time(self):
+        """ComfyUI 实际执行 (GPU) 的时间 (秒)，未知时为 None"""
+        if self.started_at is None or self.executed_at is None:
+            return None
+        return max(0.0, self.executed_at - self.started_at)
+
+    def finish(self, status, message=""):
+        self.status = status
+        self.message = message
+        self.finished_at = time.time()
+        return self
+
+
+class BatchRunner:
+    """
+    流水线式批量执行器。
+    始终保持 max_in_flight 个 prompt 排队在 ComfyUI 上，完成一个补一个，
+    GPU 不再因为等待轮询、归档和下一次 HTTP 往返而空转。
+    """
+    def __init__(self, agent, max_in_flight=4, poll_interval=0.5, job_timeout=300, events=None, history_check_interval=10):
+        """
+        :param agent: ComfyAgent，用于按 prompt_id 查询任务状态
+        :param max_in_flight: 同时排在 ComfyUI 上的任务数 N
+        :param poll_interval: 没有事件流时查询 /history 的间隔 (秒)
+        :param job_timeout: 超过该秒数没有任何任务完成时，判定最早提交的任务超时
+        :param events: ComfyEventStream (可选)，提供时改为事件驱动，任务一结束立即返回
+        :param history_check_interval: 事件流模式下，多久没收到完成事件就用 /history 兜底核对一次
+        """
+        self.agent = agent
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.events = events
+        self.history_check_interval = history_check_interval
+
+    def run(self, jobs, submit, refill=None):
+        """
+        执行一批任务。
+        :param jobs: 任务可迭代对象 (按需取出，不会一次性展开)
+        :param submit: 回调 submit(job) -> (bool success, str prompt_id_or_message)
+        :param refill: 可选回调 refill() -> 新的任务可迭代对象。jobs 取完后每腾出一个位置就调用一次，
+                       让执行期间新到的任务立即补进队列，而不是等队列清空；最近一次取不到任务且全部结束时返回
+        :yield: JobResult，每个任务结束 (成功 / 失败 / 超时) 时产出一次
+        """
+        job_iter = iter(jobs)
+        in_flight = {}  # prompt_id -> JobResult (保持提交顺序)
+        exhausted = False
+        last_progress = time.time()
+
+        while True:
+            # 1. 补满队列
+            while not exhausted and len(in_flight) < self.max_in_flight:
+                try:
+                    job = next(job_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                result = JobResult(job)
+                result.submitted_at = time.time()
+                succ, msg = submit(job)
+                if not succ:
+                    yield result.finish("failed", msg)
+                    continue
+                result.prompt_id = msg
+                result.status = "running"
+                in_flight[msg] = result
+
+            if not in_flight:
+                return
+
+            # 2. 收集已完成的任务
+            with telemetry.span("runner.wait", in_flight=len(in_flight)):
+                finished = self._collect_finished(in_flight)
+            if finished:
+                last_progress = time.time()
+                for result in finished:
+                    self._trace(result)
+                    yield result
+                if exhausted and refill is not None:
+                    job_iter, exhausted = iter(refill()), False
+                continue
+
+            # 3. 长时间无进展：判定最早提交的任务超时
+            if time.time() - last_progress > self.job_timeout:
+                oldest_id = next(iter(in_flight))
+                result = in_flight.pop(oldest_id)
+                last_progress = time.time()
+                yield result.finish("timeout", f"{self.job_timeout}s 内无任务完成")
+                if exhausted and refill is not None:
+                    job_iter, exhausted = iter(refill()), False
+                continue
+
+            if not self._events_live():
+                time.sleep(self.poll_interval)
+
+    def _events_live(self):
+        return self.events is not None and self.events.connected
+
+    def _collect_finished(self, in_flight):
+        """等待并收集本轮结束的 JobResult 列表"""
+        statuses = {}
+        if self._events_live():
+            statuses = self.events.wait_any(list(in_flight), timeout=self.history_check_interval)
+        if not statuses:
+            # 无事件流、断线或长时间无事件时，用 /history 兜底，避免漏收
+            for prompt_id in list(in_flight):
+                status = self.agent.get_job_status(prompt_id)
+                if status is not None:
+                    statuses[prompt_id] = status
+
+        finished = []
+        for prompt_id, status in statuses.items():
+            result = in_flight.pop(prompt_id)
+            message = ""
+            if status != "success":
+                message = (self.events.get_error(prompt_id) if self.events else "") or "ComfyUI 执行出错"
+            self._record_timing(result)
+            if self.events is not None:
+                self.events.forget(prompt_id)
+            finished.append(result.finish(status, message))
+        return finished
+
+    def _record_timing(self, result):
+        """
+        记录开始 / 结束执行时间：优先用事件流 (本机时钟)，否则读取 /history 中的时间戳 (服务器时钟)，
+        后者只用于计算执行耗时，不参与排队时间的计算
+        """
+        started = ended = None
+        if self.events is not None:
+            started, ended = self.events.get_timing(result.prompt_id)
+        if started is None:
+            started, ended = self.agent.get_history_timing(result.prompt_id)
+            result.server_clock = started is not None
+        result.started_at, result.executed_at = started, ended
+
+    @staticmethod
+    def _trace(result):
+        """启用遥测时，把任务在 ComfyUI 上的排队 / 执行时段记为 span (不在本进程中执行，单独一条轨道)"""
+        tracer = telemetry.tracer()
+        if tracer is None or result.started_at is None:
+            return
+        if result.server_clock:
+            # 服务器时钟：只有执行耗时可信，按本机收到结果的时刻对齐，不记排队时段
+            if result.executed_at is not None:
+                tracer.record_wall("comfy.execute", result.finished_at - result.run_time, result.finished_at, "ComfyUI 执行",
+                                   prompt_id=result.prompt_id, status=result.status)
+            return
+        tracer.record_wall("comfy.queue", result.submitted_at, result.started_at, "ComfyUI 队列", prompt_id=result.prompt_id)
+        if result.executed_at is not None:
+            tracer.record_wall("comfy.execute", result.started_at, result.executed_at, "ComfyUI 执行",
+                               prompt_id=result.prompt_id, status=result.status)
@@ -0,0 +1,506 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from src import draft_scoring, telemetry, workflow_builder
+from src.batch_planner import BatchPlanner, parse_seed
+from src.batch_runner import BatchRunner
+from src.job_ledger import JobRow, JobSource, JobJournal
+from src.result_cache import workflow_key
+
+
+class BatchWorker:
+    """
+    后台批量 worker：从 JobQueue 领取任务，流水线式提交到 ComfyUI，归档后把结果写回队列。
+    与 Streamlit 界面运行在不同进程中 (python worker.py)，界面只登记批次、展示进度；
+    浏览器关闭或界面 rerun 不影响正在执行的批次，多个批次、多个用户共用同一个 worker。
+
+    草图模式 (settings["mode"] == "draft") 只跑第一遍采样，SaveImage 接节点 8；
+    选中的草图再以精修批次 (mode == "refine") 只跑放大与第二遍采样，种子与草图相同。
+
+    提供 asset_index 时每张输出归档后计算感知哈希入库；批次设置 reject_duplicates 为真时，
+    与素材库已有图片近重复的输出被删除，任务记为 duplicate。
+    """
+    def __init__(self, queue, agent, archiver, template, result_cache=None, ledger=None, references=None, batcher=None,
+                 asset_index=None, max_in_flight=4, poll_interval=2.0, heartbeat_interval=5.0, job_timeout=300, telemetry_dir=None):
+        """
+        :param queue: JobQueue
+        :param agent: MultiBackendDispatcher (同时作为事件源)
+        :param archiver: AssetManager
+        :param template: 以 workflow_builder.WORKFLOW_BINDINGS 编译的 WorkflowTemplate
+        :param result_cache: ResultCache (可选)，命中时直接复用已归档的图片
+        :param ledger: RunLedger (可选)，记录每个任务的耗时
+        :param references: ReferenceImages (可选)，ControlNet 参考图的预处理与上传
+        :param batcher: LatentBatcher (可选)，批次设置 latent_batch 为真时，把只差种子的相邻任务合并为一次提交
+        :param asset_index: AssetIndex (可选)，归档时登记输出的感知哈希，用于近重复检测
+        :param max_in_flight: 同时排在 ComfyUI 上的任务数 (所有实例合计)
+        :param poll_interval: 队列为空时检查新批次的间隔 (秒)
+        :param telemetry_dir: 遥测导出目录 (需先 telemetry.enable())：每次心跳写入 metrics-{worker}.prom，
+                              每个批次完成时写入 trace-{批次}.json (Chrome trace)
+        """
+        self.queue = queue
+        self.agent = agent
+        self.archiver = archiver
+        self.template = template
+        self.result_cache = result_cache
+        self.ledger = ledger
+        self.references = references
+        self.batcher = batcher
+        self.asset_index = asset_index
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.telemetry_dir = telemetry_dir
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:4]}"
+        self.runner = BatchRunner(agent, max_in_flight=max_in_flight, events=agent, job_timeout=job_timeout)
+        self.stats = {"success": 0, "failed": 0, "cached": 0, "duplicate": 0}
+        self._batches = {}   # 批次 ID -> {"settings", "reference", "planner"}
+        self._journals = {}  # 进度日志路径 -> JobJournal (同一日志的批次共用)
+        self._deferred = set()  # 等待同一进度日志上的其他批次结束、再从头重跑的批次
+        self._prepared = {}  # 任务 ID -> 待提交的工作流
+        self._archiving = [] # (JobResult, 归档 Future, 哈希 Future 或 None) 后台归档中的提交
+        self._stop = threading.Event()
+
+    # === 主循环 ===
+    def run_forever(self):
+        recovered = self.queue.recover(stale_after=self.heartbeat_interval * 6)
+        if recovered:
+            print(f"♻️ 上次中断的 {recovered} 个任务已放回队列")
+        self._beat()
+        beat = threading.Thread(target=self._heartbeat_loop, name="worker-heartbeat", daemon=True)
+        beat.start()
+        print(f"🛠️ worker {self.worker_id} 已启动，等待批次...")
+        try:
+            while not self._stop.is_set():
+                finished = 0
+                for result in self.runner.run(self._groups(), self._submit, refill=self._groups):
+                    self._handle(result)
+                    finished += 1
+                self._drain_archives(wait=True)
+                if self.ledger is not None:
+                    self.ledger.flush()
+                if not finished:
+                    self._stop.wait(self.poll_interval)
+        finally:
+            self._stop.set()
+            self._drain_archives(wait=True)
+            released = self.queue.release(self.worker_id)
+            if released:
+                print(f"↩️ {released} 个未完成的任务已放回队列")
+            for journal in self._journals.values():
+                journal.close()
+            self._journals.clear()
+            self._export_metrics()
+
+    def stop(self):
+        """不再领取新任务，当前在 ComfyUI 上的任务收尾后退出 run_forever()"""
+        self._stop.set()
+
+    def _beat(self):
+        info = dict(self.stats, max_in_flight=self.max_in_flight)
+        backends = getattr(self.agent, "backends", None)
+        if backends is not None:
+            info["backends"] = f"{len(self.agent.healthy_backends)}/{len(backends)}"
+        self.queue.heartbeat(self.worker_id, info)
+        self._export_metrics()
+
+    def _export_metrics(self):
+        tracer = telemetry.tracer()
+        if tracer is not None and self.telemetry_dir:
+            tracer.write_prometheus(os.path.join(self.telemetry_dir, f"metrics-{self.worker_id}.prom"))
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self._beat()
+            except Exception as e:
+                print(f"⚠️ 心跳写入失败: {e}")
+
+    # === 批次展开 ===
+    def _journal(self, path):
+        if path not in self._journals:
+            self._journals[path] = JobJournal(path)
+        return self._journals[path]
+
+    def _expand_queued(self):
+        """把新登记的批次展开为逐行任务 (按模型亲和排序后的顺序)"""
+        deferred = set()
+        while True:
+            queued = self.queue.next_queued(exclude=deferred)
+            if queued is None:
+                return
+            batch_id, settings, _ = queued
+            if not settings.get("resume", True) and self.queue.journal_in_use(settings["journal"]):
+                # 从头重跑要清空进度日志：日志与断点由同一 jobs.csv 的批次共用，等它们全部结束再展开
+                deferred.add(batch_id)
+                if batch_id not in self._deferred:
+                    self._deferred.add(batch_id)
+                    self.queue.set_message(batch_id, "⏳ 同一任务表的其他批次仍在执行，结束后再从头重跑")
+                    print(f"⏳ 批次 {batch_id} 需要清空进度日志，等待使用同一日志的批次结束")
+                continue
+            self._deferred.discard(batch_id)
+            try:
+                count, message = self._expand(batch_id, settings)
+            except Exception as e:
+                self.queue.reject(batch_id, f"展开失败: {e}")
+                print(f"❌ 批次 {batch_id} 展开失败: {e}")
+                continue
+            if count is not None:
+                self.queue.set_message(batch_id, message)
+                print(f"📥 批次 {batch_id}: {count} 个任务" + (f"，{message}" if message else ""))
+
+    def _expand(self, batch_id, settings):
+        source = JobSource(settings["jobs_file"])
+        journal = self._journal(settings["journal"])
+        if not settings.get("resume", True):
+            journal.reset()
+        planner = BatchPlanner(settings["defaults"])
+        # 同一 jobs.csv 的行若仍在别的批次中排队，不再重复加入
+        active = self.queue.active_keys(settings["jobs_file"])
+        duplicates = 0
+
+        def pending_rows():
+            nonlocal duplicates
+            for job in source.iter_pending(journal):
+                if not job.get('prompt', '').strip():
+                    journal.record_skipped(job)
+                elif job.key in active:
+                    duplicates += 1
+                else:
+                    yield job
+
+        count = self.queue.add_tasks(batch_id, ((job.key, job.to_record()) for job in planner.plan(pending_rows())))
+        notes = []
+        if planner.stats["rows"]:
+            notes.append(f"🧩 模型亲和排序: {planner.summary()}")
+        if duplicates:
+            notes.append(f"{duplicates} 行已在其他批次中排队，未重复加入")
+        return count, "；".join(notes) or None
+
+    def _state(self, batch_id):
+        state = self._batches.get(batch_id)
+        if state is None:
+            _, settings, reference = self.queue.batch(batch_id)
+            state = {"settings": settings, "reference": reference, "planner": BatchPlanner(settings["defaults"]),
+                     "started": time.time()}
+            self._batches[batch_id] = state
+        return state
+
+    # === 任务准备与提交 ===
+    def _claimed(self):
+        while not self._stop.is_set():
+            # 执行中登记的批次也会加入轮转
+            self._expand_queued()
+            self._drain_archives()
+            # 开启潜空间批处理时一次领取同一批次的几个相邻任务，才有机会合并
+            tasks = self.queue.claim(self.worker_id, limit=self.batcher.max_batch if self.batcher is not None else 1)
+            if not tasks:
+                return
+            for task in tasks:
+                task["job"] = JobRow.from_record(task["job"])
+                yield task
+
+    def _ready_tasks(self):
+        """领取任务 -> 参考图预处理 (线程池，提前几个任务) -> 组装工作流 / 查结果缓存"""
+        if self.references is not None:
+            tasks = self.references.prefetch(self._claimed(), self._reference_of, lookahead=self.max_in_flight)
+        else:
+            tasks = ((task, None) for task in self._claimed())
+        for task, reference in tasks:
+            if self._prepare(task, reference):
+                yield task
+
+    def _groups(self):
+        """待提交的任务 -> 提交单元 (任务列表)；未开启潜空间批处理时每组只有一个任务"""
+        if self.batcher is None:
+            return ([task] for task in self._ready_tasks())
+        return self.batcher.group(self._ready_tasks(), lambda task: task.get("latent_key"), lambda task: task["latent_cap"])
+
+    def _reference_of(self, task):
+        state = self._state(task["batch"])
+        settings = state["settings"]
+        if settings.get("mode") == "refine":
+            # 精修：草图原样上传 (按内容哈希命名)，作为放大分支的输入
+            return os.path.join(self.archiver.target_dir, task["draft"]), None
+        if settings.get("cn", "None") == "None":
+            return None
+        source = (task["job"].get('cn_image') or '').strip()
+        if source:
+            source = os.path.join(os.path.dirname(settings["jobs_file"]), source)  # 绝对路径时 join 直接返回它
+        else:
+            source = state["reference"]
+        if not source:
+            return None
+        config = state["planner"].resolve(task["job"])
+        return source, (int(config['width']), int(config['height']))
+
+    def _prepare(self, task, reference):
+        """组装工作流；命中结果缓存时直接完成该任务。返回是否需要提交到 ComfyUI"""
+        with telemetry.span("worker.prepare", batch=task["batch"]):
+            return self._prepare_task(task, reference)
+
+    def _prepare_task(self, task, reference):
+        job = task["job"]
+        state = self._state(task["batch"])
+        settings = state["settings"]
+        job_seed = parse_seed(job)
+        config = state["planner"].resolve(job)
+        mode = settings.get("mode")
+        try:
+            image = reference.result() if reference else None
+            if mode == "refine":
+                if image is None:
+                    raise RuntimeError("精修需要 ReferenceImages 上传草图")
+                used_seed = task["seed"]
+                workflow = workflow_builder.build_refine_workflow(
+                    self.template, image, job['prompt'], settings.get("negative", ""), config['ckpt'], config['lora'],
+                    config['lora_strength'], config['upscale_model'] or self.template.default("upscale_model"), used_seed,
+                    job['filename'], dummy_lora=settings.get("dummy_lora"))
+            else:
+                workflow, used_seed = workflow_builder.build_workflow(
+                    self.template, job['prompt'], settings.get("negative", ""), config['width'], config['height'],
+                    config['ckpt'], config['lora'], config['lora_strength'], settings.get("cn", "None"), image,
+                    config['upscale'] and mode != "draft", config['upscale_model'], job_seed, job['filename'],
+                    dummy_lora=settings.get("dummy_lora"))
+            key = workflow_key(workflow)  # 参考图 / 草图文件名即内容哈希
+        except Exception as e:
+            self._journal(settings["journal"]).record_failed(job, str(e))
+            self._finish(task, "failed", f"构建失败: {e}")
+            self.stats["failed"] += 1
+            print(f"❌ 任务 {job['filename']} 构建失败: {e}")
+            return False
+        task["seed"] = used_seed
+        task["cache_key"] = key
+        # 草图批次中行内关闭放大的任务第一遍就是成品：不加 _draft 后缀，同时记入正式进度日志
+        task["is_draft"] = mode == "draft" and bool(config['upscale'])
+        if self.batcher is not None and settings.get("latent_batch") and mode != "refine" and job_seed == -1:
+            # 只差种子 (与文件名) 的任务可以合并为一批；不同批次的任务不合并。
+            # 整批只用一个种子，填写了种子的行合并后无法按自己的种子重现，只合并随机种子 (-1 / 留空) 的行
+            task["latent_key"] = (task["batch"], workflow_key(workflow, ignore=("seed",)))
+            task["latent_cap"] = self.batcher.capacity(config['width'], config['height'], config['upscale'] and config['upscale_model'])
+
+        cached = self.result_cache.lookup(key) if self.result_cache is not None else None
+        if cached:
+            linked = self.archiver.link_cached(cached, self._output_name(task), key[:8])
+            if linked:
+                outputs = [os.path.basename(p) for p in linked]
+                self._record_completed(task, None, outputs)
+                self._finish(task, "cached", outputs=outputs)
+                self._record(task, status="cached", total_time=0, images=len(linked), filename=outputs[0])
+                self.stats["cached"] += 1
+                print(f"♻️ 任务 {job['filename']} 命中结果缓存，跳过生成")
+                return False
+        self._prepared[task["id"]] = workflow
+        return True
+
+    @telemetry.traced("worker.submit")
+    def _submit(self, group):
+        workflow = self._prepared.pop(group[0]["id"])
+        if len(group) > 1:
+            for task in group[1:]:
+                self._prepared.pop(task["id"], None)
+            workflow = workflow_builder.with_batch_size(workflow, len(group))
+            # 整批共用第一个任务的 (随机) 种子，每张图由 (基础种子, 批内序号) 确定
+            for index, task in enumerate(group):
+                task["seed"], task["batch_index"] = group[0]["seed"], index
+        succ, msg = self.agent.send_job(workflow)
+        if succ:
+            journal = self._journal(self._state(group[0]["batch"])["settings"]["journal"])
+            for task in group:
+                journal.record_submitted(task["job"], msg)
+                self.queue.set_prompt(task["id"], msg)
+        return succ, msg
+
+    # === 结果处理 ===
+    def _handle(self, result):
+        group = result.job
+        if result.succeeded:
+            # 归档 (下载 / 搬运) 在后台线程中进行，主循环立即回去补位提交；
+            # 进度日志、队列与台账只在主线程中写入 (_drain_archives)
+            names = [self._output_name(task) for task in group]
+            archived = self.archiver.archive_batch_async(self.agent, result.prompt_id, names)
+            self._archiving.append((result, archived, self._hash_outputs(archived) if self.asset_index is not None else None))
+        else:
+            for task in group:
+                job = task["job"]
+                self._journal(self._state(task["batch"])["settings"]["journal"]).record_failed(job, result.message)
+                self._finish(task, result.status, result.message)
+                self.stats["failed"] += 1
+                print(f"❌ 任务 {job['filename']} 失败 ({result.status}): {result.message}")
+                self._record(task, status=result.status, prompt_id=result.prompt_id, backend=self._backend_of(result),
+                             queue_wait=result.queue_wait, gpu_time=self._share(result.run_time, group),
+                             total_time=result.elapsed)
+        self._drain_archives()
+
+    def _drain_archives(self, wait=False):
+        """处理已归档完成的任务；wait=True 时等待全部完成"""
+        still_running = []
+        for result, future, hashes in self._archiving:
+            if wait or (future.done() and (hashes is None or hashes.done())):
+                self._archived(result, future, hashes)
+            else:
+                still_running.append((result, future, hashes))
+        self._archiving = still_running
+
+    def _hash_outputs(self, archived):
+        """
+        归档完成后在索引的线程池中计算每张输出的感知哈希
+        :return: Future，结果为与任务对应的哈希列表的列表 (归档或哈希计算失败时为 None)，总会完成
+        """
+        hashed = Future()
+
+        def start(future):
+            try:
+                rows, _ = future.result()
+            except Exception:
+                hashed.set_result(None)
+                return
+            try:
+                flat = self.asset_index.hash_async([path for paths in rows for path in paths])
+            except Exception as e:
+                print(f"⚠️ 感知哈希计算失败: {e}")
+                hashed.set_result(None)
+                return
+
+            def split(future):
+                try:
+                    values = iter(future.result())
+                    hashed.set_result([[next(values) for _ in paths] for paths in rows])
+                except Exception as e:
+                    print(f"⚠️ 感知哈希计算失败: {e}")
+                    hashed.set_result(None)
+            flat.add_done_callback(split)
+        archived.add_done_callback(start)
+        return hashed
+
+    def _reject_duplicates(self, task, archived, hashes):
+        """
+        删除与素材库已有图片近重复的输出，其余输出的哈希入库
+        精修结果不与它自己的草图比较
+        :return: (保留的路径列表, 被拒收的 [(文件名, 重复的素材, 距离)])
+        """
+        reject = self._state(task["batch"])["settings"].get("reject_duplicates")
+        exclude = (task["draft"],) if task.get("draft") else ()
+        kept, rejected = [], []
+        for path, value in zip(archived, hashes or [None] * len(archived)):
+            match = self.asset_index.find(value, limit=1, exclude=exclude) if reject and value is not None else []
+            if match:
+                os.remove(path)
+                rejected.append((os.path.basename(path), *match[0]))
+            else:
+                kept.append(path)
+                self.asset_index.add([(path, value)])
+        return kept, rejected
+
+    @telemetry.traced("worker.bookkeeping")
+    def _archived(self, result, future, hashes=None):
+        group = result.job
+        try:
+            archived_rows, transfer_time = future.result()
+        except Exception as e:
+            archived_rows, transfer_time = [[] for _ in group], None
+            print(f"❌ 任务 {group[0]['job']['filename']} 归档出错: {e}")
+        hash_rows = (hashes.result() if hashes is not None else None) or [None] * len(group)
+        for task, archived, task_hashes in zip(group, archived_rows, hash_rows):
+            bookkeeping_start = time.time()
+            job = task["job"]
+            if self.asset_index is not None:
+                archived, rejected = self._reject_duplicates(task, archived, task_hashes)
+                if rejected and not archived:
+                    self._duplicate(task, result, rejected, transfer_time, bookkeeping_start)
+                    continue
+            outputs = [os.path.basename(p) for p in archived]
+            self._record_completed(task, result.prompt_id, outputs)
+            # 批内第 0 张与单独提交的工作流结果相同，其余几张只能由整批重现，不写入结果缓存
+            if self.result_cache is not None and not task.get("batch_index"):
+                self.result_cache.store(task["cache_key"], archived)
+            self._finish(task, "success", outputs=outputs)
+            self.stats["success"] += 1
+            for path in archived:
+                self.archiver.engine.deliver(path, {"job": job['filename'], "prompt": job['prompt'], "seed": task.get("seed"),
+                                                    "batch_index": task.get("batch_index"), "batch": task["batch"],
+                                                    "prompt_id": result.prompt_id})
+            print(f"✅ 任务 {job['filename']} 完成 ({result.elapsed:.1f}s)")
+            self._record(task, status=result.status, prompt_id=result.prompt_id, backend=self._backend_of(result),
+                         queue_wait=result.queue_wait, gpu_time=self._share(result.run_time, group), total_time=result.elapsed,
+                         transfer_time=self._share(transfer_time, group), archive_time=time.time() - bookkeeping_start,
+                         images=len(archived), filename=outputs[0] if outputs else None)
+
+    def _duplicate(self, task, result, rejected, transfer_time, bookkeeping_start):
+        """全部输出都被拒收：该行计为完成 (同样的参数重跑仍会得到重复图)，任务与台账记为 duplicate"""
+        job = task["job"]
+        name, match, distance = rejected[0]
+        message = f"与 {match} 近重复 (距离 {distance})，已删除"
+        self._record_completed(task, result.prompt_id, [])
+        self._finish(task, "duplicate", message)
+        self.stats["duplicate"] += 1
+        print(f"🧬 任务 {job['filename']} 的输出{message}")
+        group = result.job
+        self._record(task, status="duplicate", prompt_id=result.prompt_id, backend=self._backend_of(result),
+                     queue_wait=result.queue_wait, gpu_time=self._share(result.run_time, group), total_time=result.elapsed,
+                     transfer_time=self._share(transfer_time, group), archive_time=time.time() - bookkeeping_start, images=0)
+
+    @staticmethod
+    def _share(seconds, group):
+        """一次提交的 GPU / 传输耗时按张数平摊到组内每个任务，台账中的 GPU 小时与单张成本不会重复计算"""
+        return seconds / len(group) if seconds is not None else None
+
+    def _output_name(self, task):
+        """归档文件名中的任务名：草图加 _draft 后缀，与最终成品区分"""
+        name = task["job"]['filename']
+        return name + "_draft" if task.get("is_draft") else name
+
+    def _record_completed(self, task, prompt_id, outputs):
+        """写入批次的进度日志；草图批次中直接出成品的行同时写入正式进度日志，之后的完整运行不再重跑"""
+        settings = self._state(task["batch"])["settings"]
+        self._journal(settings["journal"]).record_completed(task["job"], prompt_id, outputs)
+        final = settings.get("refine_journal")
+        if settings.get("mode") == "draft" and not task.get("is_draft") and final and final != settings["journal"]:
+            self._journal(final).record_completed(task["job"], prompt_id, outputs)
+
+    def _finish(self, task, status, message=None, outputs=None):
+        if self.queue.finish(task["id"], status, message, outputs, seed=task.get("seed")):
+            self._batch_done(task["batch"])
+
+    def _batch_done(self, batch_id):
+        """
+        批次完成：启用遥测时导出该批次的 Chrome trace；
+        草图批次设置了自动精修时在后台线程中评分，并把得分最高的草图登记为精修批次
+        """
+        state = self._state(batch_id)
+        tracer = telemetry.tracer()
+        if tracer is not None and self.telemetry_dir:
+            path = tracer.write_chrome_trace(os.path.join(self.telemetry_dir, f"trace-{batch_id}.json"), since=state["started"])
+            print(f"🔬 批次 {batch_id} 的耗时追踪已写入 {path}")
+        settings = state["settings"]
+        auto = settings.get("auto_refine") or {}
+        if settings.get("mode") != "draft" or not auto.get("top"):
+            return
+        future = self.archiver.engine.submit_job(draft_scoring.auto_refine, self.queue, batch_id, self.archiver.target_dir,
+                                                 auto.get("scorer", "sharpness"), auto["top"])
+
+        def done(future):
+            try:
+                refine_id = future.result()
+            except Exception as e:
+                print(f"⚠️ 草图批次 {batch_id} 自动精修失败: {e}")
+                return
+            if refine_id:
+                print(f"✨ 草图批次 {batch_id}: 得分最高的 {auto['top']} 张已登记为精修批次 {refine_id}")
+        future.add_done_callback(done)
+
+    def _backend_of(self, result):
+        if result.prompt_id and hasattr(self.agent, "backend_of"):
+            return self.agent.backend_of(result.prompt_id)
+        return None
+
+    def _record(self, task, **fields):
+        if self.ledger is None:
+            return
+        job = task["job"]
+        self.ledger.record(batch=task["batch"], style=self._state(task["batch"])["settings"].get("style", "Batch"),
+                           job=job['filename'], prompt=job['prompt'], seed=task.get("seed"),
+                           batch_index=task.get("batch_index"), **fields)
@@ -1,33 +1,94 @@
 import requests
 import json
+import os
+import threading
+import time
+import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src import telemetry
+
+try:
+    import websocket  # websocket-client，仅事件订阅需要
+except ImportError:
+    websocket = None
+
+# (连接超时, 读取超时) 秒
+DEFAULT_TIMEOUT = (3.05, 30)
+# 健康检查结果的缓存时长 (秒)
+HEALTH_TTL = 5
+
+# 每个后端共享一个 keep-alive 连接池和一份健康检查缓存，
+# 这样每个任务新建 ComfyAgent 也不会重新握手
+_sessions = {}
+_health_cache = {}  # base_url -> (检查时间, 是否在线)
+_registry_lock = threading.Lock()
+
+
+def _get_session(base_url, pool_size=16, retries=True):
+    with _registry_lock:
+        session = _sessions.get((base_url, retries))
+        if session is None:
+            # GET 对瞬时错误 (连接失败 / 502 / 503 / 504) 带抖动指数退避重试；
+            # POST /prompt 不幂等，只在连接未建立时重试，避免重复提交
+            retry = Retry(
+                total=3, connect=3, read=2, status=2,
+                backoff_factor=0.3, backoff_jitter=0.3,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False,
+            ) if retries else 0
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[(base_url, retries)] = session
+        return session
+
 
 class ComfyAgent:
     """
     负责与 ComfyUI 后端 API 进行 HTTP 通信的代理。
+    同一 base_url 的所有实例共享连接池，所有请求都带超时。
     """
-    def __init__(self, base_url="http://127.0.0.1:8188"):
+    def __init__(self, base_url="http://127.0.0.1:8188", client_id=None, timeout=DEFAULT_TIMEOUT):
         self.base_url = base_url
         self.prompt_url = f"{base_url}/prompt"
+        self.history_url = f"{base_url}/history"
+        # clientId 让 ComfyUI 把本客户端提交的任务事件推送到对应的 WebSocket
+        self.client_id = client_id or uuid.uuid4().hex
+        self.timeout = timeout
+        self.session = _get_session(base_url)
 
-    def is_server_ready(self):
+    def is_server_ready(self, max_age=HEALTH_TTL, retries=True):
         """
         检查 ComfyUI 服务器是否在线
+        :param max_age: 复用 max_age 秒内的检查结果，传 0 强制重新探测
+        :param retries: False 时只探测一次 (不做退避重试)，用于需要快速发现宕机的场景
         """
+        checked_at, ready = _health_cache.get(self.base_url, (0, False))
+        if time.time() - checked_at < max_age:
+            return ready
+        session = self.session if retries else _get_session(self.base_url, pool_size=1, retries=False)
         try:
-            response = requests.get(self.base_url)
-            return response.status_code == 200
+            response = session.get(self.base_url, timeout=self.timeout)
+            ready = response.status_code == 200
         except requests.RequestException:
-            return False
+            ready = False
+        _health_cache[self.base_url] = (time.time(), ready)
+        return ready
 
+    @telemetry.traced("comfy.send_job")
     def send_job(self, workflow_data):
         """
         将工作流数据 (JSON) 发送给 ComfyUI 执行
         :param workflow_data: 字典格式的工作流
         :return: (bool success, str message_or_id)
         """
-        payload = {"prompt": workflow_data}
+        payload = {"prompt": workflow_data, "client_id": self.client_id}
         try:
-            response = requests.post(self.prompt_url, json=payload)
+            response = self.session.post(self.prompt_url, json=payload, timeout=self.timeout)
             
             if response.status_code == 200:
                 job_id = response.json().get('prompt_id')
@@ -36,4 +97,384 @@ class ComfyAgent:
                 return False, f"HTTP错误: {response.text}"
                 
         except requests.RequestException as e:
-            return False, f"连接异常: {str(e)}"
\ No newline at end of file
+            # 连接出错时作废健康缓存，下一次检查重新探测
+            _health_cache.pop(self.base_url, None)
+            return False, f"连接异常: {str(e)}"
+
+    def get_history(self, prompt_id):
+        """
+        查询指定任务的执行记录
+        :return: dict (任务尚未完成或查询失败时返回 None)
+        """
+        try:
+            response = self.session.get(f"{self.history_url}/{prompt_id}", timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            return response.json().get(prompt_id)
+        except (requests.RequestException, ValueError):
+            return None
+
+    def get_job_status(self, prompt_id):
+        """
+        查询任务状态
+        :return: "success" / "failed"，仍在排队或执行中返回 None
+        """
+        entry = self.get_history(prompt_id)
+        if entry is None:
+            return None
+        status = entry.get("status", {})
+        if status.get("status_str") == "error":
+            return "failed"
+        if status.get("completed", True):
+            return "success"
+        return None
+
+    def get_object_info(self, node_class=None):
+        """
+        查询 /object_info (节点定义，包含各加载节点可选的模型文件列表)
+        :param node_class: 只查询一个节点类型，例如 "CheckpointLoaderSimple"
+        :return: dict (查询失败返回 None)
+        """
+        url = f"{self.base_url}/object_info" + (f"/{node_class}" if node_class else "")
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            return response.json()
+        except (requests.RequestException, ValueError):
+            return None
+
+    def get_history_timing(self, prompt_id):
+        """
+        从 /history 的 status.messages 读取任务的开始 / 结束时间 (ComfyUI 服务器时钟，毫秒转为秒)
+        服务器时钟与本机不同步，只适合计算两者之差 (执行耗时)，不能与本机时间相减
+        :return: (开始执行时间, 执行结束时间)，缺失的一项为 None
+        """
+        history = self.get_history(prompt_id)
+        if not history:
+            return None, None
+        started = ended = None
+        for message in history.get("status", {}).get("messages", []):
+            if not isinstance(message, (list, tuple)) or len(message) != 2 or not isinstance(message[1], dict):
+                continue
+            event, data = message
+            timestamp = data.get("timestamp")
+            if timestamp is None:
+                continue
+            if event == "execution_start":
+                started = timestamp / 1000
+            elif event in ("execution_success", "execution_error", "execution_interrupted"):
+                ended = timestamp / 1000
+        return started, ended
+
+    def get_queue_depth(self):
+        """
+        查询 /queue 中正在执行与排队的任务总数
+        :return: int (查询失败返回 None)
+        """
+        try:
+            response = self.session.get(f"{self.base_url}/queue", timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            data = response.json()
+            return len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+        except (requests.RequestException, ValueError):
+            return None
+
+    @telemetry.traced("comfy.get_outputs")
+    def get_outputs(self, prompt_id, wait=3.0):
+        """
+        从 /history 读取任务的精确输出文件列表
+        ComfyUI 先推送完成事件、后写入 history，因此这里会短暂等待记录出现
+        :param wait: 等待 history 记录出现的最长秒数
+        :return: [{"filename", "subfolder", "type"}, ...]，按节点 ID 与输出顺序排列
+        """
+        deadline = time.time() + wait
+        entry = self.get_history(prompt_id)
+        while entry is None and time.time() < deadline:
+            time.sleep(0.1)
+            entry = self.get_history(prompt_id)
+        if entry is None:
+            return []
+
+        files = []
+        outputs = entry.get("outputs", {})
+        for node_id in sorted(outputs, key=lambda n: (len(n), n)):
+            for image in outputs[node_id].get("images", []):
+                # temp 类型是预览图 (PreviewImage)，不归档
+                if image.get("type", "output") == "output":
+                    files.append(image)
+        return files
+
+    @telemetry.traced("comfy.download")
+    def download_output(self, image, dst_path, chunk_size=1024 * 1024):
+        """
+        通过 /view 分块下载输出文件，不会把整张 4K 图读入内存
+        先写入 .part 临时文件，完成后原子替换，避免留下半截文件
+        :param image: get_outputs() 返回的单个文件描述
+        :return: 写入的字节数
+        """
+        params = {"filename": image["filename"], "subfolder": image.get("subfolder", ""), "type": image.get("type", "output")}
+        tmp_path = dst_path + ".part"
+        written = 0
+        try:
+            with self.session.get(f"{self.base_url}/view", params=params, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return written
+
+    @telemetry.traced("comfy.upload")
+    def upload_image(self, data, filename, overwrite=True):
+        """
+        通过 /upload/image 把图片上传到 ComfyUI 的 input 目录，不需要共享文件系统
+        :param data: 图片字节
+        :return: (bool success, str 服务器上的文件名或错误信息)
+        """
+        files = {"image": (filename, data, "image/png")}
+        form = {"type": "input", "overwrite": "true" if overwrite else "false"}
+        try:
+            response = self.session.post(f"{self.base_url}/upload/image", files=files, data=form, timeout=self.timeout)
+            if response.status_code != 200:
+                return False, f"HTTP错误: {response.text}"
+            result = response.json()
+            name = result.get("name", filename)
+            return True, f"{result['subfolder']}/{name}" if result.get("subfolder") else name
+        except (requests.RequestException, ValueError) as e:
+            return False, f"上传失败: {str(e)}"
+
+    def has_input_image(self, filename):
+        """input 目录中是否已有该文件 (只读取响应头)"""
+        params = {"filename": filename, "subfolder": "", "type": "input"}
+        try:
+            with self.session.get(f"{self.base_url}/view", params=params, stream=True, timeout=self.timeout) as response:
+                return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def open_event_stream(self, timeout=5):
+        """
+        建立 WebSocket 事件订阅
+        :return: 已启动的 ComfyEventStream (未安装 websocket-client 或连接失败时返回 None)
+        """
+        if websocket is None:
+            print("⚠️ 警告：未安装 websocket-client，无法订阅 ComfyUI 事件流")
+            return None
+        stream = ComfyEventStream(self.base_url, self.client_id)
+        if not stream.start(timeout=timeout):
+            return None
+        return stream
+
+
+class ComfyEventStream:
+    """
+    订阅 ComfyUI 的 /ws?clientId= 事件流。
+    按 prompt_id 分发 executing / progress / executed / execution_error 等事件，
+    并提供无需轮询的等待接口 (wait / wait_any / wait_all)。
+    """
+    FAILED_EVENTS = ("execution_error", "execution_interrupted")
+
+    def __init__(self, base_url, client_id):
+        ws_base = base_url.replace("https://", "wss://").replace("http://", "ws://")
+        self.ws_url = f"{ws_base}/ws?clientId={client_id}"
+        self.client_id = client_id
+        self.connected = False
+
+        self._ws = None
+        self._thread = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._results = {}      # prompt_id -> (status, data)，status 为 success / failed
+        self._progress = {}     # prompt_id -> (value, max)
+        self._timing = {}       # prompt_id -> [开始执行时间, 结束时间] (本机时钟)
+        self._current = None    # 正在执行的 prompt_id (旧版 progress 事件不带 prompt_id)
+        self._listeners = []
+
+    # === 生命周期 ===
+    def start(self, timeout=5):
+        """连接 WebSocket 并启动后台接收线程，返回是否连接成功"""
+        if not self._connect(timeout):
+            return False
+        self._thread = threading.Thread(target=self._run, name="comfy-events", daemon=True)
+        self._thread.start()
+        return True
+
+    def close(self):
+        self._closed = True
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        with self._cond:
+            self._cond.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self, timeout):
+        try:
+            ws = websocket.WebSocket()
+            ws.connect(self.ws_url, timeout=timeout)
+            ws.settimeout(None)
+        except Exception as e:
+            print(f"⚠️ 事件流连接失败: {e}")
+            return False
+        self._ws = ws
+        with self._cond:
+            self.connected = True
+            self._cond.notify_all()
+        return True
+
+    def _run(self):
+        """后台线程：接收消息，断线后按退避间隔自动重连"""
+        backoff = 0.5
+        while not self._closed:
+            try:
+                while not self._closed:
+                    message = self._ws.recv()
+                    if isinstance(message, str):
+                        self._dispatch(json.loads(message))
+                backoff = 0.5
+            except Exception:
+                pass
+            with self._cond:
+                self.connected = False
+                self._cond.notify_all()
+            if self._closed:
+                break
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10)
+            self._connect(timeout=5)
+
+    # === 事件分发 ===
+    def add_listener(self, callback):
+        """注册回调 callback(event_type, prompt_id, data)，在接收线程中调用"""
+        self._listeners.append(callback)
+
+    def _dispatch(self, message):
+        event = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+
+        with self._cond:
+            if event == "executing":
+                if prompt_id is None:
+                    prompt_id = self._current
+                if data.get("node") is None:
+                    # node 为空表示该 prompt 全部执行完毕
+                    self._finish(prompt_id, "success", data)
+                    self._current = None
+                else:
+                    self._current = prompt_id
+            elif event == "execution_start":
+                self._current = prompt_id
+                if prompt_id is not None:
+                    self._timing[prompt_id] = [time.time(), None]
+            elif event == "progress":
+                prompt_id = prompt_id or self._current
+                self._progress[prompt_id] = (data.get("value", 0), data.get("max", 0))
+            elif event == "execution_success":
+                self._finish(prompt_id, "success", data)
+            elif event in self.FAILED_EVENTS:
+                self._finish(prompt_id, "failed", data)
+
+        for callback in self._listeners:
+            try:
+                callback(event, prompt_id, data)
+            except Exception as e:
+                print(f"⚠️ 事件回调异常: {e}")
+
+    def _finish(self, prompt_id, status, data):
+        if prompt_id is None:
+            return
+        # 出错后 ComfyUI 仍可能补发 executing(node=None)，不能覆盖失败状态
+        if self._results.get(prompt_id, ("",))[0] == "failed":
+            return
+        self._results[prompt_id] = (status, data)
+        self._timing.setdefault(prompt_id, [None, None])[1] = time.time()
+        self._progress.pop(prompt_id, None)
+        self._cond.notify_all()
+
+    # === 查询与等待 ===
+    def get_status(self, prompt_id):
+        """返回 "success" / "failed"，未结束返回 None"""
+        with self._cond:
+            result = self._results.get(prompt_id)
+        return result[0] if result else None
+
+    def get_error(self, prompt_id):
+        """返回失败任务的错误信息 (execution_error 事件中的 exception_message)"""
+        with self._cond:
+            status, data = self._results.get(prompt_id, (None, {}))
+        if status != "failed":
+            return ""
+        return data.get("exception_message", "执行被中断")
+
+    def get_progress(self, prompt_id):
+        """返回 (当前步数, 总步数)，尚未开始采样时为 (0, 0)"""
+        with self._cond:
+            return self._progress.get(prompt_id, (0, 0))
+
+    def get_timing(self, prompt_id):
+        """
+        返回 (开始执行时间, 执行结束时间)，取自事件到达本机的时刻；未收到对应事件的一项为 None
+        """
+        with self._cond:
+            started, ended = self._timing.get(prompt_id, (None, None))
+        return started, ended
+
+    def forget(self, prompt_id):
+        """释放已处理完的任务记录"""
+        with self._cond:
+            self._results.pop(prompt_id, None)
+            self._progress.pop(prompt_id, None)
+            self._timing.pop(prompt_id, None)
+
+    def wait(self, prompt_id, timeout=None):
+        """
+        阻塞等待单个任务结束
+        :return: "success" / "failed"，超时或连接断开返回 None
+        """
+        finished = self.wait_any([prompt_id], timeout)
+        return finished.get(prompt_id)
+
+    def wait_any(self, prompt_ids, timeout=None):
+        """
+        阻塞直到任意一个任务结束
+        :return: dict {prompt_id: status}，包含此刻所有已结束的任务；超时或连接断开返回空字典
+        """
+        return self._wait(prompt_ids, timeout, wait_all=False)
+
+    def wait_all(self, prompt_ids, timeout=None):
+        """
+        阻塞直到全部任务结束
+        :return: dict {prompt_id: status}，超时或连接断开时只包含已结束的部分
+        """
+        return self._wait(prompt_ids, timeout, wait_all=True)
+
+    def _wait(self, prompt_ids, timeout, wait_all):
+        prompt_ids = list(prompt_ids)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                finished = {pid: self._results[pid][0] for pid in prompt_ids if pid in self._results}
+                if finished and (not wait_all or len(finished) == len(prompt_ids)):
+                    return finished
+                if self._closed or not self.connected:
+                    return finished
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return finished
+                self._cond.wait(remaining)
@@ -1,5 +1,9 @@
 import json
+import os
 import random
+import threading
+
+from src import telemetry
 
 class WorkflowModifier:
     """
@@ -7,7 +11,8 @@ class WorkflowModifier:
     """
     def __init__(self, template_path):
         self.template_path = template_path
-        self.workflow_data = self._load_template()
+        with telemetry.span("workflow.load"):
+            self.workflow_data = self._load_template()
 
     def _load_template(self):
         """加载 JSON 模板"""
@@ -17,6 +22,7 @@ class WorkflowModifier:
         except FileNotFoundError:
             raise FileNotFoundError(f"❌ 致命错误：找不到模板文件 {self.template_path}")
 
+    @telemetry.traced("workflow.patch")
     def update_prompt(self, node_id, new_text):
         """修改指定节点的提示词"""
         # 注意：这里需要你确认 JSON 里的 ID 是否匹配
@@ -25,6 +31,7 @@ class WorkflowModifier:
         else:
             print(f"⚠️ 警告：节点 ID {node_id} 不存在，跳过修改。")
 
+    @telemetry.traced("workflow.patch")
     def randomize_seed(self, node_id):
         """注入随机种子"""
         new_seed = random.randint(1, 10**14)
@@ -34,4 +41,150 @@ class WorkflowModifier:
 
     def get_workflow(self):
         """返回修改后的数据"""
-        return self.workflow_data
\ No newline at end of file
+        return self.workflow_data
+
+
+class WorkflowTemplate:
+    """
+    编译后的工作流模板。
+    模板 JSON 只加载、解析一次；具名参数 (prompt、seed、ckpt ...) 通过绑定表
+    映射到一个或多个 (节点 ID, 输入名)。每个任务调用 render() 得到一份浅拷贝，
+    只有取值发生变化的节点才会被复制和修改，其余节点与模板共享。
+
+    注意：render() 的结果与模板共享未修改的节点，只能读取或直接发送，不要原地修改。
+    """
+    def __init__(self, workflow_data, bindings):
+        """
+        :param workflow_data: 解析后的工作流字典
+        :param bindings: {参数名: [(节点 ID, 输入名), ...]}
+        """
+        self.workflow_data = workflow_data
+        self.bindings = {}
+        for name, paths in bindings.items():
+            compiled = []
+            for node_id, input_name in paths:
+                if node_id not in workflow_data:
+                    raise KeyError(f"❌ 绑定 {name} 引用了不存在的节点 {node_id}")
+                if "inputs" not in workflow_data[node_id]:
+                    raise KeyError(f"❌ 绑定 {name} 的节点 {node_id} 没有 inputs")
+                compiled.append((node_id, input_name))
+            self.bindings[name] = tuple(compiled)
+
+    @classmethod
+    def from_file(cls, template_path, bindings):
+        try:
+            with open(template_path, "r", encoding="utf-8") as f:
+                return cls(json.load(f), bindings)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"❌ 致命错误：找不到模板文件 {template_path}")
+
+    def default(self, name):
+        """返回参数在模板中的原始取值 (取第一个绑定位置)"""
+        node_id, input_name = self.bindings[name][0]
+        return self.workflow_data[node_id]["inputs"].get(input_name)
+
+    @telemetry.traced("workflow.render")
+    def render(self, **params):
+        """
+        生成一个任务的工作流
+        :param params: 具名参数，例如 render(prompt="1girl", seed=1001)
+        :return: 可直接交给 ComfyAgent.send_job 的工作流字典
+        """
+        workflow = dict(self.workflow_data)
+        copied = set()
+        for name, value in params.items():
+            paths = self.bindings.get(name)
+            if paths is None:
+                raise KeyError(f"❌ 未定义的模板参数: {name}")
+            for node_id, input_name in paths:
+                node = workflow[node_id]
+                if node["inputs"].get(input_name) == value:
+                    continue
+                if node_id not in copied:
+                    node = dict(node)
+                    node["inputs"] = dict(node["inputs"])
+                    workflow[node_id] = node
+                    copied.add(node_id)
+                node["inputs"][input_name] = value
+        return workflow
+
+# 输出节点：编译时从这些节点沿连线反向遍历，到不了的节点不影响结果
+OUTPUT_NODE_TYPES = ("SaveImage", "PreviewImage")
+# 可旁路的中性节点：类型 -> (是否中性, {输出序号: 透传的输入名})
+# 权重为 0 的 LoRA / ControlNet 不改变结果，下游连线直接接到它的输入上，ComfyUI 就不会加载对应的模型
+BYPASS_RULES = {
+    "LoraLoader": (lambda inputs: inputs.get("strength_model") == 0 and inputs.get("strength_clip") == 0, {0: "model", 1: "clip"}),
+    "LoraLoaderModelOnly": (lambda inputs: inputs.get("strength_model") == 0, {0: "model"}),
+    "ControlNetApplyAdvanced": (lambda inputs: inputs.get("strength") == 0, {0: "positive", 1: "negative"}),
+    "ControlNetApply": (lambda inputs: inputs.get("strength") == 0, {0: "conditioning"}),
+}
+
+
+def _is_link(value):
+    """[节点 ID, 输出序号] 形式的连线"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+@telemetry.traced("workflow.compile")
+def compile_workflow(workflow_data, output_types=OUTPUT_NODE_TYPES):
+    """
+    编译工作流图 (发送前调用)：
+    1. 旁路中性节点 (BYPASS_RULES)：下游连线改接到它的输入，可连续旁路多个；
+    2. 死节点消除：从输出节点沿连线反向遍历，删除不可达的节点
+       (例如关闭放大时的放大模型与第二遍采样、旁路后的 ControlNet 加载与预处理)。
+    返回新的工作流字典，只复制连线被改写的节点，输入的工作流不变；没有输出节点时原样返回。
+    """
+    bypass = {}
+    for node_id, node in workflow_data.items():
+        rule = BYPASS_RULES.get(node.get("class_type"))
+        if rule and rule[0](node.get("inputs", {})):
+            bypass[node_id] = rule[1]
+
+    def resolve(link):
+        seen = set()
+        while link[0] in bypass and link[0] not in seen:
+            seen.add(link[0])
+            input_name = bypass[link[0]].get(link[1])
+            upstream = workflow_data[link[0]].get("inputs", {}).get(input_name) if input_name else None
+            if not _is_link(upstream):
+                break
+            link = upstream
+        return link
+
+    stack = [node_id for node_id, node in workflow_data.items() if node.get("class_type") in output_types]
+    if not stack:
+        return workflow_data
+    reached = {}
+    while stack:
+        node_id = stack.pop()
+        if node_id in reached or node_id not in workflow_data:
+            continue
+        node = workflow_data[node_id]
+        inputs = node.get("inputs", {})
+        rewired = {name: resolve(value) if _is_link(value) else value for name, value in inputs.items()}
+        if any(rewired[name] is not inputs[name] for name in inputs):
+            node = dict(node, inputs=rewired)
+        reached[node_id] = node
+        stack.extend(value[0] for value in rewired.values() if _is_link(value))
+    return {node_id: reached[node_id] for node_id in workflow_data if node_id in reached}
+
+
+# 已编译模板缓存：(模板路径, 绑定表) -> (文件 mtime, WorkflowTemplate)
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def load_template(template_path, bindings):
+    """
+    加载并编译模板，同一文件只解析一次；模板文件被修改后自动重新编译
+    """
+    key = (os.path.abspath(template_path), tuple(sorted((k, tuple(map(tuple, v))) for k, v in bindings.items())))
+    mtime = os.path.getmtime(template_path) if os.path.exists(template_path) else None
+    with _templates_lock:
+        cached = _templates.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    template = WorkflowTemplate.from_file(template_path, bindings)
+    with _templates_lock:
+        _templates[key] = (mtime, template)
+    return template
@@ -0,0 +1,56 @@
+import os
+
+# 草图评分钩子：名称 -> score(草图路径, 任务行) -> float，分数越高越值得精修
+SCORERS = {}
+
+
+def register_scorer(name):
+    """
+    注册草图评分钩子 (装饰器)，例如接入美学评分模型:
+        @register_scorer("aesthetic")
+        def aesthetic(path, job): ...
+    """
+    def decorator(fn):
+        SCORERS[name] = fn
+        return fn
+    return decorator
+
+
+@register_scorer("sharpness")
+def sharpness(path, job):
+    """清晰度：灰度图拉普拉斯响应的方差 (缩到 256 像素以内计算)，发糊 / 崩坏的草图得分低"""
+    from PIL import Image, ImageFilter, ImageStat
+
+    with Image.open(path) as img:
+        gray = img.convert("L")
+    gray.thumbnail((256, 256))
+    edges = gray.filter(ImageFilter.Kernel((3, 3), (0, -1, 0, -1, 4, -1, 0, -1, 0), scale=1, offset=128))
+    return ImageStat.Stat(edges).var[0]
+
+
+def score_drafts(queue, batch_id, output_dir, scorer="sharpness"):
+    """
+    给草图批次中的每张草图打分并写回队列 (界面按分数排序展示)
+    :return: {任务 ID: 分数}
+    """
+    score = SCORERS[scorer]
+    scores = {}
+    for draft in queue.drafts(batch_id):
+        if not draft["outputs"]:
+            continue
+        try:
+            scores[draft["id"]] = score(os.path.join(output_dir, draft["outputs"][0]), draft["job"])
+        except Exception as e:
+            print(f"⚠️ 草图 {draft['outputs'][0]} 评分失败: {e}")
+    queue.set_scores(scores)
+    return scores
+
+
+def auto_refine(queue, batch_id, output_dir, scorer="sharpness", top=0):
+    """
+    草图批次完成后自动挑选：打分，把得分最高的 top 张登记为精修批次
+    :return: 精修批次 ID；没有选中任何草图时返回 None
+    """
+    scores = score_drafts(queue, batch_id, output_dir, scorer)
+    chosen = sorted(scores, key=scores.get, reverse=True)[:top]
+    return queue.enqueue_refine(batch_id, chosen) if chosen else None
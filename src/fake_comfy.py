@@ -0,0 +1,483 @@
+import base64
+import hashlib
+import json
+import os
+import queue
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def make_png(width, height, seed=0):
+    """生成一张纯色的合法 PNG (不依赖 PIL)"""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    color = bytes(((seed * 67) % 256, (seed * 131) % 256, (seed * 197) % 256))
+    raw = (b"\x00" + color * width) * height
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def _reachable(workflow, output_types=("SaveImage", "PreviewImage")):
+    """输出节点及其全部上游节点的 ID"""
+    stack = [node_id for node_id, node in workflow.items() if node.get("class_type") in output_types]
+    seen = set()
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen or node_id not in workflow:
+            continue
+        seen.add(node_id)
+        for value in workflow[node_id].get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                stack.append(value[0])
+    return seen
+
+
+class FakeComfyServer:
+    """
+    本地模拟的 ComfyUI 服务，用于离线调试和测试。
+    实现 /、/prompt、/history、/queue、/view 以及 /ws 事件流，
+    按 FIFO 顺序"执行"任务，把纯色 PNG 写入输出目录，并像真实 ComfyUI 一样推送 WebSocket 事件。
+    """
+    # /object_info 中各加载节点可选的模型文件
+    DEFAULT_MODELS = {
+        "CheckpointLoaderSimple": ("ckpt_name", ["anything-v5-PrtRE.safetensors", "realisticVisionV51.safetensors"]),
+        "LoraLoader": ("lora_name", ["blindbox_v1_mix.safetensors"]),
+        "ControlNetLoader": ("control_net_name", ["control_v11p_sd15_openpose.pth", "control_v11p_sd15_canny.pth"]),
+        "UpscaleModelLoader": ("model_name", ["4x-UltraSharp.pth"]),
+    }
+
+    def __init__(self, host="127.0.0.1", port=0, exec_time=0.05, output_dir=None, image_size=(64, 64), models=None,
+                 fail_rate=0.0, http_latency=0.0, seed=None, batch_cost=0.35, hires_cost=1.5):
+        """
+        :param port: 0 表示由系统分配空闲端口
+        :param exec_time: 模拟每个任务的 GPU 执行耗时 (秒)
+        :param output_dir: 模拟 ComfyUI 的 output 目录，默认使用临时目录
+        :param image_size: 输出图片的 (宽, 高)
+        :param models: {节点类型: (输入名, [文件名, ...])}，默认使用 DEFAULT_MODELS
+        :param fail_rate: 任务执行失败 (推送 execution_error) 的概率
+        :param http_latency: 每个 HTTP 请求额外的响应延迟 (秒)，模拟远程 / 繁忙的服务器
+        :param seed: 失败抽样的随机种子，便于复现
+        :param batch_cost: 潜空间批处理 (EmptyLatentImage batch_size > 1) 时每多一张图增加的采样耗时比例，
+                           模拟 GPU 批量计算的摊薄效果
+        :param hires_cost: 放大后第二遍采样 (latent 来自 VAEEncode 而非 EmptyLatentImage) 相对第一遍的耗时倍数
+        """
+        self.hires_cost = hires_cost
+        self.batch_cost = batch_cost
+        self.fail_rate = fail_rate
+        self.http_latency = http_latency
+        self._rng = random.Random(seed)
+        self.models = dict(self.DEFAULT_MODELS if models is None else models)
+        self.exec_time = exec_time
+        self.output_dir = output_dir or tempfile.mkdtemp(prefix="fake_comfy_")
+        self.input_dir = os.path.join(self.output_dir, "_input")
+        self.image_size = image_size
+        os.makedirs(self.input_dir, exist_ok=True)
+        self._counter = 0
+        self.uploads = 0  # 收到的 /upload/image 次数
+        self.history = {}
+        self.running = None
+        self.pending = []
+
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._clients = {}  # client_id -> _FakeComfyHandler
+        self._connections = set()  # 所有客户端连接，stop() 时一并断开，模拟进程崩溃
+        self._ws_blocked_until = 0  # 在此之前拒绝新的 WebSocket 连接 (drop_websockets)
+        self._stopped = False
+        self._httpd = ThreadingHTTPServer((host, port), _FakeComfyHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._threads = []
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        for target in (self._httpd.serve_forever, self._worker):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._jobs.put(None)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def drop_websockets(self, reject_for=0.0):
+        """
+        断开所有 WebSocket 连接 (HTTP 照常服务)，模拟网络抖动导致事件流中断
+        :param reject_for: 之后多少秒内拒绝重新连接
+        """
+        self._ws_blocked_until = time.time() + reject_for
+        with self._lock:
+            handlers = list(self._clients.values())
+        for handler in handlers:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # === 任务处理 ===
+    def submit(self, workflow, client_id=None):
+        prompt_id = str(uuid.uuid4())
+        with self._lock:
+            self.pending.append(prompt_id)
+        self._jobs.put((prompt_id, workflow, client_id))
+        self.broadcast_status()
+        return prompt_id
+
+    def queue_info(self):
+        with self._lock:
+            running = [[0, self.running]] if self.running else []
+            pending = [[i + 1, pid] for i, pid in enumerate(self.pending)]
+        return {"queue_running": running, "queue_pending": pending}
+
+    def _worker(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            prompt_id, workflow, client_id = item
+            if self._stopped:
+                return
+            with self._lock:
+                self.pending.remove(prompt_id)
+                self.running = prompt_id
+            self._execute(prompt_id, workflow, client_id)
+            with self._lock:
+                self.running = None
+            self.broadcast_status()
+
+    def _execute(self, prompt_id, workflow, client_id):
+        started_ms = int(time.time() * 1000)
+        self.send_event("execution_start", {"prompt_id": prompt_id, "timestamp": started_ms}, client_id)
+        steps = 4
+        outputs = {}
+        batch_size = max([int(node["inputs"].get("batch_size", 1)) for node in workflow.values()
+                          if node.get("class_type") == "EmptyLatentImage"] or [1])
+        sample_time = self.exec_time * (1 + (batch_size - 1) * self.batch_cost)
+        # 与 ComfyUI 一致：只执行输出节点依赖的节点
+        needed = _reachable(workflow)
+        for node_id, node in workflow.items():
+            if self._stopped:
+                return
+            if node_id not in needed:
+                continue
+            self.send_event("executing", {"node": node_id, "prompt_id": prompt_id}, client_id)
+            if node.get("class_type") == "KSampler":
+                latent = node["inputs"].get("latent_image")
+                hires = isinstance(latent, list) and workflow.get(latent[0], {}).get("class_type") != "EmptyLatentImage"
+                for step in range(1, steps + 1):
+                    time.sleep(sample_time * (self.hires_cost if hires else 1) / steps)
+                    self.send_event("progress", {"value": step, "max": steps, "prompt_id": prompt_id, "node": node_id}, client_id)
+            if node.get("class_type") == "SaveImage":
+                if self.fail_rate and self._rng.random() < self.fail_rate:
+                    return self._fail(prompt_id, workflow, client_id, node_id, started_ms)
+                outputs[node_id] = {"images": self._save_outputs(prompt_id, node_id, node, batch_size)}
+                self.send_event("executed", {"node": node_id, "prompt_id": prompt_id, "output": outputs[node_id]}, client_id)
+
+        # 与真实 ComfyUI 一致：先推送完成事件，再写入 history
+        self.send_event("executing", {"node": None, "prompt_id": prompt_id}, client_id)
+        messages = [
+            ["execution_start", {"prompt_id": prompt_id, "timestamp": started_ms}],
+            ["execution_success", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}],
+        ]
+        with self._lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, workflow, {"client_id": client_id}, list(outputs)],
+                "outputs": outputs,
+                "status": {"status_str": "success", "completed": True, "messages": messages},
+            }
+
+    def _fail(self, prompt_id, workflow, client_id, node_id, started_ms):
+        error = {"prompt_id": prompt_id, "node_id": node_id, "exception_type": "RuntimeError",
+                 "exception_message": "模拟执行失败", "timestamp": int(time.time() * 1000)}
+        self.send_event("execution_error", error, client_id)
+        with self._lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, workflow, {"client_id": client_id}, []],
+                "outputs": {},
+                "status": {"status_str": "error", "completed": False, "messages": [
+                    ["execution_start", {"prompt_id": prompt_id, "timestamp": started_ms}],
+                    ["execution_error", error],
+                ]},
+            }
+
+    def _save_outputs(self, prompt_id, node_id, node, batch_size=1):
+        """与 ComfyUI 一致：一批图片按批内顺序编号保存"""
+        prefix = node.get("inputs", {}).get("filename_prefix", "ComfyUI")
+        images = []
+        for _ in range(batch_size):
+            with self._lock:
+                self._counter += 1
+                counter = self._counter
+            filename = f"{prefix}_{counter:05d}_.png"
+            with open(os.path.join(self.output_dir, filename), "wb") as f:
+                f.write(make_png(*self.image_size, seed=counter))
+            images.append({"filename": filename, "subfolder": "", "type": "output"})
+        return images
+
+    # === WebSocket 推送 ===
+    def send_event(self, event, data, client_id=None):
+        message = json.dumps({"type": event, "data": data})
+        with self._lock:
+            if client_id is None:
+                targets = list(self._clients.values())
+            else:
+                targets = [self._clients[client_id]] if client_id in self._clients else []
+        for handler in targets:
+            handler.ws_send(message)
+
+    def object_info(self, node_class=None):
+        """与 ComfyUI 相同的结构：模型列表位于 input.required.<输入名>[0]"""
+        info = {}
+        for class_type, (input_name, files) in self.models.items():
+            if node_class is None or node_class == class_type:
+                info[class_type] = {"input": {"required": {input_name: [list(files)]}}, "output": [], "name": class_type}
+        return info
+
+    def broadcast_status(self):
+        with self._lock:
+            remaining = len(self.pending) + (1 if self.running else 0)
+        self.send_event("status", {"status": {"exec_info": {"queue_remaining": remaining}}})
+
+
+class _FakeComfyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # 关闭 Nagle，避免 keep-alive 连接上 header/body 分包带来的 40ms 延迟
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.fake._lock:
+            self.fake._connections.add(self.connection)
+
+    def finish(self):
+        with self.fake._lock:
+            self.fake._connections.discard(self.connection)
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/ws":
+            return self._serve_websocket(parse_qs(url.query).get("clientId", [None])[0])
+        if self.fake.http_latency:
+            time.sleep(self.fake.http_latency)
+        if url.path == "/":
+            return self._send_json({})
+        if url.path == "/queue":
+            return self._send_json(self.fake.queue_info())
+        if url.path == "/history":
+            with self.fake._lock:
+                history = dict(self.fake.history)
+            return self._send_json(history)
+        if url.path.startswith("/history/"):
+            prompt_id = url.path[len("/history/"):]
+            with self.fake._lock:
+                entry = self.fake.history.get(prompt_id)
+            return self._send_json({prompt_id: entry} if entry else {})
+        if url.path == "/view":
+            return self._send_file(parse_qs(url.query))
+        if url.path == "/object_info":
+            return self._send_json(self.fake.object_info())
+        if url.path.startswith("/object_info/"):
+            return self._send_json(self.fake.object_info(url.path[len("/object_info/"):]))
+        self._send_json({"error": "not found"}, 404)
+
+    def _send_file(self, query):
+        filename = os.path.basename(query.get("filename", [""])[0])
+        subfolder = query.get("subfolder", [""])[0]
+        base_dir = self.fake.input_dir if query.get("type", ["output"])[0] == "input" else self.fake.output_dir
+        path = os.path.join(base_dir, subfolder, filename)
+        if not filename or not os.path.isfile(path):
+            return self._send_json({"error": "not found"}, 404)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.fake.http_latency:
+            time.sleep(self.fake.http_latency)
+        path = urlparse(self.path).path
+        if path == "/upload/image":
+            return self._receive_upload(body)
+        if path != "/prompt":
+            return self._send_json({"error": "not found"}, 404)
+        try:
+            payload = json.loads(body)
+            workflow = payload["prompt"]
+        except (ValueError, KeyError):
+            return self._send_json({"error": "invalid prompt"}, 400)
+        prompt_id = self.fake.submit(workflow, payload.get("client_id"))
+        self._send_json({"prompt_id": prompt_id, "number": 0, "node_errors": {}})
+
+    def _receive_upload(self, body):
+        """解析 multipart/form-data，把 image 字段写入 input 目录"""
+        raw = b"Content-Type: " + self.headers.get("Content-Type", "").encode() + b"\r\n\r\n" + body
+        message = BytesParser(policy=policy.HTTP).parsebytes(raw)
+        fields, image = {}, None
+        for part in message.iter_parts() if message.is_multipart() else []:
+            name = part.get_param("name", header="content-disposition")
+            if name == "image":
+                image = (os.path.basename(part.get_filename() or "upload.png"), part.get_payload(decode=True))
+            elif name:
+                fields[name] = part.get_payload(decode=True).decode()
+        if image is None:
+            return self._send_json({"error": "no image"}, 400)
+        filename, data = image
+        path = os.path.join(self.fake.input_dir, filename)
+        if fields.get("overwrite") != "true":
+            # 与 ComfyUI 相同：同名文件存在时追加序号
+            stem, ext = os.path.splitext(filename)
+            i = 1
+            while os.path.exists(path):
+                filename = f"{stem} ({i}){ext}"
+                path = os.path.join(self.fake.input_dir, filename)
+                i += 1
+        with open(path, "wb") as f:
+            f.write(data)
+        self.fake.uploads += 1
+        self._send_json({"name": filename, "subfolder": "", "type": "input"})
+
+    # === 最小 WebSocket 实现 (RFC 6455，仅文本帧) ===
+    def _serve_websocket(self, client_id):
+        if time.time() < self.fake._ws_blocked_until:
+            return self._send_json({"error": "websocket unavailable"}, 503)
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+
+        client_id = client_id or uuid.uuid4().hex
+        self._ws_lock = threading.Lock()
+        with self.fake._lock:
+            self.fake._clients[client_id] = self
+        self.fake.broadcast_status()
+        try:
+            while True:
+                opcode = self._ws_read_frame()
+                if opcode is None or opcode == 0x8:
+                    break
+        finally:
+            with self.fake._lock:
+                if self.fake._clients.get(client_id) is self:
+                    del self.fake._clients[client_id]
+            self.close_connection = True
+
+    def _ws_read_frame(self):
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None
+        opcode = header[0] & 0x0F
+        masked = header[1] & 0x80
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        if masked:
+            self.rfile.read(4)
+        self.rfile.read(length)
+        if opcode == 0x9:  # ping -> pong
+            self.ws_send(b"", opcode=0xA)
+        return opcode
+
+    def ws_send(self, message, opcode=0x1):
+        payload = message.encode("utf-8") if isinstance(message, str) else message
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        try:
+            with self._ws_lock:
+                self.wfile.write(header + payload)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地模拟 ComfyUI 服务")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--exec-time", type=float, default=1.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--http-latency", type=float, default=0.0)
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch-cost", type=float, default=0.35)
+    parser.add_argument("--hires-cost", type=float, default=1.5)
+    args = parser.parse_args()
+
+    server = FakeComfyServer(port=args.port, exec_time=args.exec_time, output_dir=args.output_dir,
+                             fail_rate=args.fail_rate, http_latency=args.http_latency, seed=args.seed,
+                             batch_cost=args.batch_cost, hires_cost=args.hires_cost).start()
+    print(f"🧪 Fake ComfyUI 已启动: {server.base_url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
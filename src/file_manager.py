@@ -1,15 +1,117 @@
 import os
+import re
 import shutil
+import threading
 import time
 
+from src import telemetry
+from src.archive_engine import ArchiveEngine
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def _safe_name(job_name):
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", str(job_name)).strip("_") or "job"
+
+
+class ScanIndex:
+    """
+    ComfyUI 输出目录的增量扫描索引。
+    seen 记录已经判定过的文件名，hwm_ns 是见过的最新文件修改时间 (高水位线)，
+    dir_mtime_ns 是上次扫描时目录本身的修改时间：目录没有新增/删除文件时整次扫描直接跳过。
+    """
+    # 文件系统时间戳精度 (FAT 为 2 秒)，目录 mtime 在此窗口内变化时不信任快速跳过
+    MTIME_GRANULARITY_NS = 2_000_000_000
+
+    def __init__(self):
+        self.seen = set()
+        self.hwm_ns = 0
+        self.dir_mtime_ns = None
+        self.scanned_at_ns = 0
+        self.lock = threading.Lock()
+
+    def scan(self, directory):
+        """
+        返回自上次扫描以来新出现的图片 [(文件名, mtime 秒), ...]。
+        os.scandir 在同一次调用中返回目录项 (Windows 上连同 stat 信息)，
+        只有从未见过的文件才会 stat，开销与新文件数成正比。
+        """
+        dir_mtime_ns = os.stat(directory).st_mtime_ns
+        if (dir_mtime_ns == self.dir_mtime_ns
+                and self.scanned_at_ns - dir_mtime_ns > self.MTIME_GRANULARITY_NS):
+            return []
+        scanned_at_ns = time.time_ns()
+
+        new_files = []
+        present = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = entry.name
+                present.add(name)
+                if name in self.seen or not name.lower().endswith(IMAGE_EXTS):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    mtime_ns = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+                new_files.append((name, mtime_ns / 1e9))
+                if mtime_ns > self.hwm_ns:
+                    self.hwm_ns = mtime_ns
+
+        # 已被搬走或删除的文件不再占用索引
+        if len(self.seen) > len(present):
+            self.seen &= present
+        self.dir_mtime_ns = dir_mtime_ns
+        self.scanned_at_ns = scanned_at_ns
+        return new_files
+
+
+# 同一输出目录的所有 AssetManager 实例共享一份扫描索引 (Streamlit 每次重跑都会新建实例)
+_scan_indexes = {}
+_scan_indexes_lock = threading.Lock()
+
+
+def _get_scan_index(directory):
+    key = os.path.abspath(directory)
+    with _scan_indexes_lock:
+        if key not in _scan_indexes:
+            _scan_indexes[key] = ScanIndex()
+        return _scan_indexes[key]
+
+
+# 未指定归档引擎的 AssetManager 共用一个 (线程池跨 Streamlit 重跑复用)
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+
+def _get_default_engine():
+    global _default_engine
+    with _default_engine_lock:
+        if _default_engine is None:
+            _default_engine = ArchiveEngine()
+        return _default_engine
+
+
 class AssetManager:
     """
     负责管理 AIGC 资产（图片）的搬运、归档和清洗。
     v1.2: 修复同名覆盖 BUG，增加精确时间戳
+    v1.3: 新增 archive_job，按 prompt_id 精确取回输出，不再依赖共享目录
+    v1.4: 源目录增量扫描索引，同步开销只与新文件数有关
+    v1.5: 搬运交给 ArchiveEngine：同卷重命名、跨卷并行复制并校验；本机实例的输出直接从磁盘搬运
     """
-    def __init__(self, comfy_output_dir, project_output_dir):
+    def __init__(self, comfy_output_dir, project_output_dir, engine=None, local_backends=()):
+        """
+        :param engine: ArchiveEngine，默认使用进程内共享的实例
+        :param local_backends: 与 comfy_output_dir 在同一台机器上的 ComfyUI 地址；
+                               这些实例的输出直接从磁盘搬运 (同卷时只是重命名)，不再经 /view 下载
+        """
         self.source_dir = comfy_output_dir
         self.target_dir = project_output_dir
+        self.engine = engine or _get_default_engine()
+        self.local_backends = {url.rstrip("/") for url in local_backends}
         
         # 如果目标目录不存在，自动创建
         if not os.path.exists(self.target_dir):
@@ -23,39 +125,140 @@ class AssetManager:
             print(f"⚠️ 警告：源目录不存在 -> {self.source_dir}")
             return 0
 
-        # 1. 获取源目录所有图片文件
-        all_files = os.listdir(self.source_dir)
-        image_files = [f for f in all_files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
+        index = _get_scan_index(self.source_dir)
+        with index.lock:
+            # 1. 只取上次扫描之后新出现的图片
+            new_files = index.scan(self.source_dir)
+            if not new_files:
+                return 0
 
-        if not image_files:
-            return 0
+            # 2. 搬运逻辑 (同卷重命名；跨卷时多个文件并行复制)
+            moved_count = 0
+            pending = []
+            now = time.time()
+            current_time_str = time.strftime('%H%M%S') # 获取当前 时分秒 (例如 110523)
+
+            for img, file_mtime in new_files:
+                src_path = os.path.join(self.source_dir, img)
+
+                # 只搬运最近 60 秒内生成的文件，更早的旧文件记入索引，以后不再检查
+                if now - file_mtime >= 60:
+                    index.seen.add(img)
+                    continue
 
-        # 2. 搬运逻辑
-        moved_count = 0
-        current_time_str = time.strftime('%H%M%S') # 获取当前 时分秒 (例如 110523)
-        
-        for img in image_files:
-            src_path = os.path.join(self.source_dir, img)
-            
-            # 只搬运最近 60 秒内生成的文件
-            file_mtime = os.path.getmtime(src_path)
-            if time.time() - file_mtime < 60: 
                 # ✨ 核心修复：文件名加入 时分秒(current_time_str) 防止覆盖
                 # 新格式：Bili_Project_20260212_110523_ComfyUI_00001_.png
                 dst_name = f"Bili_Project_{time.strftime('%Y%m%d')}_{current_time_str}_{img}"
                 dst_path = os.path.join(self.target_dir, dst_name)
-                
+
                 # 为了防止极短时间内处理多张图导致秒数也一样，再加个保险
                 if os.path.exists(dst_path):
                     # 如果这秒钟已经有个同名文件了，就加个随机尾巴
                     dst_name = f"Bili_Project_{time.strftime('%Y%m%d')}_{current_time_str}_{int(time.time()*1000)%1000}_{img}"
                     dst_path = os.path.join(self.target_dir, dst_name)
 
+                pending.append((img, dst_name, self.engine.move(src_path, dst_path)))
+
+            for img, dst_name, future in pending:
                 try:
-                    shutil.move(src_path, dst_path)
+                    future.result()
                     print(f"📦 归档: {img} -> {dst_name}")
                     moved_count += 1
                 except Exception as e:
+                    # 搬运失败的文件不记入索引，下次同步重试
                     print(f"❌ 搬运失败 {img}: {e}")
-        
-        return moved_count
\ No newline at end of file
+                    index.dir_mtime_ns = None
+
+        return moved_count
+
+    def archive_job(self, agent, prompt_id, job_name):
+        """
+        按 prompt_id 精确归档一个任务的全部输出。
+        通过 /history 获取该任务的输出文件名，再经 /view 分块下载到项目目录，
+        不需要与 ComfyUI 共享文件系统，并发任务之间也不会串图。
+        本机实例 (local_backends) 的输出直接从磁盘搬运；多张输出并行处理。
+        文件名由任务确定: Bili_Project_{job_name}_{prompt_id前8位}_{序号}.png
+        :return: 已归档文件的路径列表
+        """
+        return self.archive_batch(agent, prompt_id, [job_name])[0]
+
+    def archive_batch(self, agent, prompt_id, job_names):
+        """
+        归档一次潜空间批处理提交 (batch_size = len(job_names)) 的输出，把每张图还原到它对应的任务。
+        ComfyUI 每个 SaveImage 节点按批内顺序输出，第 k 张输出属于第 k % len(job_names) 个任务；
+        序号沿用整次提交的输出编号，同名任务之间也不会冲突。
+        :return: 与 job_names 对应的已归档文件路径列表的列表
+        """
+        with telemetry.span("archive.job", prompt_id=prompt_id, images=len(job_names)):
+            return self._archive_batch(agent, prompt_id, job_names)
+
+    def _archive_batch(self, agent, prompt_id, job_names):
+        safe_names = [_safe_name(name) for name in job_names]
+        pending = []
+        for i, image in enumerate(agent.get_outputs(prompt_id), start=1):
+            row = (i - 1) % len(job_names)
+            ext = os.path.splitext(image["filename"])[1] or ".png"
+            dst_name = f"Bili_Project_{safe_names[row]}_{prompt_id[:8]}_{i:02d}{ext}"
+            dst_path = os.path.join(self.target_dir, dst_name)
+            local_path = self._local_output(agent, image)
+            if local_path:
+                future = self.engine.move(local_path, dst_path)
+            else:
+                future = self.engine.submit_file(agent.download_output, image, dst_path)
+            pending.append((row, image, dst_name, dst_path, future))
+
+        archived = [[] for _ in job_names]
+        for row, image, dst_name, dst_path, future in pending:
+            try:
+                future.result()
+                print(f"📦 归档: {image['filename']} -> {dst_name}")
+                archived[row].append(dst_path)
+            except Exception as e:
+                print(f"❌ 归档失败 {image['filename']}: {e}")
+        return archived
+
+    def archive_batch_async(self, agent, prompt_id, job_names):
+        """
+        在后台线程中归档 (archive_batch)
+        :return: Future，结果为 (每个任务的已归档文件路径列表, 耗时秒)
+        """
+        def run():
+            start = time.time()
+            archived = self.archive_batch(agent, prompt_id, job_names)
+            return archived, time.time() - start
+        return self.engine.submit_job(run)
+
+    def _local_output(self, agent, image):
+        """本机实例的输出在磁盘上的路径；不是本机实例或文件不存在时返回 None"""
+        backend = image.get("backend") or getattr(agent, "base_url", None)
+        if not backend or backend.rstrip("/") not in self.local_backends:
+            return None
+        path = os.path.join(self.source_dir, image.get("subfolder", ""), image["filename"])
+        return path if os.path.isfile(path) else None
+
+    def link_cached(self, paths, job_name, tag):
+        """
+        复用结果缓存中已归档的图片：以本任务的文件名硬链接 (跨盘时复制) 到项目目录，不重新生成。
+        文件名与 archive_job 一致: Bili_Project_{job_name}_{tag}_{序号}.png
+        :return: 本任务的文件路径列表
+        """
+        safe_name = _safe_name(job_name)
+        own_name = re.compile(re.escape(f"Bili_Project_{safe_name}_") + r"[0-9a-f]{8}_\d{2}\.\w+")
+        if all(os.path.dirname(os.path.abspath(p)) == os.path.abspath(self.target_dir)
+               and own_name.fullmatch(os.path.basename(p)) for p in paths):
+            return list(paths)  # 同一任务重跑：图片已在项目目录中，无需再链接一份
+        linked = []
+        for i, src_path in enumerate(paths, start=1):
+            ext = os.path.splitext(src_path)[1] or ".png"
+            dst_path = os.path.join(self.target_dir, f"Bili_Project_{safe_name}_{tag}_{i:02d}{ext}")
+            try:
+                if os.path.abspath(src_path) != os.path.abspath(dst_path) and not os.path.exists(dst_path):
+                    try:
+                        os.link(src_path, dst_path)
+                    except OSError:
+                        shutil.copy2(src_path, dst_path)
+                    print(f"♻️ 复用: {os.path.basename(src_path)} -> {os.path.basename(dst_path)}")
+                linked.append(dst_path)
+            except OSError as e:
+                print(f"❌ 复用失败 {os.path.basename(src_path)}: {e}")
+        return linked
@@ -0,0 +1,348 @@
+import csv
+import hashlib
+import json
+import os
+import time
+
+BOM = b"\xef\xbb\xbf"
+
+
+class JobRow(dict):
+    """
+    jobs.csv 中的一行任务 (列名 -> 取值)。
+    row 为数据行序号 (从 0 开始，不含表头)，offset / end_offset 为该行在文件中的字节区间，
+    key 为行内容的哈希，用于判断某行在上次运行后是否被修改过。
+    """
+    def __init__(self, fields, values, row, offset, end_offset):
+        super().__init__(zip(fields, values))
+        self.row = row
+        self.offset = offset
+        self.end_offset = end_offset
+        self.key = hashlib.sha1("\x1f".join(values).encode("utf-8")).hexdigest()
+
+    def to_record(self):
+        """可 JSON 序列化的形式 (写入任务队列)，用 from_record 还原，key 保持不变"""
+        return {"fields": list(self.keys()), "values": list(self.values()),
+                "row": self.row, "offset": self.offset, "end_offset": self.end_offset, "key": self.key}
+
+    @classmethod
+    def from_record(cls, record):
+        job = cls(record["fields"], record["values"], record["row"], record["offset"], record["end_offset"])
+        job.key = record["key"]  # 行内多出表头的列时，key 按原始整行计算
+        return job
+
+
+class JobSource:
+    """
+    流式读取 jobs.csv：逐行解析，不会把整个文件读进内存。
+    支持从任意行的字节偏移处继续读取，配合 JobJournal 实现断点续跑。
+    """
+    def __init__(self, csv_path, encoding="utf-8"):
+        self.csv_path = csv_path
+        self.encoding = encoding
+        with open(csv_path, "rb") as f:
+            first = f.readline()
+            self.data_offset = f.tell()
+        if first.startswith(BOM):
+            first = first[len(BOM):]
+        self.fieldnames = [name.strip() for name in next(csv.reader([first.decode(encoding)]))]
+
+    def fingerprint(self):
+        """文件指纹 (大小, 修改时间)，未变化时上次的断点一定仍然有效"""
+        st = os.stat(self.csv_path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def hash_range(self, digest, start, end, chunk_size=1 << 20):
+        """
+        把文件 [start, end) 区间的字节送入 digest (hashlib 对象)
+        :return: 文件不足 end 字节时返回 False
+        """
+        with open(self.csv_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    return False
+                digest.update(chunk)
+                remaining -= len(chunk)
+        return True
+
+    def rows(self, start_row=0, start_offset=None):
+        """
+        逐行产出 JobRow
+        :param start_row: 起始行的序号
+        :param start_offset: 起始行的字节偏移，默认从表头之后开始
+        """
+        offset = self.data_offset if start_offset is None else start_offset
+        row = start_row
+        with open(self.csv_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                # 引号内允许换行：引号个数为奇数说明字段尚未闭合
+                while line.count(b'"') % 2 == 1:
+                    more = f.readline()
+                    if not more:
+                        break
+                    line += more
+                end = offset + len(line)
+                text = line.decode(self.encoding)
+                if text.strip():
+                    values = next(csv.reader([text], skipinitialspace=True))
+                    values += [""] * (len(self.fieldnames) - len(values))
+                    yield JobRow(self.fieldnames, values, row, offset, end)
+                    row += 1
+                offset = end
+
+    def __iter__(self):
+        return self.rows()
+
+    def preview(self, limit=200):
+        """返回前 limit 行，用于界面预览"""
+        rows = []
+        for job in self.rows():
+            if len(rows) >= limit:
+                break
+            rows.append(job)
+        return rows
+
+    def count(self):
+        return sum(1 for _ in self.rows())
+
+    def iter_pending(self, journal):
+        """
+        只产出尚未完成的行。
+        文件自上次断点以来未被修改、或只在末尾追加了行时，直接 seek 到断点继续读取，耗时只与剩余行数有关；
+        水位线之前的内容被修改过则全量扫描一遍，按行内容哈希跳过已完成的行 (被修改的行会重新生成)。
+        """
+        resume = journal.resume_point(self)
+        if resume is not None:
+            start_row, start_offset = resume
+            for job in self.rows(start_row, start_offset):
+                if not journal.is_completed(job):
+                    yield job
+            return
+
+        completed_keys = journal.rebase(self.fingerprint(), self.data_offset)
+        for job in self.rows():
+            if job.key in completed_keys:
+                journal.mark_completed(job)
+            else:
+                yield job
+        journal.rebase_done()
+
+
+class JobJournal:
+    """
+    追加写入的任务进度日志 (JSON Lines)，记录每一行的 submitted / completed / failed。
+    另有一个小的断点文件 (.ckpt) 保存"高水位线"：在它之前的所有行均已完成，
+    并记录 CSV 开头到水位线的字节哈希，CSV 只在末尾追加了行时断点仍然有效。
+    重启时只需读取断点文件和它之后追加的少量日志，无需重写 CSV，也无需重放整个日志。
+    """
+    def __init__(self, path, checkpoint_every=100):
+        self.path = path
+        self.checkpoint_path = path + ".ckpt"
+        self.checkpoint_every = checkpoint_every
+
+        self.fingerprint = None
+        self.watermark_row = 0         # 行号小于它的行全部已完成
+        self.watermark_offset = None   # watermark_row 所在行的字节偏移
+        self.prefix_sha1 = None        # CSV 开头 (含表头) 到 watermark_offset 的字节哈希
+        self.done_above = {}           # 水位线之后已完成的行: 行号 -> (该行结束偏移, 行内容哈希)
+        self._source = None            # 当前读取的 JobSource，写断点时增量计算前缀哈希
+        self._digest = None
+        self._digest_offset = 0
+        self._rebasing = False
+        self._since_checkpoint = 0
+
+        self._load_checkpoint()
+        self._file = open(self.path, "ab")
+
+    # === 读取 ===
+    def _load_checkpoint(self):
+        journal_offset = 0
+        if os.path.exists(self.checkpoint_path):
+            try:
+                with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                    ckpt = json.load(f)
+                self.fingerprint = ckpt["fingerprint"]
+                self.watermark_row = ckpt["watermark_row"]
+                self.watermark_offset = ckpt["watermark_offset"]
+                self.prefix_sha1 = ckpt.get("prefix_sha1")
+                self.done_above = {int(row): tuple(done) if isinstance(done, list) else (done, None)
+                                   for row, done in ckpt["done_above"].items()}
+                journal_offset = ckpt["journal_offset"]
+            except (ValueError, KeyError) as e:
+                print(f"⚠️ 断点文件损坏，将全量核对进度: {e}")
+                self.fingerprint = None
+        # 只重放断点之后追加的日志 (没有断点时反正要全量核对，无需重放)
+        if self.fingerprint is not None:
+            for event in self._read_events(journal_offset):
+                if event.get("state") == "completed":
+                    self._apply_completed(event["row"], event["end"], event.get("key"))
+
+    def _read_events(self, offset=0):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时写了一半的最后一行
+
+    def resume_point(self, source):
+        """
+        CSV 未被修改、或水位线之前的字节不变 (只在末尾追加了行) 时返回 (起始行号, 起始字节偏移)，
+        否则返回 None (需要全量核对)
+        :param source: JobSource
+        """
+        self._source = source
+        if self.fingerprint is None:
+            return None
+        fingerprint = source.fingerprint()
+        if fingerprint != self.fingerprint:
+            if self.prefix_sha1 is None or fingerprint[0] < self.watermark_offset:
+                return None
+            digest = hashlib.sha1()
+            if not source.hash_range(digest, 0, self.watermark_offset) or digest.hexdigest() != self.prefix_sha1:
+                return None
+            self._digest, self._digest_offset = digest, self.watermark_offset
+            self.fingerprint = fingerprint
+        return self.watermark_row, self.watermark_offset
+
+    def is_completed(self, job):
+        if job.row < self.watermark_row:
+            return True
+        # 水位线之后的行不在前缀哈希的范围内：偏移和内容都与完成时一致才算完成
+        done = self.done_above.get(job.row)
+        return done is not None and done[0] == job.end_offset and done[1] in (None, job.key)
+
+    @property
+    def completed_count(self):
+        return self.watermark_row + len(self.done_above)
+
+    # === CSV 被修改后的全量核对 ===
+    def rebase(self, fingerprint, data_offset):
+        """
+        重放整个日志，返回所有已完成行的内容哈希集合；之后按新文件重建水位线。
+        核对完成 (rebase_done) 之前不写断点，中途崩溃下次会重新核对。
+        """
+        completed_keys = set()
+        for event in self._read_events():
+            if event.get("state") == "completed" and event.get("key"):
+                completed_keys.add(event["key"])
+        self.fingerprint = fingerprint
+        self.watermark_row = 0
+        self.watermark_offset = data_offset
+        self.prefix_sha1 = None
+        self.done_above = {}
+        self._digest = None
+        # 日志里没有已完成的行 (例如首次运行)，新水位线立即有效，可以照常写断点
+        self._rebasing = bool(completed_keys)
+        return completed_keys
+
+    def mark_completed(self, job):
+        """把核对时发现已完成的行计入进度 (不写日志)"""
+        self._apply_completed(job.row, job.end_offset, job.key)
+
+    def rebase_done(self):
+        self._rebasing = False
+        self.checkpoint()
+
+    # === 写入 ===
+    def _append(self, event):
+        event["t"] = round(time.time(), 3)
+        self._file.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._file.flush()
+
+    def record_submitted(self, job, prompt_id):
+        self._append({"state": "submitted", "row": job.row, "key": job.key, "prompt_id": prompt_id})
+
+    def record_failed(self, job, message=""):
+        self._append({"state": "failed", "row": job.row, "key": job.key, "msg": message})
+
+    def record_completed(self, job, prompt_id=None, outputs=None):
+        self._append({"state": "completed", "row": job.row, "key": job.key, "end": job.end_offset,
+                      "prompt_id": prompt_id, "outputs": outputs or []})
+        self._apply_completed(job.row, job.end_offset, job.key)
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def record_skipped(self, job, reason=""):
+        """无需生成的行 (例如 prompt 为空) 也计为完成，避免水位线卡住"""
+        self.record_completed(job, outputs=[])
+        if reason:
+            print(f"⏭️ 跳过第 {job.row + 1} 行: {reason}")
+
+    def _apply_completed(self, row, end_offset, key=None):
+        if row < self.watermark_row:
+            return
+        self.done_above[row] = (end_offset, key)
+        # 推进水位线：连续完成的行从 done_above 中移除，断点文件保持很小
+        while self.watermark_row in self.done_above:
+            self.watermark_offset = self.done_above.pop(self.watermark_row)[0]
+            self.watermark_row += 1
+
+    def _prefix_hash(self):
+        """CSV 开头到当前水位线的字节哈希：只增量读取上次写断点之后新越过水位线的部分"""
+        if self._source is None:
+            return self.prefix_sha1  # 本次没有读取 CSV，水位线未移动
+        if self._digest is None or self._digest_offset > self.watermark_offset:
+            self._digest, self._digest_offset = hashlib.sha1(), 0
+        if self._digest_offset < self.watermark_offset:
+            if not self._source.hash_range(self._digest, self._digest_offset, self.watermark_offset):
+                self._digest = None  # CSV 在运行中被截短，下次启动全量核对
+                return None
+            self._digest_offset = self.watermark_offset
+        return self._digest.hexdigest()
+
+    def checkpoint(self):
+        """原子写入断点文件"""
+        if self._rebasing or self.fingerprint is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.prefix_sha1 = self._prefix_hash()
+        ckpt = {
+            "fingerprint": self.fingerprint,
+            "watermark_row": self.watermark_row,
+            "watermark_offset": self.watermark_offset,
+            "prefix_sha1": self.prefix_sha1,
+            "done_above": self.done_above,
+            "journal_offset": self._file.tell(),
+        }
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(ckpt, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self._since_checkpoint = 0
+
+    def reset(self):
+        """清空进度，下次从头开始"""
+        self._file.close()
+        for path in (self.path, self.checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.fingerprint = None
+        self.watermark_row = 0
+        self.watermark_offset = None
+        self.prefix_sha1 = None
+        self.done_above = {}
+        self._digest = None
+        self._file = open(self.path, "ab")
+
+    def close(self):
+        self.checkpoint()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,339 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from src.batch_planner import row_upscale
+from src.job_ledger import JobRow
+
+# 批次状态：queued (等待 worker 展开) / running / done / cancelled / failed (无法展开，例如 jobs.csv 不存在)
+# 任务状态：pending / running / success / failed / timeout / cached / cancelled
+# 批次模式 (settings["mode"])：full 完整出图 / draft 只出草图 / refine 精修选中的草图 (由 enqueue_refine 登记)
+
+
+class JobQueue:
+    """
+    持久化的批量任务队列 (SQLite, WAL 模式)，界面与后台 worker 通过它解耦。
+    界面只调用 enqueue() 登记一个批次 (jobs.csv 路径 + 界面设置)，立即返回；
+    worker 进程展开批次为逐行任务并执行，关闭浏览器或界面 rerun 都不会中断。
+
+    多个批次同时排队时，claim() 在批次之间轮转取任务，后提交的批次不必等前一个全部跑完。
+    worker 定期写心跳；worker 崩溃后，recover() 把它名下未完成的任务放回队列。
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            " id TEXT PRIMARY KEY, owner TEXT, source TEXT, created REAL NOT NULL, status TEXT NOT NULL,"
+            " settings TEXT NOT NULL, reference BLOB, total INTEGER, message TEXT,"
+            " started REAL, finished REAL, claimed REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id INTEGER PRIMARY KEY, batch TEXT NOT NULL, seq INTEGER NOT NULL, key TEXT, job TEXT NOT NULL,"
+            " status TEXT NOT NULL, worker TEXT, prompt_id TEXT, message TEXT, outputs TEXT, updated REAL,"
+            " seed INTEGER, draft TEXT, score REAL)"
+        )
+        # 旧版队列没有草图相关的列：实际种子、精修输入的草图文件名、草图评分
+        existing = {row[1] for row in self._db.execute("PRAGMA table_info(tasks)")}
+        for column, kind in (("seed", "INTEGER"), ("draft", "TEXT"), ("score", "REAL")):
+            if column not in existing:
+                self._db.execute(f"ALTER TABLE tasks ADD COLUMN {column} {kind}")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            " id TEXT PRIMARY KEY, host TEXT, pid INTEGER, started REAL, heartbeat REAL, info TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_batch_status ON tasks (batch, status, seq)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_status_worker ON tasks (status, worker)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS batches_status ON batches (status, claimed)")
+        self._db.commit()
+
+    # === 界面端 ===
+    def enqueue(self, settings, source=None, reference=None, owner=None):
+        """
+        登记一个批次
+        :param settings: 批次设置 (可 JSON 序列化)，worker 展开与生成时使用
+        :param source: 任务来源 (jobs.csv 路径)，同一来源的行不会同时在两个批次中排队
+        :param reference: 批次共用的 ControlNet 参考图字节 (可选)
+        :return: 批次 ID
+        """
+        batch_id = datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:4]
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO batches (id, owner, source, created, status, settings, reference) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (batch_id, owner, source, time.time(), json.dumps(settings, ensure_ascii=False), reference),
+            )
+        return batch_id
+
+    def enqueue_refine(self, draft_batch_id, task_ids, owner=None):
+        """
+        把草图批次中选中的任务登记为精修批次：沿用草图的种子与批次设置，以草图文件作为放大分支的输入
+        :param task_ids: 草图批次中成功完成的任务 ID
+        :return: 精修批次 ID；没有可精修的草图时返回 None
+        """
+        batch_id = datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:4]
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT source, settings, owner FROM batches WHERE id = ?", (draft_batch_id,)).fetchone()
+            if row is None:
+                return None
+            source, settings, draft_owner = row
+            placeholders = ", ".join("?" for _ in task_ids)
+            rows = self._db.execute(
+                f"SELECT key, job, seed, outputs FROM tasks WHERE batch = ? AND id IN ({placeholders})"
+                " AND status IN ('success', 'cached') ORDER BY seq", (draft_batch_id, *task_ids)).fetchall()
+            drafts = []
+            for key, job, seed, outputs in rows:
+                files = json.loads(outputs) if outputs else []
+                if files:
+                    drafts.append((key, job, seed, files[0]))
+            if not drafts:
+                return None
+            settings = json.loads(settings)
+            # 草图写在单独的进度日志中；精修完成的行才记入正式进度日志 (refine_journal)
+            settings.update(mode="refine", draft_batch=draft_batch_id, style="Refine",
+                            journal=settings.get("refine_journal", settings["journal"]))
+            self._db.execute(
+                "INSERT INTO batches (id, owner, source, created, status, settings, total, message, started)"
+                " VALUES (?, ?, ?, ?, 'running', ?, ?, ?, ?)",
+                (batch_id, owner or draft_owner, source, now, json.dumps(settings, ensure_ascii=False), len(drafts),
+                 f"✨ 精修草图批次 {draft_batch_id} 中的 {len(drafts)} 张", now))
+            self._db.executemany(
+                "INSERT INTO tasks (batch, seq, key, job, status, updated, seed, draft) VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)",
+                [(batch_id, seq, key, job, now, seed, draft) for seq, (key, job, seed, draft) in enumerate(drafts)])
+        return batch_id
+
+    def cancel(self, batch_id):
+        """取消批次：尚未开始的任务不再执行，已提交到 ComfyUI 的任务照常收尾"""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("UPDATE tasks SET status = 'cancelled', updated = ? WHERE batch = ? AND status = 'pending'",
+                             (now, batch_id))
+            self._db.execute("UPDATE batches SET status = 'cancelled', finished = ? WHERE id = ? AND status IN ('queued', 'running')",
+                             (now, batch_id))
+
+    def batches(self, limit=20):
+        """最近的批次及各状态任务数 (新在前)，每条为 dict"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, owner, created, status, total, message, started, finished, settings FROM batches"
+                " ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+            result = []
+            for batch_id, owner, created, status, total, message, started, finished, settings in rows:
+                counts = dict(self._db.execute(
+                    "SELECT status, COUNT(*) FROM tasks WHERE batch = ? GROUP BY status", (batch_id,)).fetchall())
+                result.append({"id": batch_id, "owner": owner, "created": created, "status": status, "total": total or 0,
+                               "message": message, "started": started, "finished": finished, "counts": counts,
+                               "mode": json.loads(settings).get("mode", "full")})
+        return result
+
+    def recent_tasks(self, batch_id, limit=20):
+        """批次中最近结束的任务 (新在前)"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT job, status, prompt_id, message, outputs, updated FROM tasks"
+                " WHERE batch = ? AND status NOT IN ('pending', 'running') ORDER BY updated DESC LIMIT ?",
+                (batch_id, limit)).fetchall()
+        return [{"job": json.loads(job), "status": status, "prompt_id": prompt_id, "message": message,
+                 "outputs": json.loads(outputs) if outputs else [], "updated": updated}
+                for job, status, prompt_id, message, outputs, updated in rows]
+
+    def drafts(self, batch_id):
+        """
+        草图批次中已出图、可以精修的任务 (按执行顺序)：[{"id", "job", "seed", "outputs", "score"}]
+        行内关闭放大 (upscale 列) 的任务在草图批次中直接出成品，不在其中
+        """
+        with self._lock:
+            batch = self._db.execute("SELECT settings FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            rows = self._db.execute(
+                "SELECT id, job, seed, outputs, score FROM tasks WHERE batch = ? AND status IN ('success', 'cached') ORDER BY seq",
+                (batch_id,)).fetchall()
+        if batch is None:
+            return []
+        default = json.loads(batch[0]).get("defaults", {}).get("upscale", True)
+        drafts = []
+        for task_id, job, seed, outputs, score in rows:
+            job = json.loads(job)
+            if row_upscale(JobRow.from_record(job), default):
+                drafts.append({"id": task_id, "job": job, "seed": seed, "outputs": json.loads(outputs) if outputs else [], "score": score})
+        return drafts
+
+    def set_scores(self, scores):
+        """写入草图评分 {任务 ID: 分数}"""
+        with self._lock, self._db:
+            self._db.executemany("UPDATE tasks SET score = ? WHERE id = ?", [(score, task_id) for task_id, score in scores.items()])
+
+    def workers(self, max_age=30):
+        """max_age 秒内有心跳的 worker"""
+        with self._lock:
+            rows = self._db.execute("SELECT id, host, pid, started, heartbeat, info FROM workers WHERE heartbeat >= ?",
+                                    (time.time() - max_age,)).fetchall()
+        return [{"id": wid, "host": host, "pid": pid, "started": started, "heartbeat": heartbeat,
+                 "info": json.loads(info) if info else {}}
+                for wid, host, pid, started, heartbeat, info in rows]
+
+    # === worker 端 ===
+    def heartbeat(self, worker_id, info=None):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO workers (id, host, pid, started, heartbeat, info) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (id) DO UPDATE SET heartbeat = excluded.heartbeat, info = excluded.info",
+                (worker_id, socket.gethostname(), os.getpid(), now, now, json.dumps(info or {}, ensure_ascii=False)),
+            )
+
+    def recover(self, stale_after=60):
+        """
+        把心跳超时的 worker 名下执行中的任务放回队列 (worker 启动时调用)
+        :return: 放回的任务数
+        """
+        cutoff = time.time() - stale_after
+        with self._lock, self._db:
+            count = self._db.execute(
+                "UPDATE tasks SET status = 'pending', worker = NULL, prompt_id = NULL WHERE status = 'running'"
+                " AND (worker IS NULL OR worker NOT IN (SELECT id FROM workers WHERE heartbeat >= ?))", (cutoff,)).rowcount
+            self._db.execute("DELETE FROM workers WHERE heartbeat < ?", (cutoff,))
+        return count
+
+    def release(self, worker_id):
+        """worker 正常退出：名下执行中的任务立即放回队列，并注销心跳"""
+        with self._lock, self._db:
+            count = self._db.execute(
+                "UPDATE tasks SET status = 'pending', worker = NULL, prompt_id = NULL WHERE status = 'running' AND worker = ?",
+                (worker_id,)).rowcount
+            self._db.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+        return count
+
+    def next_queued(self, exclude=()):
+        """
+        最早登记、尚未展开的批次：(批次 ID, settings, reference) 或 None
+        :param exclude: 本轮暂不展开的批次 ID
+        """
+        placeholders = ", ".join("?" for _ in exclude)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, settings, reference FROM batches WHERE status = 'queued'"
+                + (f" AND id NOT IN ({placeholders})" if exclude else "") + " ORDER BY created LIMIT 1", tuple(exclude)).fetchone()
+        return (row[0], json.loads(row[1]), row[2]) if row else None
+
+    def journal_in_use(self, journal):
+        """
+        是否有批次仍有排队或执行中的任务写入该进度日志 (已取消的批次中已提交的任务也算)；
+        草图批次中不放大的行直接出成品，也会写入正式进度日志 (refine_journal)
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT settings FROM batches b WHERE"
+                " EXISTS (SELECT 1 FROM tasks t WHERE t.batch = b.id AND t.status IN ('pending', 'running'))").fetchall()
+        for (settings,) in rows:
+            settings = json.loads(settings)
+            if settings.get("journal") == journal or (settings.get("mode") == "draft" and settings.get("refine_journal") == journal):
+                return True
+        return False
+
+    def batch(self, batch_id):
+        """(status, settings, reference)，批次不存在时为 None"""
+        with self._lock:
+            row = self._db.execute("SELECT status, settings, reference FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return (row[0], json.loads(row[1]), row[2]) if row else None
+
+    def active_keys(self, source):
+        """同一来源中仍在排队或执行的行 (行内容哈希)，展开新批次时跳过，避免同一行重复生成"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT t.key FROM tasks t JOIN batches b ON b.id = t.batch"
+                " WHERE b.source = ? AND t.status IN ('pending', 'running')", (source,)).fetchall()
+        return {key for (key,) in rows}
+
+    def add_tasks(self, batch_id, jobs, message=None):
+        """
+        展开批次：按给定顺序写入任务，并把批次标为 running (单个事务)
+        :param jobs: 可迭代的 (行内容哈希, 可 JSON 序列化的任务)
+        :return: 写入的任务数；批次已被其他 worker 展开或已取消时返回 None
+        """
+        now = time.time()
+        with self._lock, self._db:
+            if not self._db.execute("UPDATE batches SET status = 'running', started = ? WHERE id = ? AND status = 'queued'",
+                                    (now, batch_id)).rowcount:
+                return None
+            rows = ((batch_id, seq, key, json.dumps(job, ensure_ascii=False), now) for seq, (key, job) in enumerate(jobs))
+            count = self._db.executemany(
+                "INSERT INTO tasks (batch, seq, key, job, status, updated) VALUES (?, ?, ?, ?, 'pending', ?)", rows).rowcount
+            status = "running" if count else "done"
+            self._db.execute("UPDATE batches SET total = ?, message = ?, status = ?, finished = ? WHERE id = ?",
+                             (count, message, status, None if count else now, batch_id))
+        return count
+
+    def reject(self, batch_id, message):
+        """批次无法展开时标为 failed，不再重试"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE batches SET status = 'failed', message = ?, finished = ? WHERE id = ? AND status = 'queued'",
+                             (message, time.time(), batch_id))
+
+    def set_message(self, batch_id, message):
+        with self._lock, self._db:
+            self._db.execute("UPDATE batches SET message = ? WHERE id = ?", (message, batch_id))
+
+    def claim(self, worker_id, limit=1):
+        """
+        领取待执行的任务，在有待执行任务的批次之间轮转 (最久未被领取的批次优先)
+        :param limit: 最多领取同一批次中按顺序相邻的几个任务 (潜空间批处理一次合并提交)
+        :return: [{"id", "batch", "job", "seed", "draft"}, ...]，队列为空时为空列表
+        """
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT id FROM batches WHERE status = 'running'"
+                " AND EXISTS (SELECT 1 FROM tasks WHERE tasks.batch = batches.id AND tasks.status = 'pending')"
+                " ORDER BY claimed, created LIMIT 1").fetchone()
+            if row is None:
+                return []
+            batch_id = row[0]
+            rows = self._db.execute(
+                "SELECT id, job, seed, draft FROM tasks WHERE batch = ? AND status = 'pending' ORDER BY seq LIMIT ?",
+                (batch_id, max(1, limit))).fetchall()
+            self._db.executemany("UPDATE tasks SET status = 'running', worker = ?, updated = ? WHERE id = ?",
+                                 [(worker_id, now, row[0]) for row in rows])
+            self._db.execute("UPDATE batches SET claimed = ? WHERE id = ?", (now, batch_id))
+        return [{"id": task_id, "batch": batch_id, "job": json.loads(job), "seed": seed, "draft": draft}
+                for task_id, job, seed, draft in rows]
+
+    def set_prompt(self, task_id, prompt_id):
+        """记录任务已提交到 ComfyUI"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE tasks SET prompt_id = ?, updated = ? WHERE id = ?", (prompt_id, time.time(), task_id))
+
+    def finish(self, task_id, status, message=None, outputs=None, seed=None):
+        """
+        记录任务结果；批次中没有未完成的任务时把批次标为 done
+        :param seed: 实际使用的种子 (精修时沿用)
+        :return: 批次是否因此完成
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("UPDATE tasks SET status = ?, message = ?, outputs = ?, updated = ?, seed = COALESCE(?, seed) WHERE id = ?",
+                             (status, message, json.dumps(outputs or [], ensure_ascii=False), now, seed, task_id))
+            return self._db.execute(
+                "UPDATE batches SET status = 'done', finished = ? WHERE status = 'running'"
+                " AND id = (SELECT batch FROM tasks WHERE id = ?)"
+                " AND NOT EXISTS (SELECT 1 FROM tasks WHERE tasks.batch = batches.id AND tasks.status IN ('pending', 'running'))",
+                (now, task_id)).rowcount > 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
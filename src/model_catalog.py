@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+
+from src.comfy_client import ComfyAgent
+
+# 模型类别 -> (ComfyUI 加载节点, 输入名, 本地目录中的文件扩展名)
+MODEL_LOADERS = {
+    "checkpoints": ("CheckpointLoaderSimple", "ckpt_name", (".safetensors", ".ckpt")),
+    "loras": ("LoraLoader", "lora_name", (".safetensors", ".ckpt")),
+    "controlnet": ("ControlNetLoader", "control_net_name", (".safetensors", ".ckpt", ".pth")),
+    "upscale_models": ("UpscaleModelLoader", "model_name", (".pth", ".pt", ".safetensors")),
+}
+
+
+def _combo_options(spec):
+    """
+    解析 /object_info 中下拉框输入的可选值。
+    旧版格式为 [[选项, ...], {配置}]，新版为 ["COMBO", {"options": [选项, ...]}]
+    """
+    if not isinstance(spec, list) or not spec:
+        return None
+    if isinstance(spec[0], list):
+        return [str(name) for name in spec[0]]
+    if spec[0] == "COMBO" and len(spec) > 1 and isinstance(spec[1], dict):
+        return [str(name) for name in spec[1].get("options", [])]
+    return None
+
+
+class ModelCatalog:
+    """
+    模型清单 (checkpoint / LoRA / ControlNet / 放大模型) 的缓存索引。
+    优先从 ComfyUI 的 /object_info 读取，模型放在远程机器上也能列出；
+    ComfyUI 未启动时退回扫描本地模型目录。
+    结果在 ttl 秒内直接复用；过期后本地目录先比较目录 mtime，没有变化就不重新列目录，
+    网络盘上每次 Streamlit rerun 不再产生目录扫描。
+    """
+    def __init__(self, base_url=None, local_dirs=None, ttl=60):
+        """
+        :param base_url: ComfyUI 地址，None 表示只读本地目录
+        :param local_dirs: {类别: 本地目录}，例如 {"checkpoints": r"M:\\models\\checkpoints"}
+        :param ttl: 缓存有效期 (秒)
+        """
+        self.agent = ComfyAgent(base_url) if base_url else None
+        self.local_dirs = dict(local_dirs or {})
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # 类别 -> {"names", "source", "checked_at", "dir_mtime"}
+
+    def list(self, category):
+        """返回该类别的模型文件名列表 (已排序)"""
+        with self._lock:
+            entry = self._entries.get(category)
+            if entry and time.time() - entry["checked_at"] < self.ttl:
+                return entry["names"]
+            entry = self._load(category, entry)
+            self._entries[category] = entry
+            return entry["names"]
+
+    def source(self, category):
+        """该类别当前数据的来源："remote" (/object_info) / "local" (本地目录) / None"""
+        entry = self._entries.get(category)
+        return entry["source"] if entry else None
+
+    def refresh(self, category=None):
+        """使缓存失效，下次 list() 时重新读取"""
+        with self._lock:
+            if category is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(category, None)
+
+    def _load(self, category, entry):
+        now = time.time()
+        names = self._load_remote(category)
+        if names is not None:
+            return {"names": names, "source": "remote", "checked_at": now, "dir_mtime": None}
+
+        directory = self.local_dirs.get(category)
+        try:
+            dir_mtime = os.stat(directory).st_mtime_ns if directory else None
+        except OSError:
+            dir_mtime = None
+        if dir_mtime is None:
+            return {"names": [], "source": None, "checked_at": now, "dir_mtime": None}
+        if entry and entry["source"] == "local" and entry["dir_mtime"] == dir_mtime:
+            # 目录未变化：沿用上次的列表，只刷新检查时间
+            return dict(entry, checked_at=now)
+
+        exts = MODEL_LOADERS[category][2]
+        with os.scandir(directory) as it:
+            names = sorted(e.name for e in it if e.name.lower().endswith(exts) and e.is_file())
+        return {"names": names, "source": "local", "checked_at": now, "dir_mtime": dir_mtime}
+
+    def _load_remote(self, category):
+        if self.agent is None:
+            return None
+        # 健康检查带缓存且不重试，ComfyUI 未启动时不会在这里卡住
+        if not self.agent.is_server_ready(retries=False):
+            return None
+        node_class, input_name, _ = MODEL_LOADERS[category]
+        info = self.agent.get_object_info(node_class)
+        if not info or node_class not in info:
+            return None
+        inputs = info[node_class].get("input", {})
+        spec = inputs.get("required", {}).get(input_name) or inputs.get("optional", {}).get(input_name)
+        names = _combo_options(spec)
+        return sorted(names) if names is not None else None
@@ -0,0 +1,148 @@
+import hashlib
+import io
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 已确认存在于某个 ComfyUI input 目录的参考图: (base_url, 文件名)，同一进程内不重复上传
+_uploaded = set()
+_uploaded_lock = threading.Lock()
+# 文件名 -> 锁：多行同时引用同一张图时只有一个线程处理与上传，其余等待后直接复用
+_name_locks = {}
+
+
+def _load_pil():
+    from PIL import Image, ImageFile, ImageOps
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    return Image, ImageOps
+
+
+class ReferenceImages:
+    """
+    ControlNet 参考图的内容寻址上传。
+    图片按内容哈希命名 (ref_<sha1>.png)，同一张图无论上传多少次、换什么文件名，
+    在 ComfyUI 上只存一份；通过 /upload/image 发送，不需要共享 input 目录。
+
+    缩放到生成尺寸 (与 ComfyUI 应用 ControlNet 时的居中裁剪一致) 和上传在线程池中进行，
+    批量模式下用 prefetch() 提前处理后面的行，提交任务时参考图通常已经就绪。
+    """
+    def __init__(self, agents, cache_dir, workers=4):
+        """
+        :param agents: ComfyAgent 列表；多实例时参考图会上传到每个实例，任务迁移后仍能找到
+        :param cache_dir: 预处理结果的本地缓存目录
+        """
+        self.agents = list(agents)
+        self.cache_dir = cache_dir
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="refs")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # === 对外接口 ===
+    def add(self, source, size=None):
+        """
+        同步处理一张参考图
+        :param source: 文件路径或图片字节
+        :param size: (宽, 高)，给出时先缩放裁剪到该尺寸
+        :return: ComfyUI input 目录中的文件名
+        """
+        return self._prepare(source, size)
+
+    def submit(self, source, size=None):
+        """在线程池中处理，返回 Future (结果为文件名)"""
+        return self._pool.submit(self._prepare, source, size)
+
+    def prefetch(self, jobs, resolve, lookahead=16):
+        """
+        提前处理后续行的参考图 (生成器)
+        :param jobs: 任务行
+        :param resolve: resolve(job) -> (source, size)，该行不需要参考图时返回 None
+        :param lookahead: 最多提前处理的行数
+        :yield: (job, Future 或 None)
+        """
+        window = deque()
+        for job in jobs:
+            spec = resolve(job)
+            window.append((job, self.submit(*spec) if spec else None))
+            if len(window) > lookahead:
+                yield window.popleft()
+        while window:
+            yield window.popleft()
+
+    # === 内部实现 ===
+    def _read(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return bytes(source)
+        with open(source, "rb") as f:
+            return f.read()
+
+    def _prepare(self, source, size):
+        data = self._read(source)
+        digest = hashlib.sha1(data).hexdigest()
+        name = f"ref_{digest[:20]}_{size[0]}x{size[1]}.png" if size else f"ref_{digest[:20]}.png"
+        with _uploaded_lock:
+            lock = _name_locks.setdefault(name, threading.Lock())
+        with lock:
+            self._store(name, data, size)
+        return name
+
+    def _store(self, name, data, size):
+        with _uploaded_lock:
+            if all((agent.base_url, name) in _uploaded for agent in self.agents):
+                return
+        if size:
+            cached = os.path.join(self.cache_dir, name)
+            if os.path.exists(cached):
+                with open(cached, "rb") as f:
+                    data = f.read()
+            else:
+                data = self._resize(data, size)
+                with open(cached + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(cached + ".tmp", cached)
+        else:
+            data = self._to_png(data)
+        self._upload(name, data)
+
+    def _resize(self, data, size):
+        Image, ImageOps = _load_pil()
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            img = ImageOps.fit(img, size, Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, "PNG")
+        return out.getvalue()
+
+    def _to_png(self, data):
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return data
+        Image, _ = _load_pil()
+        with Image.open(io.BytesIO(data)) as img:
+            out = io.BytesIO()
+            img.convert("RGB").save(out, "PNG")
+        return out.getvalue()
+
+    def _upload(self, name, data):
+        uploaded = 0
+        errors = []
+        for agent in self.agents:
+            key = (agent.base_url, name)
+            with _uploaded_lock:
+                if key in _uploaded:
+                    uploaded += 1
+                    continue
+            # 内容寻址：服务器上已有同名文件即为同一张图 (例如上次运行时上传过)
+            if not agent.has_input_image(name):
+                succ, msg = agent.upload_image(data, name, overwrite=True)
+                if not succ:
+                    errors.append(f"{agent.base_url}: {msg}")
+                    continue
+            with _uploaded_lock:
+                _uploaded.add(key)
+            uploaded += 1
+        if not uploaded:
+            raise RuntimeError("❌ 参考图上传失败 " + "; ".join(errors))
+        for error in errors:
+            print(f"⚠️ 参考图未能上传到 {error}")
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 只影响输出文件名 / 界面显示、不影响像素的输入，计算缓存键时忽略
+COSMETIC_INPUTS = ("filename_prefix",)
+# 这些节点的 image 输入是 ComfyUI input 目录中的文件名，按文件内容参与缓存键
+IMAGE_LOADERS = ("LoadImage",)
+
+# 参考图内容哈希缓存：路径 -> (mtime_ns, size, sha1)
+_file_digests = {}
+_digest_lock = threading.Lock()
+
+
+def _file_digest(path):
+    st = os.stat(path)
+    with _digest_lock:
+        cached = _file_digests.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digest_lock:
+        _file_digests[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def canonical_workflow(workflow_data, input_dir=None, ignore=()):
+    """
+    去掉 _meta 与 filename_prefix 等装饰性字段后的工作流副本。
+    指定 input_dir 时，LoadImage 的文件名替换为文件内容哈希：同一张参考图换个文件名上传仍能命中。
+    :param ignore: 额外忽略的输入名 (例如 ("seed",)，用于判断两个任务是否只差种子)
+    """
+    canonical = {}
+    for node_id, node in workflow_data.items():
+        inputs = {k: v for k, v in node.get("inputs", {}).items() if k not in COSMETIC_INPUTS and k not in ignore}
+        if input_dir and node.get("class_type") in IMAGE_LOADERS and isinstance(inputs.get("image"), str):
+            path = os.path.join(input_dir, inputs["image"])
+            if os.path.isfile(path):
+                inputs["image"] = "sha1:" + _file_digest(path)
+        canonical[node_id] = {"class_type": node.get("class_type"), "inputs": inputs}
+    return canonical
+
+
+def workflow_key(workflow_data, input_dir=None, ignore=()):
+    """工作流的规范化哈希：像素结果相同的工作流得到相同的键"""
+    text = json.dumps(canonical_workflow(workflow_data, input_dir, ignore), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    按工作流内容寻址的结果缓存。
+    索引 (SQLite) 记录 缓存键 -> 已归档文件路径；再次提交完全相同的工作流时
+    直接复用已有的图片，不再占用 GPU。随机种子 (-1) 的任务每次工作流都不同，天然不会命中。
+
+    缓存不拥有图片文件：淘汰只删除索引记录，已归档的图片保留在项目目录中。
+    """
+    def __init__(self, index_path, max_bytes=None, max_age_days=None):
+        """
+        :param index_path: SQLite 索引文件路径
+        :param max_bytes: 参与复用的图片总大小上限，超出时按最近最少使用淘汰索引记录
+        :param max_age_days: 超过该天数未被使用的记录会被淘汰
+        """
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self._db = sqlite3.connect(index_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, paths TEXT NOT NULL, bytes INTEGER NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self._db.commit()
+
+    def lookup(self, key):
+        """
+        命中时返回已归档文件路径列表；未命中或文件已被删除时返回 None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT paths FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            paths = json.loads(row[0])
+            if not paths or not all(os.path.exists(p) for p in paths):
+                # 图片被手动删除或移走，记录作废
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE results SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return paths
+
+    def store(self, key, paths):
+        """记录一次成功生成的结果"""
+        paths = [os.path.abspath(p) for p in paths if os.path.exists(p)]
+        if not paths:
+            return
+        size = sum(os.path.getsize(p) for p in paths)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, paths, bytes, created, last_used, hits) VALUES (?, ?, ?, ?, ?, 0)",
+                (key, json.dumps(paths, ensure_ascii=False), size, now, now),
+            )
+            self._db.commit()
+
+    def evict(self):
+        """
+        按期限与容量淘汰索引记录
+        :return: 淘汰的记录数
+        """
+        removed = 0
+        with self._lock:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed += self._db.execute("DELETE FROM results WHERE last_used < ?", (cutoff,)).rowcount
+            if self.max_bytes is not None:
+                total = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM results").fetchone()[0]
+                if total > self.max_bytes:
+                    victims = []
+                    for key, size in self._db.execute("SELECT key, bytes FROM results ORDER BY last_used"):
+                        if total <= self.max_bytes:
+                            break
+                        victims.append((key,))
+                        total -= size
+                    self._db.executemany("DELETE FROM results WHERE key = ?", victims)
+                    removed += len(victims)
+            self._db.commit()
+        return removed
+
+    def stats(self):
+        with self._lock:
+            count, size, hits = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(hits), 0) FROM results").fetchone()
+        return {"count": count, "bytes": size, "hits": hits}
+
+    def summary(self):
+        stats = self.stats()
+        return f"{stats['count']} 组结果，{stats['bytes'] / 1024 / 1024:.1f} MB，累计命中 {stats['hits']} 次"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
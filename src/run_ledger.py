@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import threading
+import time
+
+# 每条运行记录的字段；耗时单位均为秒，未知时为 NULL
+COLUMNS = (
+    "ts", "batch", "style", "job", "prompt", "seed", "status", "backend", "prompt_id",
+    "queue_wait", "gpu_time", "transfer_time", "archive_time", "total_time", "images", "filename",
+    "batch_index",
+)
+
+
+def _percentile(conn, column, where, args, q):
+    """按 q 分位取值 (最近秩)，只读取一行，依赖 (status, 列) 上的索引"""
+    count = conn.execute(f"SELECT COUNT({column}) FROM runs WHERE {where} AND {column} IS NOT NULL", args).fetchone()[0]
+    if not count:
+        return None
+    offset = min(count - 1, max(0, int(round(q * count + 0.5)) - 1))
+    row = conn.execute(
+        f"SELECT {column} FROM runs WHERE {where} AND {column} IS NOT NULL ORDER BY {column} LIMIT 1 OFFSET ?",
+        args + (offset,),
+    ).fetchone()
+    return row[0]
+
+
+class RunLedger:
+    """
+    任务运行台账 (SQLite, WAL 模式)，替代逐条重写的 history.csv。
+    record() 只追加到内存缓冲区，攒够 flush_every 条或距上次写入超过 flush_interval 秒时
+    一次事务批量写入；读取端 (分析页) 在 WAL 模式下可与写入并发，不会阻塞流水线。
+    """
+    def __init__(self, db_path, flush_every=50, flush_interval=2.0):
+        """
+        :param db_path: SQLite 数据库路径
+        :param flush_every: 缓冲多少条记录后写入一次
+        :param flush_interval: 缓冲区最长保留时间 (秒)
+        """
+        self.db_path = db_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " id INTEGER PRIMARY KEY, ts REAL NOT NULL, batch TEXT, style TEXT, job TEXT, prompt TEXT,"
+            " seed INTEGER, status TEXT NOT NULL, backend TEXT, prompt_id TEXT,"
+            " queue_wait REAL, gpu_time REAL, transfer_time REAL, archive_time REAL, total_time REAL,"
+            " images INTEGER, filename TEXT, batch_index INTEGER)"
+        )
+        # 旧版台账没有 batch_index 列 (潜空间批处理中的批内序号，seed 为整批的基础种子)
+        existing = {row[1] for row in self._db.execute("PRAGMA table_info(runs)")}
+        if "batch_index" not in existing:
+            self._db.execute("ALTER TABLE runs ADD COLUMN batch_index INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_ts ON runs (ts)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_status_total ON runs (status, total_time)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_status_gpu ON runs (status, gpu_time)")
+        self._db.commit()
+
+    # === 写入 ===
+    def record(self, **fields):
+        """
+        追加一条记录，例如 record(job="Job_001", status="success", gpu_time=3.2, ...)
+        未给出的字段记为 NULL，ts 默认为当前时间
+        """
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise KeyError(f"❌ 未定义的台账字段: {', '.join(sorted(unknown))}")
+        fields.setdefault("ts", time.time())
+        with self._lock:
+            self._buffer.append(tuple(fields.get(name) for name in COLUMNS))
+            due = len(self._buffer) >= self.flush_every or time.time() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            self._flushed_at = time.time()
+            if not rows:
+                return
+            placeholders = ", ".join("?" for _ in COLUMNS)
+            with self._db:
+                self._db.executemany(f"INSERT INTO runs ({', '.join(COLUMNS)}) VALUES ({placeholders})", rows)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # === 查询 ===
+    def version(self):
+        """已写入的最大行号，用作查询结果缓存的键：没有新记录时无需重新统计"""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(MAX(id), 0) FROM runs").fetchone()[0]
+
+    def summary(self, since=None, gpu_hour_cost=0.0):
+        """
+        汇总统计
+        :param since: 只统计该时间戳之后的记录 (None 表示全部)
+        :param gpu_hour_cost: 每 GPU 小时的成本，用于估算单张图成本
+        """
+        where, args = "ts >= ?", (since or 0,)
+        with self._lock:
+            conn = self._db
+            total, success, failed, cached, images, first_ts, last_ts, gpu_sum = conn.execute(
+                "SELECT COUNT(*), SUM(status = 'success'), SUM(status IN ('failed', 'timeout')), SUM(status = 'cached'),"
+                " COALESCE(SUM(CASE WHEN status = 'success' THEN images END), 0), MIN(ts), MAX(ts),"
+                " COALESCE(SUM(gpu_time), 0) FROM runs WHERE " + where, args).fetchone()
+            ok_where, ok_args = where + " AND status = ?", args + ("success",)
+            stats = {
+                "total": total or 0,
+                "success": success or 0,
+                "failed": failed or 0,
+                "cached": cached or 0,
+                "images": images or 0,
+                "p50_total": _percentile(conn, "total_time", ok_where, ok_args, 0.50),
+                "p95_total": _percentile(conn, "total_time", ok_where, ok_args, 0.95),
+                "p50_gpu": _percentile(conn, "gpu_time", ok_where, ok_args, 0.50),
+                "p95_gpu": _percentile(conn, "gpu_time", ok_where, ok_args, 0.95),
+                "p50_queue": _percentile(conn, "queue_wait", ok_where, ok_args, 0.50),
+                "avg_transfer": conn.execute(f"SELECT AVG(transfer_time) FROM runs WHERE {ok_where}", ok_args).fetchone()[0],
+                "avg_archive": conn.execute(f"SELECT AVG(archive_time) FROM runs WHERE {ok_where}", ok_args).fetchone()[0],
+                "gpu_hours": gpu_sum / 3600,
+            }
+        span = (last_ts - first_ts) if total and last_ts > first_ts else 0
+        stats["images_per_hour"] = stats["images"] / span * 3600 if span else None
+        stats["cost_per_image"] = stats["gpu_hours"] * gpu_hour_cost / stats["images"] if stats["images"] else None
+        return stats
+
+    def batches(self, limit=20):
+        """按批次汇总最近的运行：[(batch, 开始时间, 任务数, 成功数, 总耗时, 吞吐 张/小时)]"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT batch, MIN(ts), COUNT(*), SUM(status = 'success'), MAX(ts) - MIN(ts) + COALESCE(MIN(total_time), 0),"
+                " COALESCE(SUM(CASE WHEN status = 'success' THEN images END), 0)"
+                " FROM runs WHERE batch IS NOT NULL GROUP BY batch ORDER BY MIN(ts) DESC LIMIT ?", (limit,)).fetchall()
+        return [(batch, started, count, success, span, images / span * 3600 if span else None)
+                for batch, started, count, success, span, images in rows]
+
+    def recent(self, limit=200):
+        """最近的记录 (新在前)，每条为 dict"""
+        with self._lock:
+            rows = self._db.execute(f"SELECT {', '.join(COLUMNS)} FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
@@ -0,0 +1,257 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from src.comfy_client import ComfyAgent
+
+
+class Backend:
+    """
+    调度器视角下的一个 ComfyUI 实例。
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.agent = ComfyAgent(base_url)
+        self.events = None
+        self.healthy = False
+        self.external_depth = 0   # 其他客户端在该实例上排队的任务数
+        self.in_flight = set()    # 本调度器提交到该实例、尚未结束的任务 ID
+        self.failures = 0         # 连续探测失败次数
+        self.retry_at = 0         # 离线实例下次探测的时间
+
+    @property
+    def load(self):
+        return self.external_depth + len(self.in_flight)
+
+
+class MultiBackendDispatcher:
+    """
+    多 ComfyUI 实例调度器。
+    定期检查每个实例的健康状态和 /queue 深度，把每个工作流发往负载最低的健康实例；
+    某个实例中途宕机时，把它上面未完成的任务重新提交到其他实例。
+
+    对外提供与 ComfyAgent 相同的 send_job / get_job_status / get_outputs / download_output，
+    以及与 ComfyEventStream 相同的 wait_any / get_error / forget，
+    因此可以直接作为 BatchRunner 的 agent 和 events 使用。
+    返回的任务 ID 是调度器自己的逻辑 ID，任务迁移到其他实例后保持不变。
+    """
+    def __init__(self, base_urls, health_interval=5, use_events=True, keep_finished=4096):
+        """
+        :param base_urls: ComfyUI 地址列表，例如 ["http://127.0.0.1:8188", "http://10.0.0.2:8188"]
+        :param health_interval: 健康检查与队列深度刷新的间隔 (秒)
+        :param use_events: 是否为每个实例订阅 WebSocket 事件流
+        :param keep_finished: 保留最近多少个已结束任务的实例映射 (forget 之后仍可 get_outputs)
+        """
+        self.backends = [Backend(url) for url in base_urls]
+        self.health_interval = health_interval
+        self.use_events = use_events
+        self.keep_finished = keep_finished
+        self.connected = False
+
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._jobs = {}  # 逻辑 ID -> {"backend", "remote_id", "workflow", "attempts"}
+        self._finished = OrderedDict()  # 已结束任务的 逻辑 ID -> (backend, remote_id)，供结束后归档输出
+        self._refreshed_at = 0
+        self.refresh()
+
+    # === 健康检查 ===
+    def refresh(self, force=False):
+        """刷新所有实例的健康状态与队列深度，并迁移宕机实例上的任务"""
+        if not force and time.time() - self._refreshed_at < self.health_interval:
+            return
+        self._refreshed_at = time.time()
+        for backend in self.backends:
+            if not backend.healthy and not force and time.time() < backend.retry_at:
+                continue  # 离线实例按指数退避探测，避免每次刷新都等连接超时
+            was_healthy = backend.healthy
+            backend.healthy = backend.agent.is_server_ready(max_age=0, retries=False)
+            if backend.healthy:
+                backend.failures = 0
+                depth = backend.agent.get_queue_depth()
+                if depth is not None:
+                    backend.external_depth = max(0, depth - len(backend.in_flight))
+                if self.use_events and (backend.events is None or not backend.events.connected):
+                    self._open_events(backend)
+            else:
+                backend.failures += 1
+                backend.retry_at = time.time() + min(60, self.health_interval * 2 ** backend.failures)
+                if was_healthy:
+                    print(f"⚠️ 实例离线: {backend.base_url}")
+            if not backend.healthy and backend.in_flight:
+                self._failover(backend)
+        self.connected = any(b.events is not None and b.events.connected for b in self.backends)
+
+    def _open_events(self, backend):
+        if backend.events is not None:
+            backend.events.close()
+        backend.events = backend.agent.open_event_stream(timeout=2)
+        if backend.events is not None:
+            backend.events.add_listener(self._on_event)
+
+    def _on_event(self, event, prompt_id, data):
+        if event in ("executing", "execution_success", "execution_error", "execution_interrupted"):
+            with self._cond:
+                self._cond.notify_all()
+
+    def _is_alive(self, backend):
+        if backend.events is not None and backend.events.connected:
+            return True
+        # 事件流断开：用 TTL 缓存的健康检查确认是否真的宕机
+        backend.healthy = backend.agent.is_server_ready(retries=False)
+        return backend.healthy
+
+    @property
+    def healthy_backends(self):
+        return [b for b in self.backends if b.healthy]
+
+    def is_server_ready(self, max_age=None):
+        """至少有一个实例在线"""
+        self.refresh()
+        return bool(self.healthy_backends)
+
+    # === 提交与迁移 ===
+    def _submit_remote(self, workflow, exclude=None):
+        """按负载从低到高尝试各健康实例，返回 (backend, remote_id) 或 (None, 错误信息)"""
+        candidates = sorted((b for b in self.healthy_backends if b is not exclude), key=lambda b: b.load)
+        message = "没有可用的 ComfyUI 实例"
+        for backend in candidates:
+            succ, msg = backend.agent.send_job(workflow)
+            if succ:
+                return backend, msg
+            message = msg
+            if not backend.agent.is_server_ready(max_age=0, retries=False):
+                backend.healthy = False
+        return None, message
+
+    def send_job(self, workflow_data):
+        """
+        把工作流发往负载最低的健康实例
+        :return: (bool success, str 逻辑任务 ID 或错误信息)
+        """
+        self.refresh()
+        with self._lock:
+            backend, remote_id = self._submit_remote(workflow_data)
+            if backend is None:
+                return False, remote_id
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {"backend": backend, "remote_id": remote_id, "workflow": workflow_data, "attempts": 1}
+            backend.in_flight.add(job_id)
+            return True, job_id
+
+    def _failover(self, dead):
+        """把宕机实例上未完成的任务重新提交到其他实例"""
+        with self._lock:
+            for job_id in list(dead.in_flight):
+                job = self._jobs[job_id]
+                backend, remote_id = self._submit_remote(job["workflow"], exclude=dead)
+                if backend is None:
+                    return  # 暂无可用实例，下次刷新再试
+                dead.in_flight.discard(job_id)
+                backend.in_flight.add(job_id)
+                job.update(backend=backend, remote_id=remote_id, attempts=job["attempts"] + 1)
+                print(f"🔁 任务 {job_id[:8]} 从 {dead.base_url} 迁移到 {backend.base_url}")
+
+    # === 状态查询 ===
+    def get_job_status(self, job_id):
+        """返回 "success" / "failed"，未结束 (包括刚被迁移) 返回 None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            backend = job["backend"]
+            status = backend.agent.get_job_status(job["remote_id"])
+            if status is not None:
+                backend.in_flight.discard(job_id)
+                return status
+            if not self._is_alive(backend):
+                self._failover(backend)
+            return None
+
+    def wait_any(self, job_ids, timeout=None):
+        """
+        阻塞直到任意一个任务结束 (由各实例的事件流唤醒)，期间按 health_interval 检查实例健康
+        :return: dict {job_id: status}
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                finished = {}
+                for job_id in job_ids:
+                    job = self._jobs.get(job_id)
+                    if job is None or job["backend"].events is None:
+                        continue
+                    status = job["backend"].events.get_status(job["remote_id"])
+                    if status is not None:
+                        job["backend"].in_flight.discard(job_id)
+                        finished[job_id] = status
+                if finished:
+                    return finished
+                self.refresh()
+                remaining = self.health_interval if deadline is None else min(self.health_interval, deadline - time.time())
+                if remaining <= 0 or not self.connected:
+                    return finished
+                self._cond.wait(remaining)
+
+    def get_error(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job["backend"].events is None:
+            return ""
+        return job["backend"].events.get_error(job["remote_id"])
+
+    def get_timing(self, job_id):
+        """返回 (开始执行时间, 执行结束时间)，取自所在实例的事件流 (本机时钟)，没有记录的一项为 None"""
+        backend, remote_id = self._locate(job_id)
+        if backend is None or backend.events is None:
+            return None, None
+        return backend.events.get_timing(remote_id)
+
+    def get_history_timing(self, job_id):
+        """读取所在实例 /history 中的开始 / 结束时间 (该实例的服务器时钟)"""
+        backend, remote_id = self._locate(job_id)
+        if backend is None:
+            return None, None
+        return backend.agent.get_history_timing(remote_id)
+
+    def forget(self, job_id):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is not None:
+                self._finished[job_id] = (job["backend"], job["remote_id"])
+                while len(self._finished) > self.keep_finished:
+                    self._finished.popitem(last=False)
+        if job is not None:
+            job["backend"].in_flight.discard(job_id)
+            if job["backend"].events is not None:
+                job["backend"].events.forget(job["remote_id"])
+
+    # === 输出归档 (供 AssetManager.archive_job 使用) ===
+    def _locate(self, job_id):
+        """返回任务当前 (或最终) 所在的 (backend, remote_id)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job["backend"], job["remote_id"]
+            return self._finished.get(job_id, (None, None))
+
+    def backend_of(self, job_id):
+        """任务当前 (或最终) 所在实例的地址"""
+        backend, _ = self._locate(job_id)
+        return backend.base_url if backend is not None else None
+
+    def get_outputs(self, job_id, wait=3.0):
+        backend, remote_id = self._locate(job_id)
+        if backend is None:
+            return []
+        return [dict(image, backend=backend.base_url) for image in backend.agent.get_outputs(remote_id, wait=wait)]
+
+    def download_output(self, image, dst_path, chunk_size=1024 * 1024):
+        backend = next(b for b in self.backends if b.base_url == image["backend"])
+        return backend.agent.download_output(image, dst_path, chunk_size=chunk_size)
+
+    def close(self):
+        for backend in self.backends:
+            if backend.events is not None:
+                backend.events.close()
@@ -0,0 +1,264 @@
+import functools
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 耗时直方图的分桶上限 (秒)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRIC_NAME = "aigc_span_seconds"
+ERROR_METRIC_NAME = "aigc_span_errors_total"
+
+
+class _NoopSpan:
+    """未启用遥测时 span() 返回的共享空对象：不计时、不加锁、不分配"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "attrs", "start")
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.record(self.name, self.start, time.perf_counter() - self.start, self.attrs, error=exc_type is not None)
+        return False
+
+    def set(self, **attrs):
+        """补充属性 (例如执行中才知道的 prompt_id)"""
+        self.attrs.update(attrs)
+
+
+class Tracer:
+    """
+    流水线埋点的收集器：每个 span 结束时更新按名称聚合的耗时直方图，
+    并把事件追加到有界环形缓冲区 (只保留最近 max_events 个)，用于导出 Chrome trace。
+    """
+    def __init__(self, max_events=200000):
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=max_events)
+        self._stats = {}  # span 名称 -> [次数, 总耗时, 错误数, 各分桶计数]
+        self._epoch = time.time() - time.perf_counter()  # perf_counter -> 墙上时间
+
+    def record(self, name, start, duration, attrs=None, error=False, track=None):
+        """
+        记录一个已结束的 span
+        :param start: time.perf_counter() 时刻
+        :param track: Chrome trace 中的轨道名，默认为当前线程名
+        """
+        if track is None:
+            track = threading.current_thread().name
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = [0, 0.0, 0, [0] * len(BUCKETS)]
+            stats[0] += 1
+            stats[1] += duration
+            if error:
+                stats[2] += 1
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats[3][i] += 1
+                    break
+            self._events.append((name, self._epoch + start, duration, track, attrs or None, error))
+
+    def record_wall(self, name, start, end, track, **attrs):
+        """以墙上时间 (time.time()) 记录一个 span，用于 ComfyUI 侧的排队 / 执行等外部时段"""
+        self.record(name, start - self._epoch, max(0.0, end - start), attrs, track=track)
+
+    def snapshot(self):
+        """{span 名称: {"count", "sum", "errors", "buckets"}}，buckets 为累计计数"""
+        with self._lock:
+            items = [(name, list(stats[:3]), list(stats[3])) for name, stats in self._stats.items()]
+        result = {}
+        for name, (count, total, errors), buckets in items:
+            cumulative, running = [], 0
+            for n in buckets:
+                running += n
+                cumulative.append(running)
+            result[name] = {"count": count, "sum": total, "errors": errors, "buckets": cumulative}
+        return result
+
+    def prometheus(self):
+        """Prometheus 文本格式 (0.0.4)"""
+        lines = [f"# HELP {METRIC_NAME} 流水线各阶段耗时 (秒)", f"# TYPE {METRIC_NAME} histogram"]
+        snapshot = self.snapshot()
+        for name, stats in sorted(snapshot.items()):
+            label = f'span="{_escape(name)}"'
+            for bound, count in zip(BUCKETS, stats["buckets"]):
+                lines.append(f'{METRIC_NAME}_bucket{{{label},le="{bound:g}"}} {count}')
+            lines.append(f'{METRIC_NAME}_bucket{{{label},le="+Inf"}} {stats["count"]}')
+            lines.append(f"{METRIC_NAME}_sum{{{label}}} {stats['sum']:.6f}")
+            lines.append(f"{METRIC_NAME}_count{{{label}}} {stats['count']}")
+        lines += [f"# HELP {ERROR_METRIC_NAME} 以异常结束的 span 数", f"# TYPE {ERROR_METRIC_NAME} counter"]
+        for name, stats in sorted(snapshot.items()):
+            lines.append(f'{ERROR_METRIC_NAME}{{span="{_escape(name)}"}} {stats["errors"]}')
+        return "\n".join(lines) + "\n"
+
+    def chrome_trace(self, since=None, until=None):
+        """
+        Chrome trace (chrome://tracing / Perfetto) 格式的事件，按时间范围 (墙上时间) 过滤
+        :return: {"traceEvents": [...]}
+        """
+        with self._lock:
+            events = list(self._events)
+        pid = os.getpid()
+        tids = {}
+        trace = []
+        for name, start, duration, track, attrs, error in events:
+            if (since is not None and start + duration < since) or (until is not None and start > until):
+                continue
+            tid = tids.setdefault(track, len(tids) + 1)
+            event = {"name": name, "cat": name.split(".")[0], "ph": "X", "ts": round(start * 1e6),
+                     "dur": round(duration * 1e6), "pid": pid, "tid": tid}
+            if attrs or error:
+                event["args"] = dict(attrs or {}, **({"error": True} if error else {}))
+            trace.append(event)
+        for track, tid in tids.items():
+            trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": track}})
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path, since=None, until=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(since, until), f, ensure_ascii=False, default=str)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def write_prometheus(self, path):
+        """写入 Prometheus 文本文件 (node_exporter textfile collector 或界面分析页读取)"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+        return path
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# 进程级收集器：None 表示未启用，span() 直接返回空对象
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def enable(max_events=200000):
+    """启用遥测 (重复调用返回同一个收集器)"""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer(max_events)
+        return _tracer
+
+
+def disable():
+    global _tracer
+    with _tracer_lock:
+        _tracer = None
+
+
+def tracer():
+    """当前收集器，未启用时为 None"""
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, **attrs):
+    """
+    埋点：with telemetry.span("comfy.send_job"): ...
+    未启用时只有一次全局变量判断，返回共享的空上下文
+    """
+    current = _tracer
+    if current is None:
+        return _NOOP
+    return _Span(current, name, attrs)
+
+
+def traced(name):
+    """把整个函数包成一个 span 的装饰器"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            current = _tracer
+            if current is None:
+                return fn(*args, **kwargs)
+            with _Span(current, name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+_SAMPLE = re.compile(r'^(\w+)\{span="((?:[^"\\]|\\.)*)"(?:,le="[^"]*")?\}\s+(\S+)$')
+
+
+def parse_prometheus(text):
+    """
+    读取 Tracer.prometheus() 导出的文本 (界面分析页使用)
+    :return: {span 名称: {"count", "sum", "errors"}}
+    """
+    result = {}
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if not match:
+            continue
+        metric, name, value = match.groups()
+        name = name.replace('\\"', '"').replace("\\n", "\n").replace("\\\\", "\\")
+        stats = result.setdefault(name, {"count": 0, "sum": 0.0, "errors": 0})
+        if metric == f"{METRIC_NAME}_count":
+            stats["count"] = int(float(value))
+        elif metric == f"{METRIC_NAME}_sum":
+            stats["sum"] = float(value)
+        elif metric == ERROR_METRIC_NAME:
+            stats["errors"] = int(float(value))
+    return result
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        current = _tracer
+        body = (current.prometheus() if current else "").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_metrics(port, host="0.0.0.0"):
+    """在后台线程中提供 http://host:port/metrics 供 Prometheus 抓取"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+def _load_pil():
+    """PIL 只在第一次生成缩略图时导入，缓存全部命中时不付出导入开销"""
+    from PIL import Image, ImageFile
+    ImageFile.LOAD_TRUNCATED_IMAGES = True  # 允许加载截断的图片文件
+    return Image
+
+
+class ThumbnailCache:
+    """
+    画廊缩略图缓存。
+    缩略图以 (路径, mtime, 文件大小) 为键存放在磁盘上，原图一旦变化键就随之失效；
+    总大小超出预算时按最近最少使用 (LRU) 淘汰。缩略图在后台线程池中生成，
+    并缓存按修改时间排序的目录列表，目录不变时不再逐个 stat。
+    """
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, size=(384, 384), fmt="WEBP", quality=80, workers=4):
+        """
+        :param max_bytes: 缓存目录的容量上限 (字节)
+        :param size: 缩略图最大边长 (宽, 高)，保持原图比例
+        :param fmt: WEBP 或 JPEG
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = size
+        self.fmt = fmt.upper()
+        self.ext = ".webp" if self.fmt == "WEBP" else ".jpg"
+        self.quality = quality
+
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()  # 缩略图文件名 -> 字节数，越靠后越新
+        self._total = 0
+        self._pending = {}         # 缩略图文件名 -> Future
+        self._listings = {}        # 目录 -> (目录 mtime, 排序后的文件名列表)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbs")
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """按文件修改时间 (每次命中都会 touch) 恢复 LRU 顺序"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.ext):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._lru[name] = size
+            self._total += size
+
+    # === 目录列表 ===
+    def list_images(self, directory, exts=(".png",)):
+        """
+        返回目录中的图片文件名，按修改时间从新到旧排序。
+        目录 mtime 未变化时直接返回缓存的列表。
+        """
+        if not os.path.exists(directory):
+            return []
+        dir_mtime = os.stat(directory).st_mtime_ns
+        cached = self._listings.get(directory)
+        if cached and cached[0] == dir_mtime:
+            return cached[1]
+
+        files = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.lower().endswith(exts) and entry.is_file():
+                    files.append((entry.stat().st_mtime, entry.name))
+        files.sort(reverse=True)
+        listing = [name for _, name in files]
+        self._listings[directory] = (dir_mtime, listing)
+        return listing
+
+    def invalidate(self, directory=None):
+        """丢弃缓存的目录列表"""
+        if directory is None:
+            self._listings.clear()
+        else:
+            self._listings.pop(directory, None)
+
+    # === 缩略图 ===
+    def _key(self, path):
+        st = os.stat(path)
+        raw = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest() + self.ext
+
+    def get(self, path):
+        """返回已生成的缩略图路径，尚未生成时返回 None"""
+        try:
+            name = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            if name not in self._lru:
+                return None
+            self._lru.move_to_end(name)
+        thumb_path = os.path.join(self.cache_dir, name)
+        try:
+            os.utime(thumb_path)  # 记录访问时间，重启后仍能恢复 LRU 顺序
+        except OSError:
+            with self._lock:
+                self._total -= self._lru.pop(name, 0)
+            return None
+        return thumb_path
+
+    def request(self, path):
+        """
+        请求一张缩略图：已缓存则直接返回路径，否则提交到后台线程池生成并返回 Future
+        """
+        thumb_path = self.get(path)
+        if thumb_path:
+            return thumb_path
+        try:
+            name = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            future = self._pending.get(name)
+            if future is None:
+                future = self._pool.submit(self._generate, path, name)
+                self._pending[name] = future
+        return future
+
+    def ensure(self, paths, timeout=10):
+        """
+        批量获取缩略图，最多等待 timeout 秒
+        :return: {原图路径: 缩略图路径或 None}
+        """
+        requested = {path: self.request(path) for path in paths}
+        futures = [r for r in requested.values() if r is not None and not isinstance(r, str)]
+        if futures:
+            wait(futures, timeout=timeout)
+
+        result = {}
+        for path, r in requested.items():
+            if r is None or isinstance(r, str):
+                result[path] = r
+            elif r.done() and r.exception() is None:
+                result[path] = r.result()
+            else:
+                result[path] = None
+        return result
+
+    def prefetch(self, paths):
+        """后台预生成 (例如下一页)，不等待结果"""
+        for path in paths:
+            self.request(path)
+
+    def _generate(self, path, name):
+        thumb_path = os.path.join(self.cache_dir, name)
+        tmp_path = f"{thumb_path}.{threading.get_ident()}.tmp"
+        try:
+            Image = _load_pil()
+            with Image.open(path) as img:
+                img.draft("RGB", self.size)  # JPEG 源图可在解码阶段直接降采样
+                img.thumbnail(self.size)
+                if img.mode not in ("RGB", "RGBA"):
+                    img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+                if self.fmt == "JPEG" and img.mode == "RGBA":
+                    img = img.convert("RGB")
+                img.save(tmp_path, self.fmt, quality=self.quality)
+            os.replace(tmp_path, thumb_path)
+            size = os.path.getsize(thumb_path)
+            with self._lock:
+                self._total += size - self._lru.pop(name, 0)
+                self._lru[name] = size
+            self._evict()
+            return thumb_path
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print(f"⚠️ 缩略图生成失败 {os.path.basename(path)}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+    def _evict(self):
+        """超出容量预算时从最久未访问的缩略图开始删除，直到降到预算的 90%"""
+        victims = []
+        with self._lock:
+            if self._total <= self.max_bytes:
+                return
+            while self._lru and self._total > self.max_bytes * 0.9:
+                name, size = self._lru.popitem(last=False)
+                self._total -= size
+                victims.append(name)
+        for name in victims:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"count": len(self._lru), "bytes": self._total, "pending": len(self._pending)}
@@ -0,0 +1,116 @@
+import random
+
+from src.data_processor import compile_workflow
+
+# 🔗 节点 ID (config/workflow_api.json)
+NODE_ID_PROMPT = "6"
+NODE_ID_NEGATIVE = "7"
+NODE_ID_KSAMPLER = "3"
+NODE_ID_KSAMPLER_2 = "18" # 第二遍采样的采样器
+NODE_ID_CHECKPOINT = "4"
+NODE_ID_EMPTY_LATENT = "5"
+NODE_ID_LORA = "10"
+NODE_ID_CN_LOADER = "11"
+NODE_ID_CN_IMAGE = "13"
+NODE_ID_CN_APPLY = "12"
+NODE_ID_UPSCALE_LOADER = "15"
+NODE_ID_UPSCALE_IMAGE = "16"
+NODE_ID_SAVE_IMAGE = "9"
+NODE_ID_DRAFT_IMAGE = "20" # 精修模式新增的 LoadImage：已保存的草图，替代第一遍采样的解码结果
+
+# 🧩 模板参数绑定：参数名 -> [(节点 ID, 输入名), ...]
+WORKFLOW_BINDINGS = {
+    "prompt": [(NODE_ID_PROMPT, "text")],
+    "negative": [(NODE_ID_NEGATIVE, "text")],
+    "seed": [(NODE_ID_KSAMPLER, "seed"), (NODE_ID_KSAMPLER_2, "seed")],
+    "ckpt": [(NODE_ID_CHECKPOINT, "ckpt_name")],
+    "width": [(NODE_ID_EMPTY_LATENT, "width")],
+    "height": [(NODE_ID_EMPTY_LATENT, "height")],
+    "lora": [(NODE_ID_LORA, "lora_name")],
+    "lora_strength": [(NODE_ID_LORA, "strength_model"), (NODE_ID_LORA, "strength_clip")],
+    "cn": [(NODE_ID_CN_LOADER, "control_net_name")],
+    "cn_image": [(NODE_ID_CN_IMAGE, "image")],
+    "cn_strength": [(NODE_ID_CN_APPLY, "strength")],
+    "upscale_model": [(NODE_ID_UPSCALE_LOADER, "model_name")],
+    "hires_steps": [(NODE_ID_KSAMPLER_2, "steps")],
+    "hires_denoise": [(NODE_ID_KSAMPLER_2, "denoise")],
+    "save_images": [(NODE_ID_SAVE_IMAGE, "images")],
+    "filename_prefix": [(NODE_ID_SAVE_IMAGE, "filename_prefix")],
+}
+
+# 不使用 LoRA 时 LoRA 节点仍需一个存在的模型名 (权重为 0)
+DEFAULT_DUMMY_LORA = "blindbox_v1_mix.safetensors"
+
+
+def _lora_params(lora, lora_str, dummy_lora):
+    if lora != "None":
+        return {"lora": lora, "lora_strength": lora_str}
+    return {"lora": dummy_lora or DEFAULT_DUMMY_LORA, "lora_strength": 0}
+
+
+def build_workflow(template, prompt, neg_prompt, width, height, ckpt, lora, lora_str, cn, cn_img, upscale, upscale_model, seed, filename_prefix, dummy_lora=None):
+    """
+    组装一个任务的工作流 (界面单张任务与后台 worker 共用)
+    :param template: 以 WORKFLOW_BINDINGS 编译的 WorkflowTemplate
+    :param dummy_lora: 关闭 LoRA 时填入 LoRA 节点的模型名
+    :return: (workflow, 实际使用的种子)
+    """
+    # 1. 基础设置 + 2. 文件名前缀 (Tier 7 核心)
+    params = {"prompt": prompt, "negative": neg_prompt, "ckpt": ckpt, "width": width, "height": height, "filename_prefix": filename_prefix}
+
+    # 3. LoRA
+    params.update(_lora_params(lora, lora_str, dummy_lora))
+
+    # 4. ControlNet
+    if cn != "None":
+        params["cn"] = cn
+        if cn_img: params["cn_image"] = cn_img
+    else:
+        params["cn_strength"] = 0
+
+    # 5. Upscale 动态路由
+    # 如果启用放大：SaveImage -> Node 19 (高清解码)，并确保第二遍采样器的降噪不为0
+    # 如果关闭放大：SaveImage -> Node 8 (基础解码)，放大模型与第二遍采样器不再是输出的上游，编译时删除
+    if upscale and upscale_model:
+        params.update(upscale_model=upscale_model, save_images=["19", 0], hires_denoise=0.5)
+    else:
+        params["save_images"] = ["8", 0]
+
+    # 6. 种子 (处理所有采样器)
+    final_seed = seed if seed != -1 else random.randint(1, 10**14)
+    params["seed"] = final_seed
+
+    # 7. 编译：旁路权重为 0 的 LoRA / ControlNet，删除到不了 SaveImage 的节点，ComfyUI 不再加载用不到的模型
+    return compile_workflow(template.render(**params)), final_seed
+
+
+def build_refine_workflow(template, draft_image, prompt, neg_prompt, ckpt, lora, lora_str, upscale_model, seed, filename_prefix,
+                          dummy_lora=None, denoise=0.5):
+    """
+    精修 (草图模式的第二阶段)：只跑放大 + 第二遍采样。
+    已保存的草图经 LoadImage 接到放大节点 (16)，代替第一遍采样的解码输出 (8)；
+    第一遍采样 (3 / 5 / 8) 与 ControlNet 不在输出的上游，编译时删除。
+    种子与草图相同，构图保持不变。
+    :param draft_image: 草图在 ComfyUI input 目录中的文件名
+    :return: workflow
+    """
+    params = {"prompt": prompt, "negative": neg_prompt, "ckpt": ckpt, "filename_prefix": filename_prefix, "seed": seed,
+              "upscale_model": upscale_model, "save_images": ["19", 0], "hires_denoise": denoise}
+    params.update(_lora_params(lora, lora_str, dummy_lora))
+    workflow = template.render(**params)
+    upscale = workflow[NODE_ID_UPSCALE_IMAGE]
+    workflow[NODE_ID_UPSCALE_IMAGE] = dict(upscale, inputs=dict(upscale["inputs"], image=[NODE_ID_DRAFT_IMAGE, 0]))
+    workflow[NODE_ID_DRAFT_IMAGE] = {"inputs": {"image": draft_image, "upload": "image"}, "class_type": "LoadImage",
+                                     "_meta": {"title": "草图 (精修输入)"}}
+    return compile_workflow(workflow)
+
+
+def with_batch_size(workflow, batch_size):
+    """
+    潜空间批处理：让已组装的工作流一次生成 batch_size 张图 (EmptyLatentImage.batch_size)
+    :return: 新的工作流字典 (只复制被修改的节点，原工作流不变)
+    """
+    node = workflow[NODE_ID_EMPTY_LATENT]
+    batched = dict(workflow)
+    batched[NODE_ID_EMPTY_LATENT] = dict(node, inputs=dict(node["inputs"], batch_size=batch_size))
+    return batched
@@ -0,0 +1,148 @@
+"""
+compile_workflow 的剪枝结果：LoRA / ControlNet / 放大三个开关的全部组合与精修工作流，
+对照 config/workflow_api.json 检查保留的节点、连线是否都指向图中的节点、模板是否保持不变。
+另用手写的小图检查连续旁路 (LoRA -> LoRA、ControlNet) 与部分权重为 0 时不旁路。
+
+运行: python -m pytest -q tests
+"""
+import copy
+import itertools
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.data_processor import WorkflowTemplate, compile_workflow
+from src.workflow_builder import WORKFLOW_BINDINGS, build_refine_workflow, build_workflow
+
+TEMPLATE_PATH = os.path.join(ROOT, "config", "workflow_api.json")
+
+# 任何组合都保留的节点：模型、提示词、第一遍采样与解码、SaveImage
+BASE_NODES = {"3", "4", "5", "6", "7", "8", "9"}
+LORA_NODES = {"10"}
+CN_NODES = {"11", "12", "13", "14"}
+UPSCALE_NODES = {"15", "16", "17", "18", "19"}
+
+
+@pytest.fixture
+def template():
+    return WorkflowTemplate.from_file(TEMPLATE_PATH, WORKFLOW_BINDINGS)
+
+
+def links(workflow):
+    """工作流中全部 (节点 ID, 输入名, 连线)"""
+    for node_id, node in workflow.items():
+        for name, value in node["inputs"].items():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                yield node_id, name, value
+
+
+def assert_links_resolve(workflow):
+    dangling = [(node_id, name, value) for node_id, name, value in links(workflow) if value[0] not in workflow]
+    assert not dangling, f"连线指向已删除的节点: {dangling}"
+
+
+@pytest.mark.parametrize("lora, cn, upscale", list(itertools.product([False, True], repeat=3)))
+def test_build_workflow_prunes_disabled_branches(template, lora, cn, upscale):
+    original = copy.deepcopy(template.workflow_data)
+    workflow, _ = build_workflow(
+        template, "1girl", "lowres", 512, 680, "anything-v5-PrtRE.safetensors",
+        "blindbox_v1_mix.safetensors" if lora else "None", 0.8,
+        "control_v11p_sd15_canny.pth" if cn else "None", "ref.png" if cn else None,
+        upscale, "4x-UltraSharp.pth", 1234, "Job_00001")
+
+    expected = set(BASE_NODES)
+    if lora:
+        expected |= LORA_NODES
+    if cn:
+        expected |= CN_NODES
+    if upscale:
+        expected |= UPSCALE_NODES
+    assert set(workflow) == expected
+    assert_links_resolve(workflow)
+    assert template.workflow_data == original
+
+    # 旁路的节点由它的输入直接接到下游
+    model_source = "10" if lora else "4"
+    assert workflow["3"]["inputs"]["model"] == [model_source, 0]
+    assert workflow["6"]["inputs"]["clip"] == [model_source, 1]
+    assert workflow["3"]["inputs"]["positive"] == (["12", 0] if cn else ["6", 0])
+    assert workflow["3"]["inputs"]["negative"] == (["12", 1] if cn else ["7", 0])
+    assert workflow["9"]["inputs"]["images"] == (["19", 0] if upscale else ["8", 0])
+    assert workflow["3"]["inputs"]["seed"] == 1234
+    if upscale:
+        assert workflow["18"]["inputs"]["seed"] == 1234
+
+
+@pytest.mark.parametrize("lora", [False, True])
+def test_build_refine_workflow_drops_first_pass(template, lora):
+    original = copy.deepcopy(template.workflow_data)
+    workflow = build_refine_workflow(
+        template, "draft_abc123.png", "1girl", "lowres", "anything-v5-PrtRE.safetensors",
+        "blindbox_v1_mix.safetensors" if lora else "None", 0.8, "4x-UltraSharp.pth", 1234, "Job_00001")
+
+    expected = {"4", "6", "7", "9", "20"} | UPSCALE_NODES | (LORA_NODES if lora else set())
+    assert set(workflow) == expected
+    assert_links_resolve(workflow)
+    assert template.workflow_data == original
+    assert workflow["16"]["inputs"]["image"] == ["20", 0]
+    assert workflow["20"]["inputs"]["image"] == "draft_abc123.png"
+    assert workflow["18"]["inputs"]["model"] == (["10", 0] if lora else ["4", 0])
+
+
+def test_compile_is_idempotent(template):
+    workflow, _ = build_workflow(template, "1girl", "lowres", 512, 512, "anything-v5-PrtRE.safetensors", "None", 0.8,
+                                 "None", None, False, "4x-UltraSharp.pth", 1, "Job_00001")
+    assert compile_workflow(workflow) == workflow
+
+
+def test_graph_without_output_node_is_unchanged(template):
+    workflow = {node_id: node for node_id, node in template.workflow_data.items() if node["class_type"] != "SaveImage"}
+    workflow["10"] = dict(workflow["10"], inputs=dict(workflow["10"]["inputs"], strength_model=0, strength_clip=0))
+    original = copy.deepcopy(workflow)
+
+    compiled = compile_workflow(workflow)
+    assert compiled is workflow
+    assert workflow == original
+
+
+def test_chained_bypasses_resolve_to_first_live_node():
+    workflow = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "a.safetensors"}},
+        "2": {"class_type": "LoraLoader", "inputs": {"model": ["1", 0], "clip": ["1", 1], "lora_name": "a", "strength_model": 0, "strength_clip": 0}},
+        "3": {"class_type": "LoraLoaderModelOnly", "inputs": {"model": ["2", 0], "lora_name": "b", "strength_model": 0}},
+        "4": {"class_type": "CLIPTextEncode", "inputs": {"clip": ["2", 1], "text": "1girl"}},
+        "5": {"class_type": "ControlNetLoader", "inputs": {"control_net_name": "canny.pth"}},
+        "6": {"class_type": "LoadImage", "inputs": {"image": "ref.png"}},
+        "7": {"class_type": "ControlNetApplyAdvanced", "inputs": {"positive": ["4", 0], "negative": ["4", 0], "control_net": ["5", 0],
+                                                                  "image": ["6", 0], "strength": 0}},
+        "8": {"class_type": "KSampler", "inputs": {"model": ["3", 0], "positive": ["7", 0], "negative": ["7", 1], "seed": 1}},
+        "9": {"class_type": "VAEDecode", "inputs": {"samples": ["8", 0], "vae": ["1", 2]}},
+        "10": {"class_type": "SaveImage", "inputs": {"images": ["9", 0]}},
+    }
+    original = copy.deepcopy(workflow)
+
+    compiled = compile_workflow(workflow)
+    assert set(compiled) == {"1", "4", "8", "9", "10"}
+    assert compiled["8"]["inputs"]["model"] == ["1", 0]
+    assert compiled["4"]["inputs"]["clip"] == ["1", 1]
+    assert compiled["8"]["inputs"]["positive"] == ["4", 0]
+    assert compiled["8"]["inputs"]["negative"] == ["4", 0]
+    assert_links_resolve(compiled)
+    # 输入不变；连线没有改写的节点与输入共享
+    assert workflow == original
+    assert compiled["9"] is workflow["9"]
+
+
+def test_partial_strength_is_not_bypassed():
+    workflow = {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "a.safetensors"}},
+        "2": {"class_type": "LoraLoader", "inputs": {"model": ["1", 0], "clip": ["1", 1], "lora_name": "a", "strength_model": 0, "strength_clip": 0.5}},
+        "3": {"class_type": "CLIPTextEncode", "inputs": {"clip": ["2", 1], "text": "1girl"}},
+        "4": {"class_type": "KSampler", "inputs": {"model": ["2", 0], "positive": ["3", 0], "negative": ["3", 0], "seed": 1}},
+        "5": {"class_type": "SaveImage", "inputs": {"images": ["4", 0]}},
+    }
+    assert compile_workflow(workflow) == workflow
@@ -0,0 +1,99 @@
+"""
+ComfyEventStream 对照 FakeComfyServer：成功、execution_error、等待超时，
+以及执行中途 WebSocket 断开时 wait 立即返回、改查 /history 仍能拿到结果，之后自动重连。
+
+运行: python -m pytest -q tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.comfy_client import ComfyAgent
+from src.fake_comfy import FakeComfyServer
+
+pytest.importorskip("websocket")
+
+WORKFLOW = {
+    "1": {"class_type": "EmptyLatentImage", "inputs": {"batch_size": 1}},
+    "2": {"class_type": "KSampler", "inputs": {"latent_image": ["1", 0], "seed": 1}},
+    "3": {"class_type": "SaveImage", "inputs": {"images": ["2", 0], "filename_prefix": "t"}},
+}
+
+
+def start_server(tmp_path, **kwargs):
+    return FakeComfyServer(output_dir=str(tmp_path), **kwargs).start()
+
+
+def submit(agent):
+    ok, prompt_id = agent.send_job(WORKFLOW)
+    assert ok, prompt_id
+    return prompt_id
+
+
+def test_wait_returns_success(tmp_path):
+    with start_server(tmp_path) as server:
+        agent = ComfyAgent(server.base_url)
+        with agent.open_event_stream() as events:
+            assert events.connected
+            prompt_id = submit(agent)
+            assert events.wait(prompt_id, timeout=5) == "success"
+            started, ended = events.get_timing(prompt_id)
+            assert started is not None and ended is not None and started <= ended
+            assert events.get_error(prompt_id) == ""
+
+
+def test_wait_reports_execution_error(tmp_path):
+    with start_server(tmp_path, fail_rate=1.0) as server:
+        agent = ComfyAgent(server.base_url)
+        with agent.open_event_stream() as events:
+            prompt_id = submit(agent)
+            assert events.wait(prompt_id, timeout=5) == "failed"
+            assert events.get_error(prompt_id) == "模拟执行失败"
+            # 出错后补发的 executing(node=None) 不会把失败改成成功
+            time.sleep(0.1)
+            assert events.get_status(prompt_id) == "failed"
+
+
+def test_wait_times_out_while_running(tmp_path):
+    with start_server(tmp_path, exec_time=1.0) as server:
+        agent = ComfyAgent(server.base_url)
+        with agent.open_event_stream() as events:
+            prompt_id = submit(agent)
+            begin = time.time()
+            assert events.wait(prompt_id, timeout=0.2) is None
+            assert time.time() - begin < 0.9
+            assert events.connected
+            assert events.wait(prompt_id, timeout=5) == "success"
+
+
+def test_socket_drop_falls_back_to_history(tmp_path):
+    with start_server(tmp_path, exec_time=0.5) as server:
+        agent = ComfyAgent(server.base_url)
+        with agent.open_event_stream() as events:
+            prompt_id = submit(agent)
+            time.sleep(0.1)
+            server.drop_websockets(reject_for=1.0)
+
+            # 断线后 wait 不再干等到超时，调用方改查 /history
+            begin = time.time()
+            assert events.wait(prompt_id, timeout=5) is None
+            assert time.time() - begin < 1.0
+            assert not events.connected
+            assert events.get_status(prompt_id) is None
+
+            deadline = time.time() + 5
+            while agent.get_job_status(prompt_id) is None and time.time() < deadline:
+                time.sleep(0.05)
+            assert agent.get_job_status(prompt_id) == "success"
+
+            # 拒绝期过后后台线程按退避间隔重连，新任务重新走事件流
+            deadline = time.time() + 10
+            while not events.connected and time.time() < deadline:
+                time.sleep(0.05)
+            assert events.connected
+            assert events.wait(submit(agent), timeout=5) == "success"
@@ -0,0 +1,150 @@
+"""
+MultiBackendDispatcher 对照两个 FakeComfyServer：按负载选择实例、实例宕机后迁移未完成的任务、
+离线实例的探测退避，以及实例已宕机但尚未被标记离线时 send_job / get_job_status 的改道。
+
+运行: python -m pytest -q tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src import comfy_client
+from src.fake_comfy import FakeComfyServer
+from src.scheduler import MultiBackendDispatcher
+
+WORKFLOW = {
+    "1": {"class_type": "EmptyLatentImage", "inputs": {"batch_size": 1}},
+    "2": {"class_type": "KSampler", "inputs": {"latent_image": ["1", 0], "seed": 1}},
+    "3": {"class_type": "SaveImage", "inputs": {"images": ["2", 0], "filename_prefix": "t"}},
+}
+
+
+@pytest.fixture
+def servers(tmp_path):
+    started = [FakeComfyServer(output_dir=str(tmp_path / name), exec_time=0.3).start() for name in ("a", "b")]
+    yield started
+    for server in started:
+        server.stop()
+
+
+@pytest.fixture
+def make_dispatcher(servers):
+    created = []
+
+    def make(**kwargs):
+        kwargs.setdefault("use_events", False)
+        dispatcher = MultiBackendDispatcher([s.base_url for s in servers], **kwargs)
+        created.append(dispatcher)
+        return dispatcher
+
+    yield make
+    for dispatcher in created:
+        dispatcher.close()
+
+
+def submit(dispatcher):
+    ok, job_id = dispatcher.send_job(WORKFLOW)
+    assert ok, job_id
+    return job_id
+
+
+def wait_status(dispatcher, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = dispatcher.get_job_status(job_id)
+        if status is not None:
+            return status
+        time.sleep(0.05)
+    return None
+
+
+def test_sends_to_least_loaded_backend(servers, make_dispatcher):
+    dispatcher = make_dispatcher(health_interval=60)
+    a, b = dispatcher.backends
+    assert a.healthy and b.healthy
+
+    # a 上有其他客户端排队的任务，先发往 b；之后每次都选当前负载 (排队 + 在途) 最低的实例
+    a.external_depth = 1
+    first = submit(dispatcher)
+    assert dispatcher.backend_of(first) == b.base_url
+    jobs = [submit(dispatcher) for _ in range(3)]
+    assert len(a.in_flight) == len(b.in_flight) == 2
+    assert (a.load, b.load) == (3, 2)
+    assert {dispatcher.backend_of(job) for job in jobs} == {a.base_url, b.base_url}
+
+    for job in [first] + jobs:
+        assert wait_status(dispatcher, job) == "success"
+    assert not a.in_flight and not b.in_flight
+
+
+def test_refresh_requeues_in_flight_jobs_from_dead_backend(servers, make_dispatcher):
+    dispatcher = make_dispatcher(health_interval=60)
+    a, b = dispatcher.backends
+    jobs = [submit(dispatcher) for _ in range(2)]
+    on_a = [job for job in jobs if dispatcher.backend_of(job) == a.base_url]
+    assert len(on_a) == 1
+
+    servers[0].stop()
+    dispatcher.refresh(force=True)
+    assert not a.healthy and b.healthy
+    assert not a.in_flight
+    # 迁移后逻辑 ID 不变，任务在 b 上重新执行
+    assert dispatcher.backend_of(on_a[0]) == b.base_url
+    assert dispatcher._jobs[on_a[0]]["attempts"] == 2
+    for job in jobs:
+        assert wait_status(dispatcher, job) == "success"
+
+
+def test_refresh_backs_off_probing_dead_backend(servers, make_dispatcher):
+    dispatcher = make_dispatcher(health_interval=0.5)
+    a, b = dispatcher.backends
+    servers[0].stop()
+
+    dispatcher.refresh(force=True)
+    assert not a.healthy and a.failures == 1
+    first_retry = a.retry_at
+    assert first_retry - time.time() > 0.8  # health_interval * 2
+
+    # 刷新间隔已过，但还没到重试时间：跳过离线实例，不再探测
+    time.sleep(0.6)
+    dispatcher.refresh()
+    assert a.failures == 1 and a.retry_at == first_retry
+    assert b.healthy
+
+    time.sleep(max(first_retry, dispatcher._refreshed_at + dispatcher.health_interval) - time.time() + 0.05)
+    dispatcher.refresh()
+    assert a.failures == 2
+    assert a.retry_at - time.time() > 1.6  # 间隔翻倍
+
+
+def test_send_job_reroutes_when_backend_died_unnoticed(servers, make_dispatcher):
+    dispatcher = make_dispatcher(health_interval=60)
+    a, b = dispatcher.backends
+    b.external_depth = 10  # a 负载最低，会被优先选中
+    servers[0].stop()
+    assert a.healthy  # 还没有刷新，调度器不知道 a 已宕机
+
+    job = submit(dispatcher)
+    assert dispatcher.backend_of(job) == b.base_url
+    assert not a.healthy
+    assert wait_status(dispatcher, job) == "success"
+
+
+def test_get_job_status_fails_over_when_backend_died(servers, make_dispatcher):
+    dispatcher = make_dispatcher(health_interval=60)
+    a, b = dispatcher.backends
+    b.external_depth = 10
+    job = submit(dispatcher)
+    assert dispatcher.backend_of(job) == a.base_url
+
+    servers[0].stop()
+    comfy_client._health_cache.pop(a.base_url, None)  # 不复用宕机前缓存的健康检查结果
+    assert dispatcher.get_job_status(job) is None
+    assert not a.healthy and not a.in_flight
+    assert dispatcher.backend_of(job) == b.base_url
+    assert wait_status(dispatcher, job) == "success"
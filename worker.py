@@ -0,0 +1,98 @@
+import argparse
+import os
+from src import telemetry
+from src.data_processor import load_template
+from src.file_manager import AssetManager
+from src.archive_engine import ArchiveEngine, DELIVERY_FORMATS
+from src.scheduler import MultiBackendDispatcher
+from src.result_cache import ResultCache
+from src.run_ledger import RunLedger
+from src.asset_index import AssetIndex
+from src.reference_images import ReferenceImages
+from src.job_queue import JobQueue
+from src.batch_worker import BatchWorker
+from src.batch_planner import LatentBatcher
+from src.workflow_builder import WORKFLOW_BINDINGS
+
+# ==========================================
+# 🔧 配置区 (与 app.py 保持一致)
+# ==========================================
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(BASE_DIR, "config", "workflow_api.json")
+QUEUE_PATH = os.path.join(BASE_DIR, "queue.sqlite")  # 批量任务队列 (界面登记，worker 执行)
+RESULT_CACHE_PATH = os.path.join(BASE_DIR, "cache", "results.sqlite")  # 工作流结果缓存索引，删除即可全部重新生成
+REF_CACHE_DIR = os.path.join(BASE_DIR, "cache", "refs")
+ASSET_INDEX_PATH = os.path.join(BASE_DIR, "cache", "assets.sqlite")  # 输出图片的感知哈希 (近重复检测)，删除后画廊会重新计算
+LEDGER_PATH = os.path.join(BASE_DIR, "runs.sqlite")
+PROJECT_OUTPUT_DIR = os.path.join(BASE_DIR, "output")
+COMFY_OUTPUT_DIR = r"D:\ComfyUI_Main\ComfyUI-aki-v3\ComfyUI-aki-v3\ComfyUI\output"
+# 与 COMFY_OUTPUT_DIR 在同一台机器上的实例：输出直接从磁盘搬运 (同一盘符时只是重命名)，不经 HTTP 下载
+COMFY_LOCAL_BACKENDS = ["http://127.0.0.1:8188"]
+# 交付副本 (无损 WebP / 优化 PNG + 任务元数据)，在独立进程中编码；None 表示不生成
+DELIVERY_DIR = os.path.join(BASE_DIR, "delivery")
+DELIVERY_FORMAT = None
+
+# ComfyUI 实例列表与每个实例的队列深度
+COMFY_BACKENDS = ["http://127.0.0.1:8188"]
+MAX_IN_FLIGHT = 4
+# 潜空间批处理 (界面勾选后生效)：每次提交最多合并的张数，以及一批的潜空间总像素上限 (开启放大按 4 倍计)
+# 显存较小的显卡请调低 LATENT_BATCH_PIXELS；LATENT_BATCH = 1 表示不合并
+LATENT_BATCH = 4
+LATENT_BATCH_PIXELS = 4 * 512 * 512
+# 遥测 (--telemetry)：各阶段耗时的 Prometheus 指标与每个批次的 Chrome trace，界面 “📈 分析” 页读取
+TELEMETRY_DIR = os.path.join(BASE_DIR, "telemetry")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="后台批量 worker：执行界面 (🚀 批量流水线) 登记到队列中的批次")
+    parser.add_argument("--backends", nargs="+", default=COMFY_BACKENDS, help="ComfyUI 地址，可填多个")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="每个实例同时排队的任务数")
+    parser.add_argument("--queue", default=QUEUE_PATH, help="队列数据库路径")
+    parser.add_argument("--latent-batch", type=int, default=LATENT_BATCH, help="每次提交最多合并的任务数 (1 表示不合并)")
+    parser.add_argument("--deliver", choices=DELIVERY_FORMATS, default=DELIVERY_FORMAT, help="额外生成该格式的交付副本")
+    parser.add_argument("--telemetry", action="store_true", help=f"记录各阶段耗时，导出到 {TELEMETRY_DIR}")
+    parser.add_argument("--metrics-port", type=int, default=None, help="同时在该端口提供 /metrics 供 Prometheus 抓取 (隐含 --telemetry)")
+    args = parser.parse_args()
+    backends = [url.rstrip("/") for url in args.backends]
+
+    print("🤖 AIGC 批量 worker 初始化中...")
+    if args.telemetry or args.metrics_port:
+        telemetry.enable()
+        print(f"🔬 遥测已启用，导出目录: {TELEMETRY_DIR}")
+        if args.metrics_port:
+            telemetry.serve_metrics(args.metrics_port)
+            print(f"📈 Prometheus 指标: http://0.0.0.0:{args.metrics_port}/metrics")
+    template = load_template(TEMPLATE_PATH, WORKFLOW_BINDINGS)
+    agent = MultiBackendDispatcher(backends)
+    print(f"🖥️ 在线实例: {len(agent.healthy_backends)}/{len(backends)}")
+    queue = JobQueue(args.queue)
+    result_cache = ResultCache(RESULT_CACHE_PATH, max_age_days=30)
+    ledger = RunLedger(LEDGER_PATH)
+    engine = ArchiveEngine(delivery_dir=DELIVERY_DIR, delivery_format=args.deliver)
+    archiver = AssetManager(COMFY_OUTPUT_DIR, PROJECT_OUTPUT_DIR, engine=engine, local_backends=COMFY_LOCAL_BACKENDS)
+    references = ReferenceImages([backend.agent for backend in agent.backends], REF_CACHE_DIR)
+    asset_index = AssetIndex(ASSET_INDEX_PATH, PROJECT_OUTPUT_DIR)
+    batcher = LatentBatcher(args.latent_batch, LATENT_BATCH_PIXELS) if args.latent_batch > 1 else None
+    worker = BatchWorker(queue, agent, archiver, template,
+                         result_cache=result_cache, ledger=ledger, references=references, batcher=batcher,
+                         asset_index=asset_index,
+                         max_in_flight=args.max_in_flight * len(backends),
+                         telemetry_dir=TELEMETRY_DIR if telemetry.enabled() else None)
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 worker 已停止，未完成的任务会在下次启动时放回队列")
+    finally:
+        references.close()
+        engine.close()
+        asset_index.close()
+        agent.close()
+        result_cache.evict()
+        print(f"🗃️ 结果缓存: {result_cache.summary()}")
+        result_cache.close()
+        ledger.close()
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()